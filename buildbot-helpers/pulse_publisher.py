@@ -10,6 +10,10 @@ code
 """
 import time
 import re
+import os
+import tempfile
+import threading
+import Queue
 from datetime import tzinfo, timedelta, datetime
 
 from mozillapulse.messages.build import BuildMessage
@@ -27,6 +31,14 @@ skip_exps = [
     re.compile("^build\.\S+\.\d+\.step\."),
 ]
 
+
+def compile_skip_exps(exps):
+    """Combine a list of compiled regular expressions into one, so routing
+    keys only need to be checked once"""
+    if not exps:
+        return None
+    return re.compile("|".join("(?:%s)" % e.pattern for e in exps))
+
 # A UTC class.
 
 
@@ -69,10 +81,49 @@ def transform_times(event):
     return retval
 
 
+class StageStats(object):
+    """
+    Throughput and latency counters for one stage of the publishing
+    pipeline
+    """
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.events = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, events, elapsed):
+        self.batches += 1
+        self.events += events
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        if self.batches:
+            avg_time = self.total_time / self.batches
+        else:
+            avg_time = 0.0
+        if self.total_time:
+            rate = self.events / self.total_time
+        else:
+            rate = 0.0
+        return dict(batches=self.batches, events=self.events,
+                    total_time=self.total_time, avg_time=avg_time,
+                    max_time=self.max_time, rate=rate)
+
+    def __str__(self):
+        return "%(events)i events in %(batches)i batches; %(rate).1f events/s; avg %(avg_time).3fs; max %(max_time).3fs" % self.as_dict()
+
+
 class PulsePusher(object):
     """
     Publish buildbot events via pulse.
 
+    Items are loaded from the queue, filtered and converted into messages by
+    a separate thread, while the main thread publishes them. Up to `window`
+    batches can be waiting to be published at once.
+
     `queuedir`         - a directory to look for incoming events being written
                          by a buildbot master
 
@@ -88,15 +139,42 @@ class PulsePusher(object):
     `retry_time`       - time in seconds to wait between retries
 
     `max_retries`      - how many times to retry
+
+    `batch_size`       - how many queue items to load at once
+
+    `window`           - how many loaded batches can be waiting to be published
+
+    `stats_file`       - where to write per-stage counters every
+                         `stats_interval` seconds, as JSON
     """
     def __init__(self, queuedir, publisher, max_idle_time=300,
-                 max_connect_time=600, retry_time=60, max_retries=5):
+                 max_connect_time=600, retry_time=60, max_retries=5,
+                 batch_size=50, window=10, stats_file=None,
+                 stats_interval=60):
         self.queuedir = QueueDir('pulse', queuedir)
         self.publisher = publisher
         self.max_idle_time = max_idle_time
         self.max_connect_time = max_connect_time
         self.retry_time = retry_time
         self.max_retries = max_retries
+        self.batch_size = batch_size
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+
+        self.skip_exp = compile_skip_exps(skip_exps)
+
+        # Batches of (item_ids, messages, load time) waiting to be published
+        self._pipeline = Queue.Queue(window)
+        # Batches of (item_ids, success) that have been published. The
+        # loader thread is the only one that touches the queuedir, so it
+        # takes care of removing or requeuing these.
+        self._done = Queue.Queue()
+        self._loader = None
+        self._stopping = False
+
+        self.stats = dict((name, StageStats(name))
+                          for name in ('load', 'pipeline', 'publish'))
+        self._last_stats = time.time()
 
         # When should we next disconnect
         self._disconnect_timer = None
@@ -105,32 +183,47 @@ class PulsePusher(object):
         # When did we last connect
         self._last_connection = None
 
+    def prepare(self, events):
+        """
+        Convert events into pulse messages, dropping any we don't want to
+        send
+
+        `events` - a list of buildbot event dicts
+        """
+        messages = []
+        for e in events:
+            routing_key = e['event']
+            if self.skip_exp and self.skip_exp.search(routing_key):
+                log.debug("Skipping event %s", routing_key)
+                continue
+            messages.append(BuildMessage(transform_times(e)))
+        log.debug("Prepared %i messages (skipped %i)", len(messages),
+                  len(events) - len(messages))
+        return messages
+
     def send(self, events):
         """
         Send events to pulse
 
         `events` - a list of buildbot event dicts
         """
+        self.publish(self.prepare(events))
+
+    def publish(self, messages):
+        """
+        Publish messages to pulse
+
+        `messages` - a list of messages returned by prepare()
+        """
         if not self._last_connection and self.max_connect_time:
             self._last_connection = time.time()
-        log.debug("Sending %i messages", len(events))
+        log.debug("Sending %i messages", len(messages))
         start = time.time()
-        skipped = 0
-        sent = 0
-        for e in events:
-            routing_key = e['event']
-            if any(exp.search(routing_key) for exp in skip_exps):
-                skipped += 1
-                log.debug("Skipping event %s", routing_key)
-                continue
-            else:
-                log.debug("Sending event %s", routing_key)
-            msg = BuildMessage(transform_times(e))
+        for msg in messages:
             self.publisher.publish(msg)
-            sent += 1
         end = time.time()
-        log.info("Sent %i messages in %.2fs (skipped %i)", sent,
-                 end - start, skipped)
+        log.info("Sent %i messages in %.2fs", len(messages), end - start)
+        self.stats['publish'].record(len(messages), end - start)
         self._last_activity = time.time()
 
         # Update our timers
@@ -155,69 +248,141 @@ class PulsePusher(object):
             self._last_connection = None
             self._last_activity = None
 
-    def loop(self):
-        """
-        Main processing loop. Read new items from the queue, push them to
-        pulse, remove processed items, and then wait for more.
-        """
+    def report_stats(self):
+        "Log our counters, and write them out to stats_file if it's set"
+        self._last_stats = time.time()
+        for name in ('load', 'pipeline', 'publish'):
+            log.info("%s: %s", name, self.stats[name])
+        if not self.stats_file:
+            return
+        data = dict((name, stats.as_dict())
+                    for name, stats in self.stats.items())
+        data['pending_batches'] = self._pipeline.qsize()
+        data['time'] = self._last_stats
+        fd, tmpname = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.stats_file)))
+        fp = os.fdopen(fd, 'wb')
+        json.dump(data, fp)
+        fp.close()
+        os.rename(tmpname, self.stats_file)
+
+    def _finish_batches(self):
+        "Remove or requeue items that the main thread has finished with"
         while True:
-            self.maybe_disconnect()
-
-            # Grab any new events
-            item_ids = []
-            events = []
-            come_back_soon = False
             try:
-                while True:
-                    item = self.queuedir.pop()
-                    if not item:
-                        break
-                    if len(events) > 50:
-                        come_back_soon = True
-                        break
-
-                    try:
-                        item_id, fp = item
-                        item_ids.append(item_id)
-                        log.debug("Loading %s", item)
-                        events.extend(json.load(fp))
-                    except:
-                        log.exception("Error loading %s", item_id)
-                        raise
-                    finally:
-                        fp.close()
-                log.info("Loaded %i events", len(events))
-                self.send(events)
-                for item_id in item_ids:
+                item_ids, success = self._done.get(block=False)
+            except Queue.Empty:
+                return
+            for item_id in item_ids:
+                if success:
                     log.info("Removing %s", item_id)
                     try:
                         self.queuedir.remove(item_id)
                     except OSError:
                         # Somebody (re-)moved it already, that's ok!
                         pass
+                else:
+                    self.queuedir.requeue(
+                        item_id, self.retry_time, self.max_retries)
+
+    def _load_loop(self):
+        """
+        Loader thread. Read new items from the queue, convert them into
+        messages, and hand them over to the main thread to be published.
+        """
+        while not self._stopping:
+            self._finish_batches()
+            items = self.queuedir.pop_batch(self.batch_size)
+            if not items:
+                # Wake up every so often to look for finished batches
+                self.queuedir.wait(1)
+                continue
+
+            start = time.time()
+            item_ids = []
+            events = []
+            for item_id, fp in items:
+                try:
+                    log.debug("Loading %s", item_id)
+                    events.extend(json.load(fp))
+                    item_ids.append(item_id)
+                except:
+                    log.exception("Error loading %s", item_id)
+                    self.queuedir.requeue(
+                        item_id, self.retry_time, self.max_retries)
+                finally:
+                    fp.close()
+
+            try:
+                messages = self.prepare(events)
             except:
-                log.exception("Error processing messages")
-                # Don't try again soon, something has gone horribly wrong!
-                come_back_soon = False
+                log.exception("Error preparing messages")
                 for item_id in item_ids:
                     self.queuedir.requeue(
                         item_id, self.retry_time, self.max_retries)
-
-            if come_back_soon:
-                # Let's do more right now!
-                log.info("Doing more!")
                 continue
+            log.info("Loaded %i events", len(events))
+            end = time.time()
+            self.stats['load'].record(len(events), end - start)
+
+            # This blocks if the main thread has fallen behind
+            while not self._stopping:
+                try:
+                    self._pipeline.put((item_ids, messages, end), timeout=1)
+                    break
+                except Queue.Full:
+                    self._finish_batches()
+        self._finish_batches()
+
+    def start(self):
+        "Start the loader thread"
+        self._stopping = False
+        self._loader = threading.Thread(target=self._load_loop)
+        self._loader.daemon = True
+        self._loader.start()
+
+    def stop(self):
+        "Stop the loader thread"
+        self._stopping = True
+        if self._loader:
+            self._loader.join()
+            self._loader = None
 
-            # Wait for more
-            # don't wait more than our max_idle/max_connect_time
-            now = time.time()
-            to_wait = None
-            if self._disconnect_timer:
-                to_wait = self._disconnect_timer - now
-                if to_wait < 0:
-                    to_wait = None
-            log.info("Waiting for %s", to_wait)
-            self.queuedir.wait(to_wait)
+    def loop(self):
+        """
+        Main processing loop. Take loaded batches from the loader thread,
+        push them to pulse, and let the loader know which items to remove.
+        """
+        self.start()
+        try:
+            while True:
+                self.maybe_disconnect()
+
+                if time.time() - self._last_stats > self.stats_interval:
+                    self.report_stats()
+
+                # Wait for more
+                # don't wait more than our max_idle/max_connect_time or until
+                # our stats are next due
+                now = time.time()
+                to_wait = self._last_stats + self.stats_interval - now
+                if self._disconnect_timer:
+                    to_wait = min(to_wait, self._disconnect_timer - now)
+                try:
+                    item_ids, messages, loaded = self._pipeline.get(
+                        timeout=max(to_wait, 0.1))
+                except Queue.Empty:
+                    continue
+                self.stats['pipeline'].record(len(messages), time.time() - loaded)
+
+                try:
+                    self.publish(messages)
+                    self._done.put((item_ids, True))
+                except:
+                    log.exception("Error processing messages")
+                    self._done.put((item_ids, False))
+        finally:
+            self.stop()
 
 
 def main():
@@ -231,6 +396,7 @@ def main():
         logfile=None,
         max_retries=5,
         retry_time=60,
+        stats_file=None,
     )
     parser.add_option("--passwords", dest="passwords")
     parser.add_option("-q", "--queuedir", dest="queuedir")
@@ -242,6 +408,8 @@ def main():
                       help="number of times to retry")
     parser.add_option("-t", "--retry_time", dest="retry_time", type="int",
                       help="seconds to wait between retries")
+    parser.add_option("-s", "--stats-file", dest="stats_file",
+                      help="where to write publishing statistics")
 
     options, args = parser.parse_args()
 
@@ -281,7 +449,8 @@ def main():
         exchange=passwords['PULSE_EXCHANGE'])
 
     pusher = PulsePusher(options.queuedir, publisher,
-                         max_retries=options.max_retries, retry_time=options.retry_time)
+                         max_retries=options.max_retries, retry_time=options.retry_time,
+                         stats_file=options.stats_file)
     pusher.loop()
 
 if __name__ == '__main__':
@@ -11,6 +11,10 @@
 #
 # This script, given a path to a symbol store, removes symbols
 # for the oldest builds there.
+#
+# The symbol files each index refers to are kept track of in a
+# database (see symbolindex.py), which post-symbol-upload.py adds new
+# indexes to. Any indexes it doesn't know about yet are read here.
 
 import os
 import os.path
@@ -19,6 +23,9 @@ import re
 from datetime import datetime, timedelta
 from optparse import OptionParser
 
+from symbolindex import SymbolIndex
+from symboldelete import DeletionEngine
+
 # options, tweak as desired
 # maximum number of nightlies to keep per branch
 nightliesPerBin = 30
@@ -37,6 +44,15 @@ parser.add_option("-d", "--dry-run",
 parser.add_option("-r", "--remove-these-symbols",
                   action="store_true", dest="remove_symbols",
                   help="Remove specified symbol indexes and their contained symbols")
+parser.add_option("--index", dest="index",
+                  help="Database of symbol file reference counts. Defaults to "
+                  ".symbol-refcounts.db in the symbol path")
+parser.add_option("--journal", dest="journal",
+                  help="Where to keep track of symbol files being deleted, so an "
+                  "interrupted run can be finished off. Defaults to "
+                  ".cleanup-journal in the symbol path")
+parser.add_option("-j", "--threads", dest="threads", type="int", default=8,
+                  help="How many files to delete at once")
 (options, args) = parser.parse_args()
 
 if not args:
@@ -51,20 +67,6 @@ symbols_to_remove = set()
 if options.remove_symbols:
     symbols_to_remove = set(os.path.basename(a) for a in args[1:])
 
-# Cheezy atom implementation, so we don't have to store symbol filenames
-# multiple times.
-atoms = []
-atomdict = {}
-
-
-def atomize(s):
-    if s in atomdict:
-        return atomdict[s]
-    a = len(atoms)
-    atoms.append(s)
-    atomdict[s] = a
-    return a
-
 
 def sortByBuildID(x, y):
     "Sort two symbol index filenames by the Build IDs contained within"
@@ -91,29 +93,6 @@ def adddefault(d, key, default):
         d[key] = default
 
 
-def addFiles(symbolindex, filesDict):
-    """Return a list of atoms representing the symbols in this index file.
-Also add 1 to filesDict[atom] for each symbol."""
-    l = []
-    try:
-        sf = open(symbolindex, "r")
-        for line in sf:
-            a = atomize(line.rstrip())
-            l.append(a)
-            adddefault(filesDict, a, 0)
-            filesDict[a] += 1
-        sf.close()
-    except IOError:
-        pass
-    return l
-
-
-def markDeleteSymbols(symbols, filesDict):
-    "Decrement reference count by one for each symbol in this symbol index."
-    for a in symbols:
-        filesDict[a] -= 1
-
-
 def deletefile(f):
     if options.dry_run:
         print "rm ", f
@@ -125,17 +104,29 @@ def deletefile(f):
                 print >>sys.stderr, "Error removing file: ", f
 
 builds = {}
-allfiles = {}
-buildfiles = {}
-print "[1/4] Reading symbol index files..."
+# symbol files that are no longer referenced by any index
+orphans = []
+
+
+def removeIndex(f):
+    "Delete symbol index f, and drop its references to symbol files"
+    orphans.extend(index.remove_index(f))
+    deletefile(os.path.join(symbolPath, f))
+
+index = SymbolIndex(symbolPath, options.index)
+engine = DeletionEngine(symbolPath,
+                        options.journal or os.path.join(symbolPath, ".cleanup-journal"),
+                        options.threads, options.dry_run)
+if not options.dry_run:
+    # finish off anything a previous run didn't get to
+    engine.resume(index)
+
+print "[1/3] Reading new symbol index files..."
+# pick up any indexes that were uploaded without being added to the
+# database; files belonging to indexes that have disappeared are orphaned
+orphans.extend(index.sync())
 # get symbol index files, there's one per build
-for f in os.listdir(symbolPath):
-    if not (os.path.isfile(os.path.join(symbolPath, f)) and
-            f.endswith("-symbols.txt")):
-        continue
-    # increment reference count of all symbol files listed in the index
-    # and also keep a list of files from that index
-    buildfiles[f] = addFiles(os.path.join(symbolPath, f), allfiles)
+for f in index.indexes():
     # drop -symbols.txt
     parts = f.split("-")[:-1]
     (product, version, osName, buildId) = parts[:4]
@@ -161,10 +152,9 @@ for f in os.listdir(symbolPath):
     adddefault(builds, identifier, [])
     builds[identifier].append(f)
     if f in symbols_to_remove:
-        markDeleteSymbols(buildfiles[f], allfiles)
-        deletefile(os.path.join(symbolPath,f))
+        removeIndex(f)
 
-print "[2/4] Looking for symbols to delete..."
+print "[2/3] Looking for symbols to delete..."
 if not symbols_to_remove:
     oldestdate = datetime.now() - maxNightlyAge
     for bin in builds:
@@ -175,30 +165,23 @@ if not symbols_to_remove:
         if len(builds[bin]) > nightliesPerBin:
             # delete the oldest builds if there are too many
             for f in builds[bin][:-nightliesPerBin]:
-                markDeleteSymbols(buildfiles[f], allfiles)
-                deletefile(os.path.join(symbolPath,f))
+                removeIndex(f)
             builds[bin] = builds[bin][-nightliesPerBin:]
         # now look for really old symbol files
         for f in builds[bin]:
             if datetimefrombuildid(f) < oldestdate:
-                markDeleteSymbols(buildfiles[f], allfiles)
-                deletefile(os.path.join(symbolPath,f))
-
-print "[3/4] Deleting symbols..."
-# now delete all files marked for deletion
-for a, refcnt in allfiles.iteritems():
-    if refcnt == 0:
-        deletefile(os.path.join(symbolPath, atoms[a]))
-
-print "[4/4] Pruning empty directories..."
-sys.exit(0)
-# now delete empty directories.
-for root, dirs, files in os.walk(symbolPath, topdown=False):
-    for d in dirs:
-        fullpath = os.path.join(root, d)
-        if len(os.listdir(fullpath)) == 0:
-            if options.dry_run:
-                print "rm -rf ", fullpath
-            else:
-                os.rmdir(fullpath)
+                removeIndex(f)
+
+print "[3/3] Deleting symbols and pruning empty directories..."
+# now delete all files that are no longer referenced
+if options.dry_run:
+    engine.delete(orphans)
+    index.rollback()
+else:
+    # record what needs deleting before forgetting about it, so we can
+    # pick up where we left off if we're interrupted
+    engine.write_journal(orphans)
+    index.commit()
+    engine.resume(index)
+index.close()
 print "Done!"
@@ -3,8 +3,46 @@
 # Post-symbol upload script.
 #
 # This script is run on dm-symbolpush01 after symbols are uploaded
-# from build slaves. Currently it's a no-op, but it will be modified
-# to convert symbols to a different format in the very near future.
+# from build slaves. It adds the symbol indexes that were uploaded to
+# the database of symbol file reference counts used by
+# cleanup-breakpad-symbols.py, so that cleanup doesn't need to read
+# them again.
+#
+# usage: post-symbol-upload.py [--index db] <symbol path> [uploaded files]
+#
+# If no symbol indexes (*-symbols.txt) are among the uploaded files, the
+# whole symbol path is checked for indexes that haven't been added yet.
+
+import os
+import sys
+import sqlite3
+from optparse import OptionParser
+
+from symbolindex import SymbolIndex, is_symbol_index
 
 if __name__ == '__main__':
-    pass
+    parser = OptionParser(usage="usage: %prog [options] <symbol path> [uploaded files]")
+    parser.add_option("--index", dest="index",
+                      help="Database of symbol file reference counts. Defaults to "
+                      ".symbol-refcounts.db in the symbol path")
+    options, args = parser.parse_args()
+
+    if not args:
+        parser.error("Must specify a symbol path!")
+    symbolPath = args[0]
+
+    names = [os.path.basename(f) for f in args[1:] if is_symbol_index(f)]
+    try:
+        index = SymbolIndex(symbolPath, options.index)
+        if names:
+            index.sync(names, remove_missing=False)
+        else:
+            index.sync(remove_missing=False)
+        index.commit()
+        index.close()
+    except sqlite3.OperationalError, e:
+        # Most likely cleanup has been holding on to the database for too
+        # long. It adds any indexes we didn't get to itself, so the upload
+        # is still fine
+        print >>sys.stderr, "Couldn't update symbol index database: %s" % e
+    sys.exit(0)
@@ -0,0 +1,179 @@
+"""Deletes large numbers of files from a symbol store.
+
+Files are grouped by the directory they're in, and each directory is handled
+by one of a pool of threads, so that slow unlinks (e.g. on NFS) overlap.
+Once a directory's files have been removed, it and any parents that are now
+empty are removed as well.
+
+What's being deleted is written to a journal first, and each directory is
+recorded there once it's been finished, so an interrupted run can be picked
+up where it left off by calling resume(). Given the SymbolIndex, resume()
+skips any files that have been referenced again since they were journaled.
+"""
+
+import os
+import sys
+import errno
+import time
+import threading
+import Queue
+
+
+class DeletionEngine(object):
+    """Deletes files under `root` using `threads` threads.
+
+    `journal` is the file to record progress in, or None to not keep one.
+    If `dry_run` is set, files are only printed out.
+    """
+    # How often to report progress, in seconds
+    progress_interval = 30
+
+    def __init__(self, root, journal=None, threads=8, dry_run=False):
+        self.root = root
+        self.journal = journal
+        self.threads = threads
+        self.dry_run = dry_run
+
+        self._lock = threading.Lock()
+        self._journal_fp = None
+        self.reset()
+
+    def reset(self):
+        "Resets our counters"
+        self.total = 0
+        self.deleted = 0
+        self.errors = 0
+        self.dirs_removed = 0
+        self.start_time = time.time()
+        self._last_report = self.start_time
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 0.001)
+        print "%i/%i files deleted (%.0f files/s), %i errors, %i directories removed" % (
+            self.deleted, self.total, self.deleted / elapsed, self.errors,
+            self.dirs_removed)
+        sys.stdout.flush()
+        self._last_report = time.time()
+
+    def resume(self, index=None):
+        """Finishes off anything left in the journal by an interrupted run.
+        Files that `index` (a SymbolIndex) says are referenced are left alone.
+        Returns the number of files that were still to be deleted."""
+        if not self.journal or not os.path.exists(self.journal):
+            return 0
+
+        files = []
+        done = set()
+        for line in open(self.journal):
+            # The last line may have been cut short
+            if not line.endswith("\n") or line[1:2] != " ":
+                continue
+            kind, path = line[0], line[2:-1]
+            if kind == "F":
+                files.append(path)
+            elif kind == "D":
+                done.add(path)
+
+        pending = [f for f in files if os.path.dirname(f) not in done]
+        if index:
+            # New uploads may have started using them again
+            referenced = index.referenced(pending)
+            if referenced:
+                print "Keeping %i files that are in use again" % len(referenced)
+                pending = [f for f in pending if f not in referenced]
+        print "Deleting %i files" % len(pending)
+        self._journal_fp = open(self.journal, "a")
+        self._run(pending)
+        return len(pending)
+
+    def write_journal(self, paths):
+        """Records that `paths` are to be deleted, without deleting them yet.
+        Call resume() to delete them."""
+        fp = open(self.journal, "w")
+        for p in paths:
+            fp.write("F %s\n" % p)
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+
+    def delete(self, paths, index=None):
+        """Deletes `paths`, which are relative to our root, then removes any
+        directories that are left empty. If a journal is being kept, files
+        that `index` says are referenced are left alone."""
+        if self.dry_run:
+            for p in paths:
+                print "rm ", os.path.join(self.root, p)
+        elif self.journal:
+            self.write_journal(paths)
+            self.resume(index)
+        else:
+            self._run(paths)
+
+    def _run(self, paths):
+        self.reset()
+        self.total = len(paths)
+
+        dirs = {}
+        for p in paths:
+            dirs.setdefault(os.path.dirname(p), []).append(p)
+
+        q = Queue.Queue()
+        for item in dirs.iteritems():
+            q.put(item)
+
+        workers = []
+        for i in range(min(self.threads, len(dirs))):
+            t = threading.Thread(target=self._worker, args=(q,))
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+
+        self.report()
+        if self._journal_fp:
+            self._journal_fp.close()
+            self._journal_fp = None
+            os.unlink(self.journal)
+
+    def _worker(self, q):
+        while True:
+            try:
+                d, files = q.get(block=False)
+            except Queue.Empty:
+                return
+
+            deleted = 0
+            errors = 0
+            for f in files:
+                try:
+                    os.unlink(os.path.join(self.root, f))
+                    deleted += 1
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        print >>sys.stderr, "Error removing file: ", f
+                        errors += 1
+            removed = self._prune(d)
+
+            with self._lock:
+                self.deleted += deleted
+                self.errors += errors
+                self.dirs_removed += removed
+                if self._journal_fp:
+                    self._journal_fp.write("D %s\n" % d)
+                    self._journal_fp.flush()
+                if time.time() - self._last_report > self.progress_interval:
+                    self.report()
+
+    def _prune(self, d):
+        """Removes `d` and its parents, up to our root, for as long as they're
+        empty. Returns how many directories were removed."""
+        removed = 0
+        while d:
+            try:
+                os.rmdir(os.path.join(self.root, d))
+            except OSError:
+                # Not empty, or already gone
+                break
+            removed += 1
+            d = os.path.dirname(d)
+        return removed
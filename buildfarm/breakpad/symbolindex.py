@@ -0,0 +1,181 @@
+"""Persistent reference counts for the files in a Breakpad symbol store.
+
+Each build uploads a ${product}-${version}-${OS_ARCH}-${BUILD_ID}-symbols.txt
+index listing the symbol files it uses. Symbol files are shared between
+builds, so a file can only be removed once no index refers to it any more.
+
+SymbolIndex keeps track of which files each index refers to, and how many
+indexes refer to each file, in a SQLite database so that they don't have to
+be read again every time symbols are cleaned up.
+"""
+
+import os
+import sqlite3
+
+DEFAULT_DB_NAME = ".symbol-refcounts.db"
+# How long to wait for another process to finish writing to the database, in
+# seconds
+DEFAULT_TIMEOUT = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    refcount INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS indexes (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS index_files (
+    index_id INTEGER NOT NULL,
+    file_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS index_files_index_id ON index_files (index_id);
+"""
+
+
+def is_symbol_index(name):
+    return name.endswith("-symbols.txt")
+
+
+class SymbolIndex(object):
+    """Reference counts of the files under `symbol_path`, stored in `db`
+    (by default DEFAULT_DB_NAME in `symbol_path`).
+
+    Changes aren't saved until commit() is called. Once something has been
+    changed, other processes can't make changes until then, and wait up to
+    `timeout` seconds for it to happen before sqlite3.OperationalError is
+    raised."""
+
+    def __init__(self, symbol_path, db=None, timeout=DEFAULT_TIMEOUT):
+        self.symbol_path = symbol_path
+        if db is None:
+            db = os.path.join(symbol_path, DEFAULT_DB_NAME)
+        self.db = sqlite3.connect(db, timeout=timeout)
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+    def indexes(self):
+        "Returns a dict of index name to (mtime, size) for all known indexes"
+        return dict((name, (mtime, size)) for name, mtime, size in
+                    self.db.execute("SELECT name, mtime, size FROM indexes"))
+
+    def referenced(self, paths):
+        "Returns the set of `paths` that are referenced by some index"
+        paths = list(paths)
+        found = set()
+        # SQLite limits how many parameters a statement can have
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            found.update(p for (p,) in self.db.execute(
+                "SELECT path FROM files WHERE refcount > 0 AND path IN (%s)" %
+                ", ".join("?" * len(chunk)), chunk))
+        return found
+
+    def add_index(self, name):
+        """Reads symbol index `name` from the symbol store and adds a
+        reference to each of the files it lists. If it's already known it is
+        removed first, and the paths of any files no longer referenced are
+        returned."""
+        fn = os.path.join(self.symbol_path, name)
+        st = os.stat(fn)
+        paths = set()
+        for line in open(fn):
+            line = line.rstrip()
+            if line:
+                paths.add(line)
+
+        orphans = []
+        if self.db.execute("SELECT 1 FROM indexes WHERE name = ?",
+                           (name,)).fetchone():
+            orphans = self.remove_index(name)
+
+        c = self.db.cursor()
+        c.execute("INSERT INTO indexes (name, mtime, size) VALUES (?, ?, ?)",
+                  (name, st.st_mtime, st.st_size))
+        index_id = c.lastrowid
+        params = [(p,) for p in paths]
+        c.executemany("INSERT OR IGNORE INTO files (path, refcount) VALUES (?, 0)",
+                      params)
+        c.executemany("UPDATE files SET refcount = refcount + 1 WHERE path = ?",
+                      params)
+        c.executemany("INSERT INTO index_files (index_id, file_id) "
+                      "SELECT ?, id FROM files WHERE path = ?",
+                      [(index_id, p) for p in paths])
+        return [p for p in orphans if p not in paths]
+
+    def remove_index(self, name):
+        """Removes symbol index `name`, dropping a reference to each of the
+        files it lists. Returns the paths of the files that are no longer
+        referenced by any index, which are forgotten about."""
+        row = self.db.execute("SELECT id FROM indexes WHERE name = ?",
+                              (name,)).fetchone()
+        if not row:
+            return []
+        index_id = row[0]
+
+        c = self.db.cursor()
+        c.execute("UPDATE files SET refcount = refcount - 1 WHERE id IN "
+                  "(SELECT file_id FROM index_files WHERE index_id = ?)",
+                  (index_id,))
+        orphans = [path for (path,) in c.execute(
+            "SELECT path FROM files WHERE refcount <= 0 AND id IN "
+            "(SELECT file_id FROM index_files WHERE index_id = ?)",
+            (index_id,))]
+        c.execute("DELETE FROM files WHERE refcount <= 0 AND id IN "
+                  "(SELECT file_id FROM index_files WHERE index_id = ?)",
+                  (index_id,))
+        c.execute("DELETE FROM index_files WHERE index_id = ?", (index_id,))
+        c.execute("DELETE FROM indexes WHERE id = ?", (index_id,))
+        return orphans
+
+    def sync(self, names=None, remove_missing=True):
+        """Brings the database up to date with the symbol indexes on disk.
+
+        Only indexes that are new, or whose mtime or size have changed, are
+        read. If `names` is given only those indexes are checked, otherwise
+        the whole symbol store is listed. If `remove_missing` is set, indexes
+        that no longer exist are removed.
+
+        Returns the paths of files that are no longer referenced."""
+        known = self.indexes()
+        if names is None:
+            names = [n for n in os.listdir(self.symbol_path)
+                     if is_symbol_index(n)]
+            missing = set(known) - set(names)
+        else:
+            missing = set()
+
+        orphans = []
+        for name in names:
+            fn = os.path.join(self.symbol_path, name)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                missing.add(name)
+                continue
+            if known.get(name) != (st.st_mtime, st.st_size):
+                try:
+                    orphans.extend(self.add_index(name))
+                except IOError:
+                    # We'll try again next time
+                    pass
+
+        if remove_missing:
+            for name in missing:
+                if name in known:
+                    orphans.extend(self.remove_index(name))
+        return orphans
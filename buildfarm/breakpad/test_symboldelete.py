@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from symboldelete import DeletionEngine
+from symbolindex import SymbolIndex
+
+
+class TestDeletionEngine(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, "symbols")
+        self.journal = os.path.join(self.tmpdir, "journal")
+        os.makedirs(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeFiles(self, paths):
+        for p in paths:
+            fn = os.path.join(self.root, p)
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            open(fn, "w").write("x")
+
+    def listFiles(self):
+        result = []
+        for root, dirs, files in os.walk(self.root):
+            rel = root[len(self.root) + 1:]
+            result.extend(os.path.join(rel, f) for f in files)
+            if not dirs and not files and rel:
+                result.append(rel + "/")
+        return sorted(result)
+
+    def testDeletePrunes(self):
+        self.makeFiles(["a/1/a.sym", "a/1/b.sym", "a/2/a.sym",
+                        "b/1/b.sym", "c.txt"])
+        engine = DeletionEngine(self.root, threads=2)
+        engine.delete(["a/1/a.sym", "a/1/b.sym", "b/1/b.sym", "missing/x"])
+        # Directories are removed from the bottom up for as long as they're
+        # empty, but never the root
+        self.assertEquals(self.listFiles(), ["a/2/a.sym", "c.txt"])
+        self.assertEquals(engine.deleted, 3)
+        self.assertEquals(engine.errors, 0)
+        self.assertEquals(engine.dirs_removed, 3)
+        engine.delete(["a/2/a.sym", "c.txt"])
+        self.assertEquals(self.listFiles(), [])
+        self.assertTrue(os.path.isdir(self.root))
+
+    def testDryRun(self):
+        self.makeFiles(["a/1/a.sym"])
+        engine = DeletionEngine(self.root, self.journal, dry_run=True)
+        engine.delete(["a/1/a.sym"])
+        self.assertEquals(self.listFiles(), ["a/1/a.sym"])
+        self.assertFalse(os.path.exists(self.journal))
+
+    def testJournal(self):
+        self.makeFiles(["a/1/a.sym", "b/1/b.sym"])
+        engine = DeletionEngine(self.root, self.journal)
+        engine.delete(["a/1/a.sym", "b/1/b.sym"])
+        self.assertEquals(self.listFiles(), [])
+        # The journal is removed once everything is done
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEquals(engine.resume(), 0)
+
+    def testResume(self):
+        self.makeFiles(["a/1/a.sym", "b/1/b.sym", "c/1/c.sym"])
+        engine = DeletionEngine(self.root, self.journal)
+        engine.write_journal(["a/1/a.sym", "b/1/b.sym", "c/1/c.sym"])
+        # An interrupted run finished a/1, and was cut off writing c/1
+        open(self.journal, "a").write("D a/1\nD c/")
+        self.assertEquals(self.listFiles(),
+                          ["a/1/a.sym", "b/1/b.sym", "c/1/c.sym"])
+        self.assertEquals(engine.resume(), 2)
+        self.assertEquals(self.listFiles(), ["a/1/a.sym"])
+        self.assertFalse(os.path.exists(self.journal))
+
+    def testResumeKeepsReferencedFiles(self):
+        self.makeFiles(["a/1/a.sym", "a/1/b.sym", "b/1/b.sym"])
+        engine = DeletionEngine(self.root, self.journal)
+        engine.write_journal(["a/1/a.sym", "a/1/b.sym", "b/1/b.sym"])
+        # A new upload uses one of the journaled files
+        open(os.path.join(self.root, "new-symbols.txt"), "w").write(
+            "a/1/b.sym\n")
+        index = SymbolIndex(self.root, os.path.join(self.tmpdir, "db"))
+        index.sync()
+        index.commit()
+        try:
+            self.assertEquals(engine.resume(index), 2)
+        finally:
+            index.close()
+        self.assertEquals(self.listFiles(), ["a/1/b.sym", "new-symbols.txt"])
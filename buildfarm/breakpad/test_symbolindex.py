@@ -0,0 +1,118 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from symbolindex import SymbolIndex
+
+
+class TestSymbolIndex(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = SymbolIndex(self.tmpdir)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def writeIndex(self, name, paths):
+        fn = os.path.join(self.tmpdir, name)
+        open(fn, "w").write("".join("%s\n" % p for p in paths))
+        # Make sure the size or mtime changes
+        st = os.stat(fn)
+        os.utime(fn, (st.st_atime, st.st_mtime + 1))
+
+    def refcounts(self):
+        return dict(self.index.db.execute("SELECT path, refcount FROM files"))
+
+    def testAddRemove(self):
+        self.writeIndex("a-symbols.txt", ["x", "y"])
+        self.writeIndex("b-symbols.txt", ["y", "z"])
+        self.assertEquals(self.index.add_index("a-symbols.txt"), [])
+        self.assertEquals(self.index.add_index("b-symbols.txt"), [])
+        self.assertEquals(self.refcounts(), {"x": 1, "y": 2, "z": 1})
+
+        self.assertEquals(self.index.remove_index("a-symbols.txt"), ["x"])
+        self.assertEquals(self.refcounts(), {"y": 1, "z": 1})
+        self.assertEquals(sorted(self.index.remove_index("b-symbols.txt")),
+                          ["y", "z"])
+        self.assertEquals(self.refcounts(), {})
+        self.assertEquals(self.index.indexes(), {})
+        self.assertEquals(self.index.remove_index("b-symbols.txt"), [])
+
+    def testReAdd(self):
+        self.writeIndex("a-symbols.txt", ["x", "y"])
+        self.index.add_index("a-symbols.txt")
+        self.writeIndex("a-symbols.txt", ["y", "z"])
+        self.assertEquals(self.index.add_index("a-symbols.txt"), ["x"])
+        self.assertEquals(self.refcounts(), {"y": 1, "z": 1})
+
+    def testDuplicateLines(self):
+        self.writeIndex("a-symbols.txt", ["x", "x", ""])
+        self.index.add_index("a-symbols.txt")
+        self.assertEquals(self.refcounts(), {"x": 1})
+
+    def testSync(self):
+        self.writeIndex("a-symbols.txt", ["x", "y"])
+        self.writeIndex("b-symbols.txt", ["y"])
+        open(os.path.join(self.tmpdir, "other.txt"), "w").write("z\n")
+        self.assertEquals(self.index.sync(), [])
+        self.assertEquals(sorted(self.index.indexes()),
+                          ["a-symbols.txt", "b-symbols.txt"])
+        self.assertEquals(self.refcounts(), {"x": 1, "y": 2})
+
+        # Unchanged indexes aren't read again
+        self.index.db.execute("UPDATE files SET refcount = 5 WHERE path = 'x'")
+        self.assertEquals(self.index.sync(), [])
+        self.assertEquals(self.refcounts()["x"], 5)
+        self.index.db.execute("UPDATE files SET refcount = 1 WHERE path = 'x'")
+
+        # Changed and missing ones are
+        self.writeIndex("b-symbols.txt", ["z"])
+        os.unlink(os.path.join(self.tmpdir, "a-symbols.txt"))
+        self.assertEquals(sorted(self.index.sync()), ["x", "y"])
+        self.assertEquals(self.refcounts(), {"z": 1})
+
+    def testSyncNames(self):
+        self.writeIndex("a-symbols.txt", ["x"])
+        self.writeIndex("b-symbols.txt", ["y"])
+        self.index.sync(["a-symbols.txt"], remove_missing=False)
+        self.assertEquals(self.refcounts(), {"x": 1})
+        # Indexes that don't exist yet aren't removed
+        os.unlink(os.path.join(self.tmpdir, "a-symbols.txt"))
+        self.assertEquals(
+            self.index.sync(["a-symbols.txt"], remove_missing=False), [])
+        self.assertEquals(self.refcounts(), {"x": 1})
+        self.assertEquals(self.index.sync(remove_missing=False), [])
+        self.assertEquals(self.refcounts(), {"x": 1, "y": 1})
+
+    def testReferenced(self):
+        self.writeIndex("a-symbols.txt", ["f%i" % i for i in range(1200)])
+        self.index.sync()
+        self.assertEquals(
+            self.index.referenced(["f0", "f1199", "nope"]), set(["f0", "f1199"]))
+        self.assertEquals(
+            len(self.index.referenced(["f%i" % i for i in range(1300)])), 1200)
+
+    def testCommitRollback(self):
+        self.writeIndex("a-symbols.txt", ["x"])
+        self.index.sync()
+        self.index.rollback()
+        self.assertEquals(self.index.indexes(), {})
+        self.index.sync()
+        self.index.commit()
+        self.index.close()
+        self.index = SymbolIndex(self.tmpdir)
+        self.assertEquals(self.refcounts(), {"x": 1})
+
+    def testLocked(self):
+        self.writeIndex("a-symbols.txt", ["x"])
+        self.writeIndex("b-symbols.txt", ["y"])
+        self.index.sync(["a-symbols.txt"])
+        other = SymbolIndex(self.tmpdir, timeout=0.1)
+        try:
+            self.assertRaises(sqlite3.OperationalError, other.sync,
+                              ["b-symbols.txt"])
+        finally:
+            other.close()
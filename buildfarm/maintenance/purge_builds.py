@@ -22,9 +22,20 @@ example:
 import os
 import shutil
 import sys
+import time
+import json
+import tempfile
 from fnmatch import fnmatch
 import re
 
+# Use the shared tree removal code if we're running from a tools checkout;
+# this script is also deployed on its own
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../lib/python"))
+try:
+    from util.rmtree import rmtree
+except ImportError:
+    rmtree = None
+
 DEFAULT_BASE_DIRS = [".."]
 
 clobber_suffix = '.deleteme'
@@ -78,11 +89,17 @@ def rmdirRecursiveWindows(dir):
 def rmdirRecursive(dir):
     """This is a replacement for shutil.rmtree that works better under
     windows. Thanks to Bear at the OSAF for the code.
-    (Borrowed from buildbot.slave.commands)"""
+    (Borrowed from buildbot.slave.commands)
+
+    If util.rmtree is available, it is used instead, except on Windows."""
     if os.name == 'nt':
         rmdirRecursiveWindows(dir)
         return
 
+    if rmtree:
+        rmtree(dir)
+        return
+
     if not os.path.exists(dir):
         # This handles broken links
         if os.path.islink(dir):
@@ -117,6 +134,236 @@ def rmdirRecursive(dir):
     os.rmdir(dir)
 
 
+def disk_usage(p):
+    "Returns the number of bytes used by the files under directory `p`"
+    total = 0
+    for root, dirs, files in os.walk(p):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            blocks = getattr(st, 'st_blocks', None)
+            if blocks is not None:
+                total += blocks * 512
+            else:
+                total += st.st_size
+    return total
+
+
+def dir_stamp(p):
+    """Returns the latest mtime of `p` and its immediate children. This
+    changes whenever anything is added, removed or replaced at the top of a
+    build directory, and is much cheaper to check than the directory's
+    size."""
+    stamp = os.lstat(p).st_mtime
+    for name in os.listdir(p):
+        try:
+            stamp = max(stamp, os.lstat(os.path.join(p, name)).st_mtime)
+        except OSError:
+            pass
+    return stamp
+
+
+class DiskUsageIndex(object):
+    """Remembers the disk usage of directories between runs, so we don't
+    have to walk each one every time we need to know how much space deleting
+    it will free.
+
+    Sizes are recalculated when dir_stamp() of the directory changes, or
+    when they're more than `max_age` seconds old.
+
+    The index also remembers where the hg repositories under each share
+    directory are, along with the mtime of every directory that had to be
+    walked to find them. As long as those haven't changed, no repositories
+    have been added or removed.
+
+    If `filename` is None, nothing is saved between runs.
+    """
+    max_age = 24 * 3600
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # Mapping of absolute path to [stamp, size, time size was calculated]
+        self.dirs = {}
+        # Mapping of share dir to {'walked': {path: mtime}, 'hg_dirs': [...]}
+        self.shares = {}
+        self.load()
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            data = json.load(open(self.filename))
+            self.dirs = data['dirs']
+            self.shares = data['shares']
+        except (IOError, ValueError, KeyError, TypeError):
+            print >>sys.stderr, "Couldn't load index %s; ignoring it" % self.filename
+            self.dirs = {}
+            self.shares = {}
+
+    def save(self):
+        if not self.filename:
+            return
+        # Forget about directories that have gone away
+        for p in self.dirs.keys():
+            if not os.path.exists(p):
+                del self.dirs[p]
+        data = {'dirs': self.dirs, 'shares': self.shares}
+        fd, tmpname = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.filename)))
+        fp = os.fdopen(fd, 'w')
+        json.dump(data, fp)
+        fp.close()
+        if sys.platform == 'win32' and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmpname, self.filename)
+
+    def size(self, d, compute=True):
+        """Returns the number of bytes used under `d`. If `compute` is False,
+        0 is returned if we don't have an up to date size for it."""
+        key = os.path.abspath(d)
+        try:
+            stamp = dir_stamp(d)
+        except OSError:
+            return 0
+        now = time.time()
+        entry = self.dirs.get(key)
+        if entry and entry[0] == stamp and now - entry[2] < self.max_age:
+            return entry[1]
+        if not compute:
+            return 0
+        size = disk_usage(d)
+        self.dirs[key] = [stamp, size, now]
+        return size
+
+    def forget(self, d):
+        self.dirs.pop(os.path.abspath(d), None)
+
+    def hg_dirs(self, share_dir):
+        "Returns a list of the hg repositories under `share_dir`"
+        key = os.path.abspath(share_dir)
+        cached = self.shares.get(key)
+        if cached:
+            for p, mtime in cached['walked'].iteritems():
+                try:
+                    if os.path.getmtime(p) != mtime:
+                        break
+                except OSError:
+                    break
+            else:
+                return cached['hg_dirs']
+
+        hg_dirs = []
+        walked = {}
+        for root, dirs, files in os.walk(share_dir):
+            walked[os.path.abspath(root)] = os.path.getmtime(root)
+            for d in dirs[:]:
+                path = os.path.join(root, d, '.hg')
+                if os.path.exists(path) or os.path.exists(path + clobber_suffix):
+                    hg_dirs.append(os.path.join(root, d))
+                    # Remove d from the list so we don't go traversing down into it
+                    dirs.remove(d)
+        self.shares[key] = {'walked': walked, 'hg_dirs': hg_dirs}
+        return hg_dirs
+
+
+class BackgroundDeleter(object):
+    """Deletes directories in a detached process, so that whatever needed
+    the space can get started while they're being removed.
+
+    The pid of the process doing the deleting is written to `pidfile`, so
+    later runs can avoid deleting the same directories at the same time.
+    Where we can't fork, directories are deleted in the foreground by
+    start().
+    """
+    def __init__(self, pidfile):
+        self.pidfile = pidfile
+        self.paths = []
+        # How many bytes will be freed once we're done
+        self.pending = 0
+
+    def running(self):
+        "Returns True if a previous run's deleter is still going"
+        try:
+            pid = int(open(self.pidfile).read())
+        except (IOError, ValueError):
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def add(self, path, size):
+        self.paths.append(path)
+        self.pending += size
+
+    def _delete(self):
+        for p in self.paths:
+            try:
+                rmdirRecursive(p)
+            except:
+                print >>sys.stderr, "Couldn't purge %s properly. Skipping." % p
+
+    def start(self):
+        if not self.paths:
+            return
+        if not hasattr(os, 'fork'):
+            self._delete()
+            return
+
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+
+        # Detach from our parent's session, and fork again so we're not left
+        # as a zombie
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            # Don't hold on to our parent's output; buildbot waits for it to
+            # be closed
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            open(self.pidfile, 'w').write(str(os.getpid()))
+            self._delete()
+            os.remove(self.pidfile)
+        finally:
+            os._exit(0)
+
+
+def delete_dir(d, dry_run=False, index=None, deleter=None):
+    """Delete directory `d`. If `deleter` is set, `d` is moved out of the way
+    and its deletion is left to `deleter`."""
+    print "Deleting", d
+    if dry_run:
+        return
+    try:
+        size = 0
+        if deleter and index:
+            size = index.size(d, compute=False)
+        clobber_path = d + clobber_suffix
+        if os.path.exists(clobber_path):
+            rmdirRecursive(clobber_path)
+        # Prevent repeated moving.
+        if d.endswith(clobber_suffix):
+            clobber_path = d
+        else:
+            shutil.move(d, clobber_path)
+        if deleter:
+            deleter.add(clobber_path, size)
+        else:
+            rmdirRecursive(clobber_path)
+        if index:
+            index.forget(d)
+    except:
+        print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
+
+
 def str2seconds(s):
     """ Accepts time intervals resembling:
          30d  (30 days)
@@ -133,7 +380,8 @@ def str2seconds(s):
         raise ValueError("Unhandled time format '%s'" % s)
 
 
-def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
+def purge(base_dirs, gigs, ignore, max_age, dry_run=False, index=None,
+          deleter=None):
     """Delete directories under `base_dirs` until `gigs` GB are free.
 
     Delete any directories older than max_age.
@@ -144,14 +392,25 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
       rel-*:40d
 
     Will not delete rel-* directories until they are over 40 days old.
+
+    The sizes of directories are looked up in `index` (a DiskUsageIndex), and
+    the oldest directories that together free up enough space are deleted.
+    If `deleter` (a BackgroundDeleter) is set, directories are only moved out
+    of the way here, and the space they use is counted as free.
     """
     gigs *= 1024 * 1024 * 1024
 
+    if index is None:
+        index = DiskUsageIndex()
+
     # convert 'ignore' to a dict resembling { directory: cutoff_time }
     # where a cutoff time of -1 means 'never expire'.
     ignore = dict(map(lambda x: x.split(':')[0:2] if len(x.split(':')) > 1 else [x, -1], ignore))
     ignore = dict(map(lambda key: [key, time.time() - str2seconds(ignore[key])] if ignore[key] != -1 else [key, ignore[key]], ignore))
 
+    # A previous run is still deleting these
+    skip_deleteme = deleter and deleter.running()
+
     dirs = []
     for base_dir in base_dirs:
         if os.path.exists(base_dir):
@@ -159,6 +418,8 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
                 p = os.path.join(base_dir, d)
                 if not os.path.isdir(p):
                     continue
+                if skip_deleteme and d.endswith(clobber_suffix):
+                    continue
                 mtime = os.path.getmtime(p)
                 skip = False
                 for pattern, cutoff_time in ignore.iteritems():
@@ -173,56 +434,89 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
                 dirs.append((mtime, p))
 
     dirs.sort()
+    if not dirs:
+        return
 
-    while dirs:
+    # Space is measured on the first base dir that exists; if there were no
+    # such directories, dirs would be empty
+    space_dir = [b for b in base_dirs if os.path.exists(b)][0]
+    free = freespace(space_dir)
+    if deleter:
+        free += deleter.pending
+    base_dev = os.stat(space_dir).st_dev
+
+    def reclaimable(d):
+        "How much space deleting d will free up on space_dir"
+        if os.lstat(d).st_dev != base_dev:
+            return 0
+        return index.size(d)
+
+    # Directories older than max_age are deleted regardless of how much space
+    # we need
+    to_delete = []
+    reclaimed = 0
+    while dirs and max_age and dirs[0][0] <= max_age:
         mtime, d = dirs.pop(0)
+        to_delete.append(d)
+        if free + reclaimed < gigs:
+            reclaimed += reclaimable(d)
 
-        # If we're newer than max_age, and don't need any more free space,
-        # we're all done here
-        if (not max_age) or (mtime > max_age):
-            if freespace(base_dirs[0]) >= gigs:
-                break
+    # Then the oldest directories until we've got enough space
+    extra = []
+    while dirs and free + reclaimed < gigs:
+        mtime, d = dirs.pop(0)
+        size = reclaimable(d)
+        extra.append((mtime, d, size))
+        reclaimed += size
+
+    # Keep any of those that we turned out not to need, e.g. small old
+    # directories followed by a big one, newest first
+    for mtime, d, size in reversed(extra[:-1]):
+        if free + reclaimed - size >= gigs:
+            extra.remove((mtime, d, size))
+            reclaimed -= size
+            dirs.append((mtime, d))
+    dirs.sort()
 
-        print "Deleting", d
-        if not dry_run:
-            try:
-                clobber_path = d + clobber_suffix
-                if os.path.exists(clobber_path):
-                    rmdirRecursive(clobber_path)
-                # Prevent repeated moving.
-                if d.endswith(clobber_suffix):
-                    rmdirRecursive(d)
-                else:
-                    shutil.move(d, clobber_path)
-                    rmdirRecursive(clobber_path)
-            except:
-                print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
+    for d in to_delete + [d for mtime, d, size in extra]:
+        delete_dir(d, dry_run, index, deleter)
+
+    if dry_run or deleter:
+        return
+
+    # Our sizes were only estimates, so keep going if we still don't have
+    # enough space
+    while dirs and freespace(space_dir) < gigs:
+        mtime, d = dirs.pop(0)
+        delete_dir(d, dry_run, index, deleter)
 
 
-def purge_hg_shares(share_dir, gigs, max_age, dry_run=False):
+def purge_hg_shares(share_dir, gigs, max_age, dry_run=False, index=None,
+                    deleter=None):
     """Deletes old hg directories under share_dir"""
+    if index is None:
+        index = DiskUsageIndex()
+
     # Find hg directories
-    hg_dirs = []
-    for root, dirs, files in os.walk(share_dir):
-        for d in dirs[:]:
-            path = os.path.join(root, d, '.hg')
-            if os.path.exists(path) or os.path.exists(path + clobber_suffix):
-                hg_dirs.append(os.path.join(root, d))
-                # Remove d from the list so we don't go traversing down into it
-                dirs.remove(d)
+    hg_dirs = index.hg_dirs(share_dir)
 
     # Now we have a list of hg directories, call purge on them
-    purge(hg_dirs, gigs, [], max_age, dry_run)
+    purge(hg_dirs, gigs, [], max_age, dry_run, index, deleter)
 
     # Clean up empty directories
     for d in hg_dirs:
-        if not os.path.exists(os.path.join(d, '.hg')):
+        if os.path.exists(d) and not os.path.exists(os.path.join(d, '.hg')):
             print "Cleaning up", d
-            if not dry_run:
+            if dry_run:
+                continue
+            if deleter:
+                # The .hg directory may still be in the deleter's list, so
+                # leave the rest to it as well
+                deleter.add(d, 0)
+            else:
                 rmdirRecursive(d)
 
 if __name__ == '__main__':
-    import time
     from optparse import OptionParser
     from ConfigParser import ConfigParser, NoOptionError
 
@@ -236,7 +530,9 @@ if __name__ == '__main__':
 
     cwd = os.path.basename(os.getcwd())
     parser = OptionParser(usage=__doc__)
-    parser.set_defaults(size=5, share_size=1, skip=[cwd], dry_run=False, max_age=max_age)
+    parser.set_defaults(size=5, share_size=1, skip=[cwd], dry_run=False, max_age=max_age,
+                        index=os.path.expanduser('~/.purge_builds_index.json'),
+                        background=False)
 
     parser.add_option('-s', '--size',
                       help='free space required (in GB, default 5)', dest='size',
@@ -252,15 +548,25 @@ if __name__ == '__main__':
     parser.add_option('', '--dry-run', action='store_true',
                       dest='dry_run',
                       help='''do not delete anything, just print out what would be
-deleted.  note that since no directories are deleted, if the amount of free
-disk space in base_dir(s) is less than the required size, then ALL directories
-will be listed in the order in which they would be deleted.''')
+deleted.  the directories listed are chosen based on the directory sizes in
+the index, so they may not be exactly what would be deleted.''')
 
     parser.add_option('', '--max-age', dest='max_age', type='int',
                       help='''maximum age (in days) for directories.  If any directory
             has an mtime older than this, it will be deleted, regardless of how
             much free space is required.  Set to 0 to disable.''')
 
+    parser.add_option('', '--index', dest='index',
+                      help='''file to keep directory sizes in between runs
+            (default ~/.purge_builds_index.json). Set to an empty string to
+            disable.''')
+
+    parser.add_option('', '--background', action='store_true',
+                      dest='background',
+                      help='''delete directories in a background process once
+            they've been moved out of the way. the space they use is counted
+            as free.''')
+
     options, base_dirs = parser.parse_args()
 
     if len(base_dirs) < 1:
@@ -277,13 +583,21 @@ will be listed in the order in which they would be deleted.''')
     else:
         cutoff_time = None
 
-    purge(base_dirs, options.size, options.skip, cutoff_time, options.dry_run)
+    index = DiskUsageIndex(options.index or None)
+    deleter = None
+    if options.background and not options.dry_run:
+        deleter = BackgroundDeleter(
+            os.path.expanduser('~/.purge_builds_deleter.pid'))
+
+    purge(base_dirs, options.size, options.skip, cutoff_time, options.dry_run,
+          index, deleter)
 
     # Try to cleanup shared hg repos. We run here even if we've freed enough
     # space so we can be sure and delete repositories older than max_age
     if 'HG_SHARE_BASE_DIR' in os.environ:
         purge_hg_shares(os.environ['HG_SHARE_BASE_DIR'],
-                        options.share_size, cutoff_time, options.dry_run)
+                        options.share_size, cutoff_time, options.dry_run,
+                        index, deleter)
 
     # tooltool cache cleanup
     if 'TOOLTOOL_HOME' in os.environ and 'TOOLTOOL_CACHE' in os.environ:
@@ -294,14 +608,25 @@ will be listed in the order in which they would be deleted.''')
         except:
             print "Warning: impossible to cleanup tooltool cache"
 
-    after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
+    def get_free():
+        free = freespace(base_dirs[0])
+        if deleter:
+            free += deleter.pending
+        return free / (1024 * 1024 * 1024.0)
+
+    after = get_free()
 
     # Try to cleanup the current dir if we still need space and it will
     # actually help.
     if after < options.size:
         # We skip the tools dir here because we've usually just cloned it.
-        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run)
-        after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
+        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run,
+              index, deleter)
+        after = get_free()
+
+    index.save()
+    if deleter:
+        deleter.start()
 
     if after < options.size:
         print "Error: unable to free %1.2f GB of space. " % options.size + \
@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from purge_builds import DiskUsageIndex, BackgroundDeleter, purge, \
+    purge_hg_shares
+
+
+def write_file(path, size):
+    d = os.path.dirname(path)
+    if not os.path.exists(d):
+        os.makedirs(d)
+    open(path, 'w').write('x' * size)
+
+
+class TestDiskUsageIndex(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.build_dir = os.path.join(self.tmpdir, 'build')
+        write_file(os.path.join(self.build_dir, 'a', 'file'), 1024 * 1024)
+        self.index_file = os.path.join(self.tmpdir, 'index.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testSize(self):
+        index = DiskUsageIndex()
+        self.assertEquals(index.size(self.build_dir, compute=False), 0)
+        size = index.size(self.build_dir)
+        self.assertTrue(size >= 1024 * 1024)
+        self.assertEquals(index.size(self.build_dir, compute=False), size)
+
+    def testSizeChanged(self):
+        index = DiskUsageIndex()
+        index.size(self.build_dir)
+        # Make sure the stamp changes
+        time.sleep(0.01)
+        write_file(os.path.join(self.build_dir, 'b'), 1024)
+        self.assertEquals(index.size(self.build_dir, compute=False), 0)
+
+    def testSizeMissing(self):
+        index = DiskUsageIndex()
+        self.assertEquals(index.size(os.path.join(self.tmpdir, 'nope')), 0)
+
+    def testSaveLoad(self):
+        index = DiskUsageIndex(self.index_file)
+        size = index.size(self.build_dir)
+        index.save()
+        index = DiskUsageIndex(self.index_file)
+        self.assertEquals(index.size(self.build_dir, compute=False), size)
+
+    def testLoadBadIndex(self):
+        open(self.index_file, 'w').write('garbage')
+        index = DiskUsageIndex(self.index_file)
+        self.assertEquals(index.dirs, {})
+
+    def testForget(self):
+        index = DiskUsageIndex()
+        index.size(self.build_dir)
+        index.forget(self.build_dir)
+        self.assertEquals(index.size(self.build_dir, compute=False), 0)
+
+    def testHgDirs(self):
+        share_dir = os.path.join(self.tmpdir, 'shares')
+        os.makedirs(os.path.join(share_dir, 'mozilla-central', '.hg'))
+        os.makedirs(os.path.join(share_dir, 'releases', 'mozilla-beta', '.hg'))
+        index = DiskUsageIndex()
+        expected = sorted([os.path.join(share_dir, 'mozilla-central'),
+                           os.path.join(share_dir, 'releases', 'mozilla-beta')])
+        self.assertEquals(sorted(index.hg_dirs(share_dir)), expected)
+        # A new repository is noticed
+        time.sleep(0.01)
+        os.makedirs(os.path.join(share_dir, 'releases', 'mozilla-aurora', '.hg'))
+        self.assertEquals(
+            sorted(index.hg_dirs(share_dir)),
+            sorted(expected + [os.path.join(share_dir, 'releases', 'mozilla-aurora')]))
+
+
+class TestBackgroundDeleter(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pidfile = os.path.join(self.tmpdir, 'deleter.pid')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testNotRunning(self):
+        self.assertFalse(BackgroundDeleter(self.pidfile).running())
+        open(self.pidfile, 'w').write('garbage')
+        self.assertFalse(BackgroundDeleter(self.pidfile).running())
+
+    def testRunning(self):
+        open(self.pidfile, 'w').write(str(os.getpid()))
+        self.assertTrue(BackgroundDeleter(self.pidfile).running())
+
+    def testAdd(self):
+        deleter = BackgroundDeleter(self.pidfile)
+        deleter.add('a', 10)
+        deleter.add('b', 20)
+        self.assertEquals(deleter.paths, ['a', 'b'])
+        self.assertEquals(deleter.pending, 30)
+
+    def testStart(self):
+        d = os.path.join(self.tmpdir, 'build.deleteme')
+        write_file(os.path.join(d, 'file'), 10)
+        deleter = BackgroundDeleter(self.pidfile)
+        deleter.add(d, 10)
+        deleter.start()
+        for i in range(100):
+            if not os.path.exists(d):
+                break
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(d))
+
+
+class TestPurge(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testMissingFirstBaseDir(self):
+        base_dir = os.path.join(self.tmpdir, 'base')
+        write_file(os.path.join(base_dir, 'old', 'file'), 10)
+        old = time.time() - 3600
+        os.utime(os.path.join(base_dir, 'old'), (old, old))
+        purge([os.path.join(self.tmpdir, 'missing'), base_dir], 0, [],
+              time.time() - 60)
+        self.assertFalse(os.path.exists(os.path.join(base_dir, 'old')))
+
+    def testNoBaseDirs(self):
+        purge([os.path.join(self.tmpdir, 'missing')], 1, [], None)
+        purge([], 1, [], None)
+
+    def testEmptyShareDir(self):
+        share_dir = os.path.join(self.tmpdir, 'shares')
+        os.makedirs(share_dir)
+        purge_hg_shares(share_dir, 1, None)
+
+    def testShareDirDeleter(self):
+        share_dir = os.path.join(self.tmpdir, 'shares')
+        repo = os.path.join(share_dir, 'mozilla-central')
+        write_file(os.path.join(repo, '.hg', 'file'), 10)
+        old = time.time() - 3600
+        os.utime(os.path.join(repo, '.hg'), (old, old))
+        deleter = BackgroundDeleter(os.path.join(self.tmpdir, 'deleter.pid'))
+        purge_hg_shares(share_dir, 0, time.time() - 60, deleter=deleter)
+        self.assertFalse(os.path.exists(os.path.join(repo, '.hg')))
+        self.assertEquals(sorted(deleter.paths),
+                          sorted([os.path.join(repo, '.hg.deleteme'), repo]))
@@ -13,8 +13,12 @@ Utility for managing mar files"""
 import struct
 import os
 import bz2
+import errno
 import hashlib
+import mmap
+import shutil
 import tempfile
+import multiprocessing
 from subprocess import Popen, PIPE
 
 
@@ -47,6 +51,61 @@ def unpackint(s):
     return struct.unpack(">L", s)[0]
 
 
+def makedirs(dirname):
+    """Like os.makedirs, but doesn't fail if `dirname` already exists"""
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+# Opened by _init_worker in each process of the pool used by
+# MarFile.extractall
+_worker_mar = None
+
+
+def _init_worker(mar_class, name):
+    global _worker_mar
+    _worker_mar = mar_class(name)
+
+
+def _extract_worker(args):
+    """Extract member number `i` of _worker_mar into `path`"""
+    i, path = args
+    _worker_mar.extract(_worker_mar.members[i], path)
+    return i
+
+
+def bz2_compress(f, tmpdir):
+    """Compress the contents of file object `f` into a new file in `tmpdir`.
+    Returns the new file's name and size."""
+    comp = bz2.BZ2Compressor(9)
+    fd, tmpname = tempfile.mkstemp(dir=tmpdir)
+    output = os.fdopen(fd, 'wb')
+    size = 0
+    while True:
+        block = f.read(512 * 1024)
+        if not block:
+            break
+        block = comp.compress(block)
+        size += len(block)
+        output.write(block)
+    block = comp.flush()
+    size += len(block)
+    output.write(block)
+    output.close()
+    return tmpname, size
+
+
+def _compress_worker(path, tmpdir):
+    f = open(path, 'rb')
+    try:
+        return bz2_compress(f, tmpdir)
+    finally:
+        f.close()
+
+
 def generate_signature(fp, updatefunc):
     fp.seek(0)
     # Magic
@@ -187,10 +246,18 @@ class MarFile:
     `name`:     filename of MAR file
     `mode`:     either 'r' or 'w', depending on if you're reading or writing.
                 defaults to 'r'
+
+    When reading, the file is memory mapped so that members can be read
+    directly without seeking around the file.
     """
 
     _longint_fmt = ">L"
 
+    # How much of a member to read or write at once
+    _blocksize = 512 * 1024
+
+    _mmap = None
+
     def __init__(self, name, mode="r", signature_versions=[]):
         if mode not in "rw":
             raise ValueError("Mode must be either 'r' or 'w'")
@@ -217,13 +284,15 @@ class MarFile:
         self.signature_versions = signature_versions
 
         if mode == "r":
+            if os.fstat(self.fileobj.fileno()).st_size:
+                self._mmap = mmap.mmap(self.fileobj.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
             # Read the file's index
             self._read_index()
         elif mode == "w":
-            # Create placeholder signatures
-            if signature_versions:
-                # Space for num_signatures and file size
-                self.index_offset += 4 + 8
+            # Space for num_signatures and file size, which are always
+            # written
+            self.index_offset += 4 + 8
 
             # Write the magic and placeholder for the index
             self.fileobj.write("MAR1" + packint(self.index_offset))
@@ -368,15 +437,20 @@ class MarFile:
         """Close the MAR file, writing out the new index if required.
 
         Furthur modifications to the file are not allowed."""
+        if self._mmap:
+            self._mmap.close()
+            self._mmap = None
+
         if self.mode == "w" and self.rewrite_index:
             self._write_index()
 
-        # Update file size
-        self.fileobj.seek(0, 2)
-        totalsize = self.fileobj.tell()
-        self.fileobj.seek(8)
-        # print "File size is", totalsize, repr(struct.pack(">Q", totalsize))
-        self.fileobj.write(struct.pack(">Q", totalsize))
+        if self.mode == "w":
+            # Update file size
+            self.fileobj.seek(0, 2)
+            totalsize = self.fileobj.tell()
+            self.fileobj.seek(8)
+            # print "File size is", totalsize, repr(struct.pack(">Q", totalsize))
+            self.fileobj.write(struct.pack(">Q", totalsize))
 
         if self.mode == "w" and self.signatures:
             self.fileobj.flush()
@@ -412,49 +486,106 @@ class MarFile:
         self.fileobj.seek(4)
         self.fileobj.write(packint(self.index_offset))
 
-    def extractall(self, path=".", members=None):
+    def extractall(self, path=".", members=None, processes=1):
         """Extracts members into `path`. If members is None (the default), then
-        all members are extracted."""
+        all members are extracted.
+
+        If `processes` is greater than 1, members are extracted concurrently
+        by a pool of that many processes. If it is None, one process per CPU
+        is used."""
         if members is None:
             members = self.members
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes <= 1 or len(members) <= 1:
+            for m in members:
+                self.extract(m, path)
+            return
+
+        # Create the directories up front, so the workers don't race to create
+        # them
         for m in members:
-            self.extract(m, path)
+            makedirs(os.path.dirname(os.path.join(path, m.name)))
+
+        # Hand out the biggest members first so one large file doesn't hold
+        # everything up at the end
+        indexes = dict((id(m), i) for i, m in enumerate(self.members))
+        jobs = [(indexes[id(m)], path) for m in
+                sorted(members, key=lambda m: m.size, reverse=True)]
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (self.__class__, self.name))
+        try:
+            for _ in pool.imap_unordered(_extract_worker, jobs):
+                pass
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def iter_member(self, member):
+        """Generates the (raw) data of `member` in blocks, without reading
+        the whole member into memory"""
+        if self._mmap:
+            end = member._offset + member.size
+            for start in xrange(member._offset, end, self._blocksize):
+                yield self._mmap[start:min(start + self._blocksize, end)]
+        else:
+            self.fileobj.seek(member._offset)
+            toread = member.size
+            while toread > 0:
+                block = self.fileobj.read(min(self._blocksize, toread))
+                if not block:
+                    break
+                toread -= len(block)
+                yield block
 
     def extract(self, member, path="."):
         """Extract `member` into `path` which defaults to the current
         directory."""
         dstpath = os.path.join(path, member.name)
-        dirname = os.path.dirname(dstpath)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        makedirs(os.path.dirname(dstpath))
 
-        self.fileobj.seek(member._offset)
-        open(dstpath, "wb").write(self.fileobj.read(member.size))
+        output = open(dstpath, "wb")
+        for block in self.iter_member(member):
+            output.write(block)
+        output.close()
         os.chmod(dstpath, member.flags)
 
 
 class BZ2MarFile(MarFile):
     """Subclass of MarFile that compresses/decompresses members using BZ2.
 
-    BZ2 compression is used for most update MARs."""
+    BZ2 compression is used for most update MARs.
+
+    When writing, members are compressed into temporary files as they're
+    added, by a pool of `processes` worker processes if it's greater than 1
+    (or None, meaning one per CPU). The MAR itself is written out in the order
+    members were added when it's closed, and signatures are calculated as the
+    data is written rather than by reading the file back in."""
+    def __init__(self, name, mode="r", signature_versions=[], processes=1):
+        MarFile.__init__(self, name, mode, signature_versions)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self._pool = None
+        self._tmpdir = None
+        # Compressed data for each member, in the same order as self.members.
+        # Each is either (tmpname, size), or an AsyncResult that will return
+        # that
+        self._pending = []
+
     def extract(self, member, path="."):
         """Extract and decompress `member` into `path` which defaults to the
         current directory."""
         dstpath = os.path.join(path, member.name)
-        dirname = os.path.dirname(dstpath)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        makedirs(os.path.dirname(dstpath))
 
-        self.fileobj.seek(member._offset)
         decomp = bz2.BZ2Decompressor()
         output = open(dstpath, "wb")
-        toread = member.size
-        while True:
-            thisblock = min(128 * 1024, toread)
-            block = self.fileobj.read(thisblock)
-            if not block:
-                break
-            toread -= len(block)
+        for block in self.iter_member(member):
             output.write(decomp.decompress(block))
         output.close()
         os.chmod(dstpath, member.flags)
@@ -478,33 +609,102 @@ class BZ2MarFile(MarFile):
             return
         info = MarInfo()
         info.name = name or os.path.normpath(path)
-        info.size = 0
         if not fileobj:
             info.flags = os.stat(path).st_mode & 0777
         else:
             info.flags = mode
-        info._offset = self.index_offset
 
-        if not fileobj:
-            f = open(path, 'rb')
+        if not self._tmpdir:
+            self._tmpdir = tempfile.mkdtemp(
+                dir=os.path.dirname(os.path.abspath(self.name)))
+
+        if fileobj:
+            # File objects can't be handed to other processes
+            result = bz2_compress(fileobj, self._tmpdir)
+        elif self.processes > 1:
+            if not self._pool:
+                self._pool = multiprocessing.Pool(self.processes)
+            result = self._pool.apply_async(_compress_worker,
+                                            (path, self._tmpdir))
         else:
-            f = fileobj
-        comp = bz2.BZ2Compressor(9)
-        self.fileobj.seek(self.index_offset)
-        while True:
-            block = f.read(512 * 1024)
-            if not block:
-                break
-            block = comp.compress(block)
-            info.size += len(block)
-            self.fileobj.write(block)
-        block = comp.flush()
-        info.size += len(block)
-        self.fileobj.write(block)
+            result = _compress_worker(path, self._tmpdir)
 
-        self.index_offset += info.size
         self.rewrite_index = True
         self.members.append(info)
+        self._pending.append(result)
+
+    def _write_members(self):
+        """Writes out the header, compressed members and index, updating the
+        signatures with everything but the signatures themselves"""
+        tmpnames = []
+        offset = self.index_offset
+        for info, result in zip(self.members, self._pending):
+            if not isinstance(result, tuple):
+                result = result.get()
+            tmpname, info.size = result
+            info._offset = offset
+            offset += info.size
+            tmpnames.append(tmpname)
+        self._pending = []
+        self.index_offset = offset
+
+        index = "".join(m.to_bytes() for m in self.members)
+        totalsize = self.index_offset + 4 + len(index)
+
+        fp = self.fileobj
+
+        def write(data, sign=True):
+            fp.write(data)
+            if sign:
+                self._update_signatures(data)
+
+        fp.seek(0)
+        write("MAR1" + packint(self.index_offset))
+        write(struct.pack(">Q", totalsize))
+        write(packint(len(self.signatures)))
+        for sig in self.signatures:
+            write(packint(sig.algo_id) + packint(sig.sigsize))
+            # Space for the signature
+            write("\0" * sig.sigsize, sign=False)
+
+        for tmpname in tmpnames:
+            f = open(tmpname, 'rb')
+            while True:
+                block = f.read(512 * 1024)
+                if not block:
+                    break
+                write(block)
+            f.close()
+            os.unlink(tmpname)
+
+        write(packint(len(index)))
+        write(index)
+        fp.truncate()
+
+        for sig in self.signatures:
+            sig.write_signature(fp)
+
+    def close(self):
+        """Close the MAR file, writing out the members and index if
+        required.
+
+        Furthur modifications to the file are not allowed."""
+        if self.mode != "w":
+            MarFile.close(self)
+            return
+
+        try:
+            self._write_members()
+        finally:
+            if self._pool:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+            if self._tmpdir:
+                shutil.rmtree(self._tmpdir, ignore_errors=True)
+                self._tmpdir = None
+            self.fileobj.close()
+            self.fileobj = None
 
 if __name__ == "__main__":
     from optparse import OptionParser
@@ -516,6 +716,7 @@ if __name__ == "__main__":
         chdir=None,
         keyfile=None,
         verify=False,
+        processes=1,
     )
     parser.add_option("-x", "--extract", action="store_const", const="extract",
                       dest="action", help="extract MAR")
@@ -529,6 +730,8 @@ if __name__ == "__main__":
                       help="sign/verify with given key")
     parser.add_option("-v", "--verify", dest="verify", action="store_true",
                       help="verify the marfile")
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+                      help="extract or compress members using this many processes; 0 means one per CPU")
     parser.add_option("-C", "--chdir", dest="chdir",
                       help="chdir to this directory before creating or extracing; location of marfile isn't affected by this option.")
 
@@ -558,7 +761,7 @@ if __name__ == "__main__":
 
     if options.action == "extract":
         m = mar_class(marfile)
-        m.extractall()
+        m.extractall(processes=options.processes or None)
 
     elif options.action == "list":
         m = mar_class(marfile, signature_versions=signatures)
@@ -571,7 +774,10 @@ if __name__ == "__main__":
     elif options.action == "create":
         if not files:
             parser.error("Must specify at least one file to add to marfile")
-        m = mar_class(marfile, "w", signature_versions=signatures)
+        kwargs = {}
+        if options.bz2:
+            kwargs['processes'] = options.processes or None
+        m = mar_class(marfile, "w", signature_versions=signatures, **kwargs)
         for f in files:
             m.add(f)
         m.close()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import struct
+import tempfile
+from subprocess import check_call
+from unittest import TestCase
+
+from mar import MarFile, BZ2MarFile
+
+FILES = {
+    "a.txt": ("hello\n", 0644),
+    "bin/tool": ("\0\1\2" * 300000, 0755),
+    "bin/lib/empty": ("", 0600),
+    "defaults/pref/channel-prefs.js": ("pref('app.update.channel', 'x');\n",
+                                       0644),
+}
+
+
+class TestMar(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, "src")
+        for name, (data, mode) in FILES.items():
+            fn = os.path.join(self.src, name)
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            open(fn, "wb").write(data)
+            os.chmod(fn, mode)
+        self.marfile = os.path.join(self.tmpdir, "test.mar")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create(self, mar_class, signature_versions=[], **kwargs):
+        m = mar_class(self.marfile, "w", signature_versions=signature_versions,
+                      **kwargs)
+        for name in sorted(FILES):
+            m.add(os.path.join(self.src, name), name=name)
+        m.close()
+
+    def checkExtract(self, mar_class, processes):
+        dest = os.path.join(self.tmpdir, "dest-%i" % processes)
+        m = mar_class(self.marfile)
+        self.assertEquals(sorted(i.name for i in m.members), sorted(FILES))
+        m.extractall(dest, processes=processes)
+        m.close()
+        for name, (data, mode) in FILES.items():
+            fn = os.path.join(dest, name)
+            self.assertEquals(open(fn, "rb").read(), data)
+            self.assertEquals(os.stat(fn).st_mode & 0777, mode)
+
+    def testRoundTrip(self):
+        self.create(MarFile)
+        for processes in 1, 3:
+            self.checkExtract(MarFile, processes)
+
+    def testRoundTripBZ2(self):
+        for write_processes in 1, 3:
+            self.create(BZ2MarFile, processes=write_processes)
+            for processes in 1, 3:
+                self.checkExtract(BZ2MarFile, processes)
+            # The temporary files have all been cleaned up
+            self.assertEquals(sorted(os.listdir(self.tmpdir)),
+                              ["dest-1", "dest-3", "src", "test.mar"])
+            shutil.rmtree(os.path.join(self.tmpdir, "dest-1"))
+            shutil.rmtree(os.path.join(self.tmpdir, "dest-3"))
+
+    def checkHeader(self):
+        data = open(self.marfile, "rb").read()
+        magic, index_offset, size, num_sigs = struct.unpack(
+            ">4sLQL", data[:20])
+        self.assertEquals(magic, "MAR1")
+        self.assertEquals(size, len(data))
+        self.assertEquals(num_sigs, 0)
+        # Members start straight after the header
+        m = MarFile(self.marfile)
+        self.assertEquals(m.index_offset, index_offset)
+        self.assertEquals(m.members[0]._offset, 20)
+        m.close()
+
+    def testHeader(self):
+        self.create(MarFile)
+        self.checkHeader()
+
+    def testHeaderBZ2(self):
+        self.create(BZ2MarFile, processes=3)
+        self.checkHeader()
+
+    def testReadDoesntModify(self):
+        self.create(MarFile)
+        data = open(self.marfile, "rb").read()
+        for mar_class in MarFile, BZ2MarFile:
+            mar_class(self.marfile).close()
+            self.assertEquals(open(self.marfile, "rb").read(), data)
+
+    def testSignatures(self):
+        key = os.path.join(self.tmpdir, "key.pem")
+        pubkey = os.path.join(self.tmpdir, "pubkey.pem")
+        devnull = open(os.devnull, "w")
+        check_call(["openssl", "genrsa", "-out", key, "2048"],
+                   stdout=devnull, stderr=devnull)
+        check_call(["openssl", "rsa", "-in", key, "-pubout", "-out", pubkey],
+                   stdout=devnull, stderr=devnull)
+        devnull.close()
+        # BZ2MarFile signs members as they're written, and MarFile by reading
+        # the file back in; both have to match what's verified
+        for mar_class, kwargs in ((MarFile, {}),
+                                  (BZ2MarFile, {'processes': 1}),
+                                  (BZ2MarFile, {'processes': 3})):
+            self.create(mar_class, [(1, key)], **kwargs)
+            m = mar_class(self.marfile, signature_versions=[(1, pubkey)])
+            m.verify_signatures()
+            m.close()
@@ -7,13 +7,28 @@ import urllib
 import os
 import traceback
 import time
+import tempfile
+import subprocess
+try:
+    import json
+except ImportError:
+    import simplejson as json
 if os.name == 'nt':
     from win32file import RemoveDirectory, DeleteFile, \
         GetFileAttributesW, SetFileAttributesW, \
         FILE_ATTRIBUTE_NORMAL, FILE_ATTRIBUTE_DIRECTORY
     from win32api import FindFiles
 
+# Use the shared tree removal code if we're running from a tools checkout;
+# this script is also downloaded and run on its own
+sys.path.append(os.path.join(os.path.dirname(__file__), "../lib/python"))
+try:
+    from util.rmtree import rmtree
+except ImportError:
+    rmtree = None
+
 clobber_suffix = '.deleteme'
+reaper_pidfile = '.reaper.pid'
 
 
 def ts_to_str(ts):
@@ -39,7 +54,7 @@ def read_file(fn):
     except ValueError:
         return None
 
-def rmdirRecursiveWindows(dir):
+def rmdirRecursiveWindows(dir, throttle=None):
     """Windows-specific version of rmdirRecursive that handles
     path lengths longer than MAX_PATH.
     """
@@ -56,18 +71,28 @@ def rmdirRecursiveWindows(dir):
         full_name = os.path.join(dir, name)
 
         if file_attr & FILE_ATTRIBUTE_DIRECTORY:
-            rmdirRecursiveWindows(full_name)
+            rmdirRecursiveWindows(full_name, throttle)
         else:
             SetFileAttributesW('\\\\?\\' + full_name, FILE_ATTRIBUTE_NORMAL)
             DeleteFile('\\\\?\\' + full_name)
+            if throttle:
+                throttle()
     RemoveDirectory('\\\\?\\' + dir)
 
-def rmdirRecursive(dir):
+def rmdirRecursive(dir, throttle=None):
     """This is a replacement for shutil.rmtree that works better under
     windows. Thanks to Bear at the OSAF for the code.
-    (Borrowed from buildbot.slave.commands)"""
+    (Borrowed from buildbot.slave.commands)
+
+    If throttle is set, it is called after each file is removed.
+
+    If util.rmtree is available, it is used instead, except on Windows."""
     if os.name == 'nt':
-        rmdirRecursiveWindows(dir)
+        rmdirRecursiveWindows(dir, throttle)
+        return
+
+    if rmtree:
+        rmtree(dir, throttle=throttle)
         return
 
     if not os.path.exists(dir):
@@ -95,17 +120,145 @@ def rmdirRecursive(dir):
                 os.chmod(full_name, 0600)
 
         if os.path.isdir(full_name):
-            rmdirRecursive(full_name)
+            rmdirRecursive(full_name, throttle)
         else:
             # Don't try to chmod links
             if not os.path.islink(full_name):
                 os.chmod(full_name, 0700)
             os.remove(full_name)
+            if throttle:
+                throttle()
     os.rmdir(dir)
 
 
-def do_clobber(dir, dryrun=False, skip=None):
+class Throttle(object):
+    """Sleeps as needed when called, so that it's called at most `rate` times
+    a second"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.count = 0
+        self.start = time.time()
+
+    def __call__(self):
+        self.count += 1
+        if self.count < self.rate:
+            return
+        elapsed = time.time() - self.start
+        if elapsed < 1:
+            time.sleep(1 - elapsed)
+        self.count = 0
+        self.start = time.time()
+
+
+def move_to_trash(dir, trash, skip=None):
+    """Moves everything in dir, except for anything in skip, into a new
+    directory in trash. trash must be on the same filesystem as dir.
+    Returns the names of anything that couldn't be moved."""
+    trash = os.path.abspath(trash)
+    if not os.path.isdir(trash):
+        os.makedirs(trash)
+    victim = tempfile.mkdtemp(dir=trash,
+                              prefix=os.path.basename(os.path.abspath(dir)) + '.')
+    left = []
+    for f in os.listdir(dir):
+        if skip is not None and f in skip:
+            continue
+        path = os.path.join(os.path.abspath(dir), f)
+        if trash == path or trash.startswith(path + os.sep):
+            continue
+        print "Moving %s to %s" % (f, victim)
+        try:
+            os.rename(os.path.join(dir, f), os.path.join(victim, f))
+        except OSError:
+            left.append(f)
+    return left
+
+
+def reaper_running(trash):
+    "Returns True if a reaper is already deleting the contents of trash"
+    try:
+        pid = int(open(os.path.join(trash, reaper_pidfile)).read())
+    except (IOError, ValueError):
+        return False
+    if os.name == 'nt':
+        # We can't check; assume it has died if it hasn't been touched in a
+        # while
+        return time.time() - os.path.getmtime(
+            os.path.join(trash, reaper_pidfile)) < 3600
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def reap_trash(trash, rate=None):
+    """Deletes everything in trash, removing at most rate files a second,
+    until it's empty"""
+    pidfile = os.path.join(trash, reaper_pidfile)
+    open(pidfile, 'w').write(str(os.getpid()))
+    throttle = None
+    if rate:
+        throttle = Throttle(rate)
+    failed = set()
+    try:
+        while True:
+            victims = [f for f in os.listdir(trash)
+                       if f != reaper_pidfile and f not in failed]
+            if not victims:
+                break
+            for f in victims:
+                path = os.path.join(trash, f)
+                try:
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        rmdirRecursive(path, throttle)
+                    else:
+                        os.remove(path)
+                except Exception, e:
+                    print "Couldn't remove %s: %s" % (path, e)
+                    failed.add(f)
+                # Let reaper_running know we're still alive
+                os.utime(pidfile, None)
+    finally:
+        os.remove(pidfile)
+
+
+def start_reaper(trash, rate=None):
+    """Starts a detached, low priority process to delete everything in trash,
+    unless one is already running"""
+    if not os.path.isdir(trash) or reaper_running(trash):
+        return
+    if not [f for f in os.listdir(trash) if f != reaper_pidfile]:
+        return
+    cmd = [sys.executable, os.path.abspath(__file__), '--reap', trash]
+    if rate:
+        cmd.extend(['--reap-rate', str(rate)])
+    print "Deleting the contents of %s in the background" % trash
+    # Don't hold on to our output; buildbot waits for it to be closed
+    devnull = open(os.devnull, 'r+')
+    if os.name == 'nt':
+        DETACHED_PROCESS = 0x8
+        BELOW_NORMAL_PRIORITY_CLASS = 0x4000
+        subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+                         creationflags=DETACHED_PROCESS | BELOW_NORMAL_PRIORITY_CLASS)
+    else:
+        def detach():
+            os.setsid()
+            os.nice(10)
+        subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=detach)
+    devnull.close()
+
+
+def do_clobber(dir, dryrun=False, skip=None, trash=None):
+    """Removes everything in dir, except for anything in skip. If trash is
+    set, things are moved there to be deleted later by reap_trash instead,
+    wherever possible."""
     try:
+        if trash and not dryrun:
+            left = move_to_trash(dir, trash, skip)
+            # Anything we couldn't move gets deleted below
+            skip = [f for f in os.listdir(dir) if f not in left]
         for f in os.listdir(dir):
             if skip is not None and f in skip:
                 print "Skipping", f
@@ -138,17 +291,70 @@ def do_clobber(dir, dryrun=False, skip=None):
         sys.exit(1)
 
 
-def getClobberDates(clobberURL, branch, buildername, builddir, slave, master):
+def read_cache(fn):
+    try:
+        return json.load(open(fn))
+    except (IOError, ValueError):
+        return {}
+
+
+def write_cache(cache, fn):
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)))
+    f = os.fdopen(fd, "w")
+    json.dump(cache, f)
+    f.close()
+    if os.name == 'nt' and os.path.exists(fn):
+        os.unlink(fn)
+    os.rename(tmpname, fn)
+
+
+def getClobberDates(clobberURL, branch, buildername, builddir, slave, master,
+                    cache_file=None, max_age=None):
+    """Returns the server's clobber dates, as a dictionary of builddir to
+    (clobber time, who).
+
+    If cache_file is set, the server's response is kept there, and the server
+    is asked to only send it again if it has changed (using its ETag). If
+    max_age is also set, a cached response that is less than max_age seconds
+    old is used without asking the server at all."""
     params = dict(branch=branch, buildername=buildername,
                   builddir=builddir, slave=slave, master=master)
     url = "%s?%s" % (clobberURL, urllib.urlencode(params))
-    print "Checking clobber URL: %s" % url
-    # The timeout arg was added to urlopen() at Python 2.6
-    # Deprecate this test when esr17 reaches EOL
-    if sys.version_info[:2] < (2, 6):
-        data = urllib2.urlopen(url).read().strip()
+
+    cache = {}
+    cached = None
+    if cache_file:
+        cache = read_cache(cache_file)
+        cached = cache.get(url)
+
+    if cached and max_age and time.time() - cached['time'] < max_age:
+        print "Using cached clobber dates for %s" % url
+        data = cached['data']
     else:
-        data = urllib2.urlopen(url, timeout=30).read().strip()
+        print "Checking clobber URL: %s" % url
+        req = urllib2.Request(url)
+        if cached and cached.get('etag'):
+            req.add_header('If-None-Match', cached['etag'])
+        try:
+            # The timeout arg was added to urlopen() at Python 2.6
+            # Deprecate this test when esr17 reaches EOL
+            if sys.version_info[:2] < (2, 6):
+                resp = urllib2.urlopen(req)
+            else:
+                resp = urllib2.urlopen(req, timeout=30)
+            data = resp.read().strip()
+            etag = None
+            if cache_file:
+                etag = resp.info().getheader('ETag')
+        except urllib2.HTTPError, e:
+            if e.code != 304 or not cached:
+                raise
+            print "Clobber dates haven't changed"
+            data = cached['data']
+            etag = cached['etag']
+        if cache_file:
+            cache[url] = dict(data=data, etag=etag, time=time.time())
+            write_cache(cache, cache_file)
 
     retval = {}
     try:
@@ -179,8 +385,28 @@ if __name__ == "__main__":
                       dest='dir', default='.', type='string')
     parser.add_option('-v', '--verbose', help='be more verbose',
                       dest='verbose', action='store_true', default=False)
+    parser.add_option('--trash', dest='trash', default=None,
+                      help='move things to be clobbered into this directory, '
+                      'which must be on the same filesystem, and delete them '
+                      'in the background')
+    parser.add_option('--reap-rate', dest='reap_rate', type='int',
+                      default=None,
+                      help='delete at most this many files a second from the '
+                      'trash directory')
+    parser.add_option('--reap', dest='reap', default=None,
+                      help='delete everything in this trash directory, and exit')
+    parser.add_option('--cache', dest='cache', default=None,
+                      help='cache the server\'s clobber dates in this file')
+    parser.add_option('--cache-max-age', dest='cache_max_age', type='float',
+                      default=None,
+                      help='use cached clobber dates less than this many '
+                      'seconds old without checking with the server')
 
     options, args = parser.parse_args()
+    if options.reap:
+        reap_trash(options.reap, options.reap_rate)
+        sys.exit(0)
+
     if len(args) != 6:
         parser.error("Incorrect number of arguments")
 
@@ -191,9 +417,14 @@ if __name__ == "__main__":
 
     clobberURL, branch, builder, my_builddir, slave, master = args
 
+    trash = None
+    if options.trash:
+        trash = os.path.abspath(options.trash)
+
     try:
         server_clobber_dates = getClobberDates(
-            clobberURL, branch, builder, my_builddir, slave, master)
+            clobberURL, branch, builder, my_builddir, slave, master,
+            options.cache, options.cache_max_age)
     except:
         if options.verbose:
             traceback.print_exc()
@@ -270,7 +501,7 @@ if __name__ == "__main__":
         if clobber:
             # Finally, perform a clobber if we're supposed to
             print "%s:Clobbering..." % builddir
-            do_clobber(builder_dir, options.dryrun, options.skip)
+            do_clobber(builder_dir, options.dryrun, options.skip, trash)
             write_file(our_clobber_date, "last-clobber")
 
         # If this is the build dir for the current job, display the clobber type in TBPL.
@@ -278,3 +509,6 @@ if __name__ == "__main__":
         # clobber was performed this time.
         if clobberType and builddir == my_builddir:
             print "TinderboxPrint: %s clobber" % clobberType
+
+    if trash and not options.dryrun:
+        start_reaper(trash, options.reap_rate)
@@ -5,6 +5,7 @@ import os
 
 from clobberer import do_clobber
 from clobberer import getClobberDates
+from clobberer import reap_trash
 
 
 class TestClobbererClient(TestCase):
@@ -43,6 +44,58 @@ class TestClobbererClient(TestCase):
         os.rmdir(skip_dir_name)
         os.remove(skip_file_name)
 
+    def test_do_clobber_with_trash(self):
+        trash = os.path.join(self.outer_dir, 'trash')
+        builder_dir = os.path.join(self.outer_dir, 'builder')
+        os.makedirs(os.path.join(builder_dir, 'objdir', 'dist'))
+        open(os.path.join(builder_dir, 'objdir', 'dist', 'a.out'), 'a').close()
+        open(os.path.join(builder_dir, 'last-clobber'), 'a').close()
+        os.chdir(builder_dir)
+        do_clobber(builder_dir, skip=['last-clobber'], trash=trash)
+        self.assertEqual(os.listdir(builder_dir), ['last-clobber'])
+        victims = os.listdir(trash)
+        self.assertEqual(len(victims), 1)
+        self.assertTrue(os.path.exists(
+            os.path.join(trash, victims[0], 'objdir', 'dist', 'a.out')))
+        reap_trash(trash, rate=100)
+        self.assertEqual(os.listdir(trash), [])
+
+    def test_get_clobber_dates_cached(self):
+        import urllib2
+        import mimetools
+        import StringIO
+        cache_file = os.path.join(self.outer_dir, 'cache')
+        requests = []
+
+        class FakeResponse(object):
+            def read(self):
+                return 'the-roadhouse:9999:JimMorrison@thedoors.net\n'
+
+            def info(self):
+                return mimetools.Message(StringIO.StringIO('ETag: "1"\n'))
+
+        def fake_urlopen(req, timeout=None):
+            requests.append(req.get_header('If-none-match'))
+            if req.get_header('If-none-match') == '"1"':
+                raise urllib2.HTTPError(req.get_full_url(), 304,
+                                        'Not Modified', {}, None)
+            return FakeResponse()
+
+        old_urlopen = urllib2.urlopen
+        urllib2.urlopen = fake_urlopen
+        try:
+            expected = {'the-roadhouse': (9999, 'JimMorrison@thedoors.net')}
+            args = ('clobberer/lastclobber', 'branch', 'buildername',
+                    'builddir', 'slave', 'master', cache_file)
+            self.assertEqual(getClobberDates(*args), expected)
+            # the server says nothing has changed
+            self.assertEqual(getClobberDates(*args), expected)
+            # the server isn't asked at all
+            self.assertEqual(getClobberDates(*args, max_age=60), expected)
+            self.assertEqual(requests, [None, '"1"'])
+        finally:
+            urllib2.urlopen = old_urlopen
+
     def test_get_clobber_dates(self):
         import urllib2
         lastclobber_fmt = '{}:{}:{}\n'
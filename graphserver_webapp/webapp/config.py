@@ -2,6 +2,11 @@ class Config(object):
     DEBUG = False
     TESTING = False
     DATABASE_URI = 'sqlite:///:memory:'
+    # connection pool settings; ignored for sqlite
+    DATABASE_POOL_SIZE = 5
+    DATABASE_POOL_RECYCLE = 3600
+    # how long, in seconds, to cache the branch and machine listings
+    LISTING_CACHE_TIME = 60
     VERSION = 'Default'
 
 
@@ -1,6 +1,7 @@
 import sqlite3
 import time
-from flask import Flask, request, redirect, url_for, jsonify
+import threading
+from flask import Flask, request, redirect, url_for, jsonify, g
 from flask import abort, render_template, flash
 from contextlib import closing
 from sqlalchemy import create_engine, MetaData, Table
@@ -19,13 +20,51 @@ handler.setFormatter(format)
 app.logger.addHandler(handler)
 
 
+app.engine = None
+app.engine_uri = None
+
+# cached results of listing(), as { table name : (time, rows) }
+_listings = {}
+_listings_lock = threading.Lock()
+
+
 def init_db():
-    app.engine = create_engine(
-        app.config['DATABASE_URI'], convert_unicode=True)
+    """Create the engine and reflect the tables, once per process (or again
+    if DATABASE_URI has changed)"""
+    uri = app.config['DATABASE_URI']
+    if app.engine is not None and app.engine_uri == uri:
+        return
+    options = {}
+    # sqlite engines don't use a QueuePool
+    if not uri.startswith('sqlite:'):
+        options['pool_size'] = app.config.get('DATABASE_POOL_SIZE', 5)
+        options['pool_recycle'] = app.config.get('DATABASE_POOL_RECYCLE', 3600)
+    app.engine = create_engine(uri, convert_unicode=True, **options)
+    app.engine_uri = uri
     app.metadata = MetaData(bind=app.engine)
-    app.con = app.engine.connect()
     app.branches = Table('branches', app.metadata, autoload=True)
     app.machines = Table('machines', app.metadata, autoload=True)
+    invalidate_listing('branches', 'machines')
+
+
+def listing(table):
+    """Return all of the rows in table, cached for LISTING_CACHE_TIME seconds
+    or until invalidate_listing is called"""
+    max_age = app.config.get('LISTING_CACHE_TIME', 60)
+    with _listings_lock:
+        cached = _listings.get(table.name)
+    if cached and time.time() - cached[0] < max_age:
+        return cached[1]
+    rows = g.con.execute(table.select().order_by(table.c.id)).fetchall()
+    with _listings_lock:
+        _listings[table.name] = (time.time(), rows)
+    return rows
+
+
+def invalidate_listing(*names):
+    with _listings_lock:
+        for name in names:
+            _listings.pop(name, None)
 
 
 def is_json():
@@ -39,17 +78,20 @@ def is_json():
 @app.before_request
 def before_request():
     init_db()
+    g.con = app.engine.connect()
 
 
 @app.teardown_request
 def teardown_request(exception):
-    pass
+    con = getattr(g, 'con', None)
+    if con is not None:
+        con.close()
 
 
 @app.route('/')
 def show_entries():
-    branch_list = app.engine.execute('select * from branches')
-    machine_list = app.engine.execute('select * from machines')
+    branch_list = listing(app.branches)
+    machine_list = listing(app.machines)
     version = app.config['VERSION']
     return render_template('show_entries.html', branch_list=branch_list,
                            machine_list=machine_list, version=version)
@@ -60,7 +102,7 @@ def update_branches():
     if request.form.get('_method') == "delete":
         delete_branch(request.form['id'], request.form['branch_name'])
     else:
-        exists = app.con.execute(app.branches.select(
+        exists = g.con.execute(app.branches.select(
         ).where(app.branches.c.name == request.form['branch_name']))
         if exists.fetchone() != None:
             flash('Branch name "%s" exists, please enter a unique name' %
@@ -70,25 +112,27 @@ def update_branches():
             flash('Branch name cannot be blank')
             app.logger.warning('Branch name cannot be blank')
         else:
-            results = app.con.execute(
+            results = g.con.execute(
                 app.branches.insert(), name=request.form['branch_name'])
+            invalidate_listing('branches')
             flash('New branch "%s" was successfully added' %
                   request.form['branch_name'])
             app.logger.info('New branch "%s" was successfully added' %
                             request.form['branch_name'])
 
     if is_json():
-        return jsonify(app.branches.select().execute().fetchall())
+        return jsonify(listing(app.branches))
     return redirect(url_for('show_entries'))
 
 
 @app.route('/branches', methods=['DELETE'])
 def delete_branch(id, branch_name):
-    exists = app.con.execute(
+    exists = g.con.execute(
         app.branches.select().where(app.branches.c.id == id))
     if exists.returns_rows:
-        results = app.con.execute(
+        results = g.con.execute(
             app.branches.delete().where(app.branches.c.id == id))
+        invalidate_listing('branches')
         flash('Branch "%s" was successfully deleted' % branch_name)
         app.logger.info('Branch "%s" was successfully deleted' % branch_name)
 
@@ -96,7 +140,7 @@ def delete_branch(id, branch_name):
 @app.route('/branches', methods=['GET'])
 def get_branches():
     if is_json():
-        return jsonify(app.branches.select().execute().fetchall())
+        return jsonify(listing(app.branches))
     return redirect(url_for('show_entries'))
 
 
@@ -108,7 +152,7 @@ def update_machines():
         errors = False
         for key, value in request.form.items():
             if key == 'machine_name':
-                exists = app.con.execute(app.machines.select().where(
+                exists = g.con.execute(app.machines.select().where(
                     app.machines.c.name == request.form['machine_name']))
                 if exists.fetchone() != None:
                     flash('Machine name "%s" exists, please enter a unique name' % request.form['machine_name'])
@@ -126,7 +170,7 @@ def update_machines():
                     app.logger.warning('"%s" must be a numeric value' % key)
                     errors = True
         if not errors:
-            results = app.con.execute(
+            results = g.con.execute(
                 app.machines.insert(),
                 os_id=int(request.form['os_id']),
                 is_throttling=int(request.form['is_throttling']),
@@ -135,13 +179,14 @@ def update_machines():
                 is_active=int(request.form['is_active']),
                 date_added=int(time.time())
             )
+            invalidate_listing('machines')
             flash('New machine "%s" was successfully added' %
                   request.form['machine_name'])
             app.logger.info('New machine "%s" was successfully added' %
                             request.form['machine_name'])
     if is_json():
         machines = {}
-        results = app.machines.select().execute().fetchall()
+        results = listing(app.machines)
         for r in results:
             machines[r[0]] = r[4]
         return jsonify(machines)
@@ -150,11 +195,12 @@ def update_machines():
 
 @app.route('/machines', methods=['DELETE'])
 def delete_machine(id, machine_name):
-    exists = app.con.execute(
+    exists = g.con.execute(
         app.machines.select().where(app.machines.c.id == id))
     if exists.returns_rows:
-        results = app.con.execute(
+        results = g.con.execute(
             app.machines.delete().where(app.machines.c.id == id))
+        invalidate_listing('machines')
         flash('Machine "%s" was successfully deleted' % machine_name)
         app.logger.info('Machine "%s" was successfully deleted' % machine_name)
 
@@ -163,7 +209,7 @@ def delete_machine(id, machine_name):
 def get_machines():
     if is_json():
         machines = {}
-        results = app.machines.select().execute().fetchall()
+        results = listing(app.machines)
         for r in results:
             machines[r[0]] = r[4]
         return jsonify(machines)
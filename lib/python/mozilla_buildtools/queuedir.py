@@ -1,9 +1,18 @@
 """
 Implement an on-disk queue for stuff
+
+Items are normally stored one per file. Producers can instead set
+use_segments, in which case items are appended to segment files as
+length-prefixed records, and a whole segment is moved into new at once.
+Consumers handle both kinds of files transparently; each record in a
+segment is popped as its own item, with an id of <segment>~<index>.
 """
 import os
 import tempfile
 import time
+import heapq
+import struct
+from cStringIO import StringIO
 import logging
 log = logging.getLogger(__name__)
 
@@ -12,8 +21,20 @@ try:
     assert pyinotify
 
     class _MovedHandler(pyinotify.ProcessEvent):
+        """Keeps a QueueDir's index up to date as items are moved in and out
+        of new"""
+        def my_init(self, queue):
+            self.queue = queue
+
         def process_IN_MOVED_TO(self, event):
-            pass
+            self.queue._index_add(event.name)
+
+        def process_IN_MOVED_FROM(self, event):
+            self.queue._index_remove(event.name)
+
+        def process_IN_Q_OVERFLOW(self, event):
+            # We've missed some events, so rescan
+            self.queue._needs_scan = True
 except ImportError:
     pyinotify = None
 
@@ -26,6 +47,21 @@ class QueueDir(object):
     # Should the producer do cleanup?
     producer_cleanup = True
 
+    # How often to rescan new for items we haven't been told about, if
+    # pyinotify isn't available
+    rescan_interval = 60
+
+    # Should the producer write items into segment files?
+    use_segments = False
+    # Segments are moved into new once they reach this many items or bytes,
+    # or are this many seconds old. They can also be moved into new sooner
+    # by calling flush()
+    segment_max_items = 1000
+    segment_max_bytes = 1024 ** 2
+    segment_max_age = 5
+    # Should segments be fsync'ed before being moved into new?
+    segment_fsync = True
+
     # Mapping of names to QueueDir instances
     _objects = {}
 
@@ -40,6 +76,25 @@ class QueueDir(object):
         # List of time, item_id for items to move from cur back into new
         self.to_requeue = []
 
+        # Index of items in new, as a heap of (mtime, item_id). It is only
+        # built once we start consuming items. Entries for items that are no
+        # longer in _indexed have been removed from new and are skipped.
+        self._index = None
+        self._indexed = set()
+        self._last_scan = 0
+        self._needs_scan = False
+        self._wm = None
+        self._notifier = None
+
+        # The segment we're currently writing to, if any
+        self._segment = None
+        # Records from segments we've popped that haven't been returned by
+        # pop() yet
+        self._popped = []
+        # Mapping of segment names in cur to {record id: data} for records
+        # that haven't been removed or requeued yet
+        self._segments = {}
+
         self.tmp_dir = os.path.join(self.queue_dir, 'tmp')
         self.new_dir = os.path.join(self.queue_dir, 'new')
         self.cur_dir = os.path.join(self.queue_dir, 'cur')
@@ -84,7 +139,13 @@ class QueueDir(object):
                 fn = os.path.join(d, f)
                 try:
                     if os.path.getmtime(fn) < now - self.cleanup_time:
-                        os.unlink(fn)
+                        if d == self.tmp_dir and self._is_segment(f):
+                            # The producer went away without moving this
+                            # segment into new, so rescue what it wrote
+                            log.info("Moving abandoned segment %s into new", f)
+                            os.rename(fn, os.path.join(self.new_dir, f))
+                        else:
+                            os.unlink(fn)
                 except OSError:
                     pass
 
@@ -96,13 +157,156 @@ class QueueDir(object):
             except OSError:
                 pass
 
+    def close(self):
+        """
+        Moves any partially written segment into new, and stops watching new
+        for changes
+        """
+        self.flush()
+        if self._wm:
+            self._wm.close()
+            self._wm = None
+            self._notifier = None
+
     ###
-    # For producers
+    # Index of items in new
     ###
-    def add(self, data):
+    def _index_add(self, item_id, mtime=None):
+        if self._index is None:
+            return
+        if mtime is None:
+            try:
+                mtime = os.path.getmtime(os.path.join(self.new_dir, item_id))
+            except OSError:
+                # It's gone already
+                return
+        self._indexed.add(item_id)
+        heapq.heappush(self._index, (mtime, item_id))
+
+    def _index_remove(self, item_id):
+        self._indexed.discard(item_id)
+
+    def _scan(self):
         """
-        Adds a new item to the queue.
+        Rebuilds the index from the contents of new
         """
+        self._last_scan = time.time()
+        self._needs_scan = False
+        index = []
+        for item_id in os.listdir(self.new_dir):
+            try:
+                index.append((os.path.getmtime(os.path.join(self.new_dir, item_id)), item_id))
+            except OSError:
+                pass
+        heapq.heapify(index)
+        self._index = index
+        self._indexed = set(item_id for mtime, item_id in index)
+
+    def _update_index(self):
+        """
+        Brings the index up to date with any changes to new
+        """
+        if self._index is None:
+            # Start watching before we scan, so we don't miss anything
+            if pyinotify:
+                self._wm = pyinotify.WatchManager()
+                self._wm.add_watch(self.new_dir, pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM)
+                self._notifier = pyinotify.Notifier(self._wm, _MovedHandler(queue=self))
+            self._scan()
+            return
+
+        if self._notifier:
+            while self._notifier.check_events(0):
+                self._notifier.read_events()
+                self._notifier.process_events()
+        elif not self._indexed or time.time() - self._last_scan > self.rescan_interval:
+            # Without notifications, look for new items whenever we run out,
+            # and every so often in case they should be handled first
+            self._needs_scan = True
+
+        if self._needs_scan:
+            self._scan()
+
+    ###
+    # Segments
+    ###
+    def _is_segment(self, item_id):
+        return item_id.startswith("seg-") and "~" not in item_id
+
+    def _read_segment(self, segment):
+        """
+        Reads the records from `segment` in cur. Returns a list of
+        (record_id, file handle) for each record.
+        """
+        data = open(os.path.join(self.cur_dir, segment), 'rb').read()
+        if "." in segment:
+            core, count = segment.split(".", 1)
+            suffix = "." + count
+        else:
+            core, suffix = segment, ""
+
+        records = {}
+        result = []
+        pos = 0
+        while pos + 4 <= len(data):
+            size = struct.unpack(">I", data[pos:pos + 4])[0]
+            if pos + 4 + size > len(data):
+                break
+            record_id = "%s~%i%s" % (core, len(result), suffix)
+            record = data[pos + 4:pos + 4 + size]
+            records[record_id] = record
+            result.append((record_id, StringIO(record)))
+            pos += 4 + size
+        if pos != len(data):
+            log.warning("%s has a truncated record; ignoring it", segment)
+
+        self._segments[segment] = records
+        return result
+
+    def _record_segment(self, item_id):
+        """
+        Returns the name of the segment in cur that item_id is a record in,
+        or None if item_id isn't a record we're working on
+        """
+        if "~" not in item_id:
+            return None
+        core, rest = item_id.split("~", 1)
+        if "." in rest:
+            segment = "%s.%s" % (core, rest.split(".", 1)[1])
+        else:
+            segment = core
+        if item_id in self._segments.get(segment, ()):
+            return segment
+        return None
+
+    def _record_done(self, segment, item_id):
+        """
+        Marks item_id as finished with, removing its segment once all of its
+        records are done
+        """
+        records = self._segments[segment]
+        del records[item_id]
+        if not records:
+            del self._segments[segment]
+            try:
+                os.unlink(os.path.join(self.cur_dir, segment))
+            except OSError:
+                # Somebody else moved this; that's probably ok
+                pass
+
+    def _write_item(self, d, item_id, data):
+        """
+        Writes data as a single item named item_id in directory d
+        """
+        fd, tmp_name = tempfile.mkstemp(dir=self.tmp_dir)
+        os.write(fd, data)
+        os.close(fd)
+        os.rename(tmp_name, os.path.join(d, item_id))
+
+    ###
+    # For producers
+    ###
+    def _add_file(self, data):
         # write data to tmp
         fd, tmp_name = tempfile.mkstemp(prefix="%i-%i-%i" % (self.started,
                                                              self.count, self.pid), dir=self.tmp_dir)
@@ -112,10 +316,82 @@ class QueueDir(object):
         dst_name = os.path.join(self.new_dir, os.path.basename(tmp_name))
         os.rename(tmp_name, dst_name)
         self.count += 1
+        self._index_add(os.path.basename(tmp_name))
+
+    def _add_records(self, items):
+        now = time.time()
+        if self._segment and now - self._segment['last_write'] > self.cleanup_time / 2:
+            # Don't append to segments that have been idle for a while, in
+            # case cleanup() is about to rescue them
+            self.flush()
+
+        if not self._segment:
+            fd, tmp_name = tempfile.mkstemp(prefix="seg-%i-%i-%i-" % (self.started,
+                                                                      self.count, self.pid), dir=self.tmp_dir)
+            self._segment = dict(fd=fd, tmp_name=tmp_name, created=now,
+                                 last_write=now, items=0, bytes=0)
+        segment = self._segment
+
+        data = "".join(struct.pack(">I", len(d)) + d for d in items)
+        written = 0
+        while written < len(data):
+            written += os.write(segment['fd'], data[written:])
+        segment['last_write'] = now
+        segment['items'] += len(items)
+        segment['bytes'] += len(data)
+        self.count += len(items)
+
+        if segment['items'] >= self.segment_max_items or \
+                segment['bytes'] >= self.segment_max_bytes or \
+                now - segment['created'] >= self.segment_max_age:
+            self.flush()
+
+    def add(self, data):
+        """
+        Adds a new item to the queue.
+        """
+        if self.use_segments:
+            self._add_records([data])
+        else:
+            self._add_file(data)
+
+        if self.producer_cleanup:
+            self.cleanup()
+
+    def add_many(self, items):
+        """
+        Adds a list of new items to the queue.
+        """
+        if self.use_segments:
+            self._add_records(items)
+        else:
+            for data in items:
+                self._add_file(data)
 
         if self.producer_cleanup:
             self.cleanup()
 
+    def flush(self):
+        """
+        Moves the segment we're writing to into new, so consumers can see the
+        items in it
+        """
+        segment = self._segment
+        if not segment:
+            return
+        self._segment = None
+        if self.segment_fsync:
+            os.fsync(segment['fd'])
+        os.close(segment['fd'])
+
+        item_id = os.path.basename(segment['tmp_name'])
+        try:
+            os.rename(segment['tmp_name'], os.path.join(self.new_dir, item_id))
+        except OSError:
+            # cleanup() has moved it for us already
+            return
+        self._index_add(item_id)
+
     ###
     # For consumers
     ###
@@ -128,17 +404,49 @@ class QueueDir(object):
         """
         self._check_to_requeue()
         self.cleanup()
-        items = os.listdir(self.new_dir)
-        if sorted:
-            items.sort(
-                key=lambda f: os.path.getmtime(os.path.join(self.new_dir, f)))
-        for item in items:
+        self._update_index()
+        return self._pop()
+
+    def pop_batch(self, n, sorted=True):
+        """
+        Moves up to n items from new into cur
+        Returns a list of (item_id, file handle)
+        """
+        self._check_to_requeue()
+        self.cleanup()
+        self._update_index()
+        items = []
+        while len(items) < n:
+            item = self._pop()
+            if item is None:
+                break
+            items.append(item)
+        return items
+
+    def _pop(self):
+        if self._popped:
+            return self._popped.pop(0)
+
+        # The index is always sorted by mtime, so `sorted` costs us nothing
+        while self._index:
+            mtime, item = heapq.heappop(self._index)
+            if item not in self._indexed:
+                continue
+            self._indexed.discard(item)
             try:
                 dst_name = os.path.join(self.cur_dir, item)
                 os.rename(os.path.join(self.new_dir, item), dst_name)
                 os.utime(dst_name, None)
-                return item, open(dst_name, 'rb')
-            except OSError:
+                if not self._is_segment(item):
+                    return item, open(dst_name, 'rb')
+                records = self._read_segment(item)
+                if not records:
+                    del self._segments[item]
+                    os.unlink(dst_name)
+                    continue
+                self._popped.extend(records[1:])
+                return records[0]
+            except (OSError, IOError):
                 pass
         return None
 
@@ -146,13 +454,18 @@ class QueueDir(object):
         """
         Returns True if there are new items in the queue
         """
-        items = os.listdir(self.new_dir)
-        return len(items) > 0
+        if self._popped:
+            return True
+        self._update_index()
+        return len(self._indexed) > 0
 
     def touch(self, item_id):
         """
         Indicate that we're still working on this item
         """
+        segment = self._record_segment(item_id)
+        if segment:
+            item_id = segment
         fn = os.path.join(self.cur_dir, item_id)
         try:
             os.utime(fn, None)
@@ -188,6 +501,10 @@ class QueueDir(object):
         """
         Removes item_id from cur
         """
+        segment = self._record_segment(item_id)
+        if segment:
+            self._record_done(segment, item_id)
+            return
         os.unlink(os.path.join(self.cur_dir, item_id))
 
     def _check_to_requeue(self):
@@ -234,9 +551,19 @@ class QueueDir(object):
             return
 
         dst_name = os.path.join(self.new_dir, "%s.%i" % (core_item_id, count))
+        segment = self._record_segment(item_id)
+        if segment:
+            # Records are requeued as items of their own
+            self._write_item(self.new_dir, os.path.basename(dst_name),
+                             self._segments[segment][item_id])
+            self._record_done(segment, item_id)
+            self._index_add(os.path.basename(dst_name))
+            return
+
         try:
             os.rename(os.path.join(self.cur_dir, item_id), dst_name)
             os.utime(dst_name, None)
+            self._index_add(os.path.basename(dst_name))
         except OSError:
             # Somebody else got to it first
             pass
@@ -246,7 +573,13 @@ class QueueDir(object):
         Moves item_id and log from cur into dead for future inspection
         """
         dst_name = os.path.join(self.dead_dir, item_id)
-        os.rename(os.path.join(self.cur_dir, item_id), dst_name)
+        segment = self._record_segment(item_id)
+        if segment:
+            self._write_item(self.dead_dir, item_id,
+                             self._segments[segment][item_id])
+            self._record_done(segment, item_id)
+        else:
+            os.rename(os.path.join(self.cur_dir, item_id), dst_name)
         if os.path.exists(self.getlogname(item_id)):
             dst_name = os.path.join(self.dead_dir, "%s.log" % item_id)
             os.rename(self.getlogname(item_id), dst_name)
@@ -269,20 +602,18 @@ class QueueDir(object):
                 else:
                     timeout = reque_time
 
+            # Don't sleep if there's something to do already
+            if self.peek():
+                return
+
             if timeout:
                 timeout *= 1000
 
             log.debug("Sleeping for %s", timeout)
 
-            wm = pyinotify.WatchManager()
-            try:
-                wm.add_watch(self.new_dir, pyinotify.IN_MOVED_TO)
-
-                notifier = pyinotify.Notifier(wm, _MovedHandler())
-                notifier.check_events(timeout)
-                notifier.process_events()
-            finally:
-                wm.close()
+            if self._notifier.check_events(timeout):
+                self._notifier.read_events()
+                self._notifier.process_events()
     else:
         def wait(self, timeout=None):
             """
@@ -0,0 +1,235 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from mozilla_buildtools import queuedir
+from mozilla_buildtools.queuedir import QueueDir
+
+
+class TestQueueDir(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.q = QueueDir('test', self.tmpdir)
+
+    def tearDown(self):
+        self.q.close()
+        shutil.rmtree(self.tmpdir)
+
+    def add(self, q, data, mtime=None):
+        q.add(data)
+        if mtime is not None:
+            for f in os.listdir(q.new_dir):
+                fn = os.path.join(q.new_dir, f)
+                if open(fn).read() == data:
+                    os.utime(fn, (mtime, mtime))
+                    q._index_add(f, mtime)
+
+    def popdata(self, q):
+        item = q.pop()
+        if item is None:
+            return None
+        item_id, fp = item
+        q.remove(item_id)
+        return fp.read()
+
+    def testEmpty(self):
+        self.assertEquals(self.q.pop(), None)
+        self.assertFalse(self.q.peek())
+
+    def testSorted(self):
+        now = time.time()
+        self.add(self.q, 'second', now - 10)
+        self.add(self.q, 'third', now)
+        self.add(self.q, 'first', now - 20)
+        self.assertTrue(self.q.peek())
+        self.assertEquals([self.popdata(self.q) for _ in range(4)],
+                          ['first', 'second', 'third', None])
+
+    def testOtherProducer(self):
+        self.assertFalse(self.q.peek())
+        producer = QueueDir('producer', self.tmpdir)
+        producer.add('hello')
+        self.assertTrue(self.q.peek())
+        self.assertEquals(self.popdata(self.q), 'hello')
+
+    def testOtherConsumer(self):
+        self.q.add('one')
+        self.q.add('two')
+        self.assertTrue(self.q.peek())
+        other = QueueDir('other', self.tmpdir)
+        try:
+            self.popdata(other)
+            self.assertEquals(self.popdata(self.q) is not None, True)
+            self.assertEquals(self.q.pop(), None)
+        finally:
+            other.close()
+
+    def testRequeue(self):
+        self.q.add('data')
+        item_id, fp = self.q.pop()
+        self.assertEquals(self.q.pop(), None)
+        self.q.requeue(item_id)
+        new_id, fp = self.q.pop()
+        self.assertEquals(new_id, item_id + '.1')
+        self.assertEquals(fp.read(), 'data')
+
+    def testWaitWakesUp(self):
+        self.q.peek()
+        producer = QueueDir('producer', self.tmpdir)
+        t = threading.Timer(0.2, producer.add, ('hello',))
+        t.start()
+        start = time.time()
+        self.q.wait(10)
+        t.join()
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(self.popdata(self.q), 'hello')
+
+    def testWaitReturnsIfItems(self):
+        self.q.add('hello')
+        start = time.time()
+        self.q.wait(10)
+        self.assertTrue(time.time() - start < 1)
+
+    def testAddMany(self):
+        self.q.add_many(['one', 'two', 'three'])
+        items = self.q.pop_batch(2)
+        self.assertEquals([fp.read() for item_id, fp in items], ['one', 'two'])
+        items += self.q.pop_batch(2)
+        self.assertEquals(len(items), 3)
+        self.assertEquals(self.q.pop_batch(2), [])
+        for item_id, fp in items:
+            self.q.remove(item_id)
+        self.assertEquals(os.listdir(self.q.cur_dir), [])
+
+
+class TestQueueDirSegments(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.producer = QueueDir('producer', self.tmpdir)
+        self.producer.use_segments = True
+        self.q = QueueDir('consumer', self.tmpdir)
+
+    def tearDown(self):
+        self.q.close()
+        self.producer.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testSegment(self):
+        self.producer.add('one')
+        self.producer.add_many(['two', 'three'])
+        # Nothing is visible until the segment is flushed
+        self.assertFalse(self.q.peek())
+        self.producer.flush()
+        self.assertEquals(len(os.listdir(self.q.new_dir)), 1)
+
+        items = self.q.pop_batch(10)
+        self.assertEquals([fp.read() for item_id, fp in items],
+                          ['one', 'two', 'three'])
+        self.assertEquals(len(set(item_id for item_id, fp in items)), 3)
+        self.assertEquals(len(os.listdir(self.q.cur_dir)), 1)
+
+        for item_id, fp in items:
+            self.q.remove(item_id)
+        self.assertEquals(os.listdir(self.q.cur_dir), [])
+
+    def testRotate(self):
+        self.producer.segment_max_items = 2
+        self.producer.add_many(['one', 'two'])
+        self.producer.add('three')
+        self.assertEquals(len(os.listdir(self.q.new_dir)), 1)
+        self.producer.flush()
+        self.assertEquals(len(os.listdir(self.q.new_dir)), 2)
+        self.assertEquals([fp.read() for item_id, fp in self.q.pop_batch(10)],
+                          ['one', 'two', 'three'])
+
+    def testRequeueRecord(self):
+        self.producer.add_many(['one', 'two'])
+        self.producer.flush()
+        (one_id, fp), (two_id, fp) = self.q.pop_batch(2)
+        self.q.requeue(one_id)
+        self.q.remove(two_id)
+        # The segment is gone, and the requeued record is an item of its own
+        self.assertEquals(os.listdir(self.q.cur_dir), [])
+        item_id, fp = self.q.pop()
+        self.assertEquals(item_id, one_id + '.1')
+        self.assertEquals(self.q.getcount(item_id), 1)
+        self.assertEquals(fp.read(), 'one')
+
+        self.q.requeue(item_id, max_retries=1)
+        self.assertEquals(os.listdir(self.q.dead_dir), [one_id + '.1'])
+
+    def testMurderRecord(self):
+        self.producer.add_many(['one', 'two'])
+        self.producer.flush()
+        (one_id, fp), (two_id, fp) = self.q.pop_batch(2)
+        self.q.log(one_id, 'oh no')
+        self.q.murder(one_id)
+        self.assertEquals(sorted(os.listdir(self.q.dead_dir)),
+                          [one_id, one_id + '.log'])
+        self.assertEquals(open(os.path.join(self.q.dead_dir, one_id)).read(), 'one')
+        self.assertEquals(len(os.listdir(self.q.cur_dir)), 1)
+
+    def testAbandonedSegment(self):
+        self.producer.add_many(['one', 'two'])
+        tmp_name = self.producer._segment['tmp_name']
+        # Pretend we wrote a partial record before going away
+        open(tmp_name, 'ab').write('\x00\x00\x01\x00abc')
+        os.close(self.producer._segment['fd'])
+        self.producer._segment = None
+        old = time.time() - 1000
+        os.utime(tmp_name, (old, old))
+
+        self.q.last_cleanup = 0
+        self.q.cleanup()
+        self.assertEquals([fp.read() for item_id, fp in self.q.pop_batch(10)],
+                          ['one', 'two'])
+
+    def testCrashedConsumer(self):
+        self.producer.add_many(['one', 'two'])
+        self.producer.flush()
+        self.q.pop()
+        for f in os.listdir(self.q.cur_dir):
+            old = time.time() - 1000
+            os.utime(os.path.join(self.q.cur_dir, f), (old, old))
+
+        # Another consumer picks up the whole segment again
+        other = QueueDir('other', self.tmpdir)
+        try:
+            items = other.pop_batch(10)
+            self.assertEquals([fp.read() for item_id, fp in items], ['one', 'two'])
+            self.assertTrue(all(other.getcount(item_id) == 1 for item_id, fp in items))
+        finally:
+            other.close()
+
+
+class TestQueueDirNoInotify(TestQueueDir):
+    def setUp(self):
+        self.patcher = mock.patch.object(queuedir, 'pyinotify', None)
+        self.patcher.start()
+        TestQueueDir.setUp(self)
+
+    def tearDown(self):
+        TestQueueDir.tearDown(self)
+        self.patcher.stop()
+
+    # wait() is chosen when the module is imported
+    def testWaitWakesUp(self):
+        pass
+
+    def testWaitReturnsIfItems(self):
+        pass
+
+    def testRescan(self):
+        self.q.add('one')
+        self.assertTrue(self.q.peek())
+        producer = QueueDir('producer', self.tmpdir)
+        producer.add('two')
+        self.assertEquals(len(self.q._indexed), 1)
+        self.q._last_scan = 0
+        self.assertTrue(self.q.peek())
+        self.assertEquals(len(self.q._indexed), 2)
@@ -0,0 +1,69 @@
+import unittest
+import tempfile
+import os
+import hashlib
+import shutil
+from release.signing import generateChecksums
+
+
+class TestGenerateChecksums(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checksums_dir = os.path.join(self.tmpdir, "checksums")
+        self.files_dir = os.path.join(self.tmpdir, "files")
+        os.makedirs(os.path.join(self.checksums_dir, "linux"))
+        os.makedirs(self.files_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeFile(self, name, data):
+        open(os.path.join(self.files_dir, name), "wb").write(data)
+        lines = []
+        for hash_type in "md5", "sha1":
+            lines.append("%s %s %i %s\n" % (
+                hashlib.new(hash_type, data).hexdigest(), hash_type,
+                len(data), name))
+        return lines
+
+    def writeChecksums(self, name, lines):
+        open(os.path.join(self.checksums_dir, name), "w").writelines(lines)
+
+    def generate(self, **kwargs):
+        sums_info = {"md5": os.path.join(self.tmpdir, "MD5SUMS"),
+                     "sha1": os.path.join(self.tmpdir, "SHA1SUMS")}
+        generateChecksums(self.checksums_dir, sums_info, **kwargs)
+        return dict((hash_type, open(fn).read())
+                    for hash_type, fn in sums_info.items())
+
+    def testGenerate(self):
+        b = self.makeFile("b.exe", "bbb")
+        a = self.makeFile("a.tar.bz2", "aaa")
+        c = self.makeFile("c d.mar", "ccc")
+        self.writeChecksums("one.checksums", b + a)
+        # duplicates across and within files are only listed once
+        self.writeChecksums(os.path.join("linux", "two.checksums"),
+                            a + c + c)
+        self.writeChecksums("ignored.txt", ["garbage\n"])
+
+        sums = self.generate(verify_dir=self.files_dir)
+        self.assertEquals(sums["md5"], "".join(
+            "%s  %s\n" % (l.split()[0], l.split(None, 3)[3].rstrip())
+            for l in (a[0], b[0], c[0])))
+        self.assertEquals(sums["sha1"], "".join(
+            "%s  %s\n" % (l.split()[0], l.split(None, 3)[3].rstrip())
+            for l in (a[1], b[1], c[1])))
+
+    def testVerifyFails(self):
+        lines = self.makeFile("a.exe", "aaa")
+        self.makeFile("a.exe", "bad")
+        self.writeChecksums("one.checksums", lines)
+        self.assertRaises(ValueError, self.generate,
+                          verify_dir=self.files_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "MD5SUMS")))
+        # without verification, the sums are written anyway
+        self.generate()
+
+    def testBadLine(self):
+        self.writeChecksums("one.checksums", ["foo bar\n"])
+        self.assertRaises(ValueError, self.generate)
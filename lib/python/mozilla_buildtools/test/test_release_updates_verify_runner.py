@@ -0,0 +1,215 @@
+import unittest
+import tempfile
+import shutil
+import os
+import hashlib
+import tarfile
+import threading
+import time
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+from release.updates.verify import UpdateVerifyConfig
+from release.updates.verify_runner import UpdateVerifyRunner, \
+    DownloadCache, use_old_updater
+
+UPDATER = """#!/bin/sh
+tar xf "$1/update.mar" && echo succeeded > "$1/update.status"
+"""
+
+UPDATE_XML = """<?xml version="1.0"?>
+<updates>
+<update type="minor" version="36.0">
+<patch type="complete" URL="%(url)s" hashFunction="sha512"
+ hashValue="%(hash)s" size="%(size)i"/>
+</update>
+</updates>
+"""
+
+
+def make_tar(filename, files, mode="w"):
+    tar = tarfile.open(filename, mode)
+    for name, data in sorted(files.items()):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0755 if name.endswith("updater") else 0644
+        tar.addfile(info, StringIO(data))
+    tar.close()
+
+
+class TestUpdateVerifyRunner(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.www = os.path.join(self.tmpdir, "www")
+        self.requests = []
+        www = self.www
+        requests = self.requests
+
+        class Handler(SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                requests.append(path)
+                return os.path.join(www, path.split("?")[0].lstrip("/"))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.url = "http://127.0.0.1:%i" % self.server.server_port
+
+        self.locales = ["de", "fr"]
+        os.makedirs(os.path.join(self.www, "builds"))
+        for locale in self.locales:
+            self.makeBuilds(locale)
+        self.makeMar({"a.txt": "new", "bin": "\0new"})
+
+        self.config = UpdateVerifyConfig(
+            product="Firefox", platform="Linux_x86_64-gcc3", channel="beta",
+            aus_server=self.url, to="/builds/target-%locale%.tar.bz2")
+        self.config.addRelease(
+            "35.0", "20150101", locales=self.locales,
+            from_path="/builds/source-%locale%.tar.bz2",
+            ftp_server_from=self.url, ftp_server_to=self.url)
+        self.cache = DownloadCache(os.path.join(self.tmpdir, "cache"))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def makeBuilds(self, locale, target_bin="\0new"):
+        for name, files in (
+                ("source", {"a.txt": "old", "bin": "\0old"}),
+                ("target", {"a.txt": "new", "bin": target_bin})):
+            files = dict(("firefox/%s" % f, d) for f, d in files.items())
+            files["firefox/updater"] = UPDATER
+            make_tar(os.path.join(self.www, "builds",
+                                  "%s-%s.tar.bz2" % (name, locale)),
+                     files, "w:bz2")
+
+    def makeMar(self, files, hash_value=None):
+        mar = os.path.join(self.www, "update.mar")
+        make_tar(mar, files)
+        data = open(mar, "rb").read()
+        xml = UPDATE_XML % dict(url="%s/update.mar" % self.url,
+                                hash=hash_value or
+                                hashlib.sha512(data).hexdigest(),
+                                size=len(data))
+        for locale in self.locales:
+            d = os.path.join(self.www, "update/3/Firefox/35.0/20150101/"
+                             "Linux_x86_64-gcc3/%s/beta/default/default/"
+                             "default" % locale)
+            if not os.path.exists(d):
+                os.makedirs(d)
+            open(os.path.join(d, "update.xml"), "w").write(xml)
+
+    def run_verify(self, **kwargs):
+        runner = UpdateVerifyRunner(
+            self.config, os.path.join(self.tmpdir, "work"), self.cache,
+            threads=2, empty_update_retries=1, **kwargs)
+        return dict((t.locale, t) for t in runner.run())
+
+    def testSuccess(self):
+        tests = self.run_verify()
+        self.assertEquals([tests[l].status for l in self.locales],
+                          ["SUCCESS", "SUCCESS"])
+        # Nothing but the link to release/common is left behind
+        self.assertEquals(os.listdir(os.path.join(self.tmpdir, "work")),
+                          ["common"])
+
+    def testCache(self):
+        self.run_verify()
+        # The MAR is shared by both locales
+        self.assertEquals(self.requests.count("/update.mar"), 1)
+        del self.requests[:]
+        tests = self.run_verify()
+        self.assertEquals(tests["de"].status, "SUCCESS")
+        self.assertEquals(
+            [r for r in self.requests if not r.endswith("?force=1")], [])
+
+    def testCacheHashMismatch(self):
+        url = "%s/update.mar" % self.url
+        old = open(self.cache.get(url)).read()
+        self.makeMar({"a.txt": "newer", "bin": "\0new"})
+        data = open(os.path.join(self.www, "update.mar"), "rb").read()
+        self.assertNotEquals(data, old)
+        # The cached copy of the url doesn't match, so it's downloaded again
+        cached = self.cache.get(url, hashlib.sha512(data).hexdigest())
+        self.assertEquals(open(cached).read(), data)
+        self.assertEquals(self.requests.count("/update.mar"), 2)
+
+    def testPrune(self):
+        urls = ["%s/builds/%s-de.tar.bz2" % (self.url, b)
+                for b in ("source", "target")]
+        objs = [self.cache.get(u) for u in urls]
+        self.assertNotEquals(objs[0], objs[1])
+        old = time.time() - 3600
+        os.utime(objs[0], (old, old))
+        # Nothing is removed without limits
+        self.assertEquals(self.cache.prune(), 0)
+
+        self.cache.max_age = 60
+        self.assertEquals(self.cache.prune(), 1)
+        self.assertFalse(os.path.exists(objs[0]))
+        self.assertEquals(self.cache.lookup(urls[0]), None)
+        self.assertEquals(os.listdir(self.cache.urls_dir),
+                          [os.path.basename(self.cache._url_index(urls[1]))])
+
+        # Looking a file up counts as using it
+        os.utime(objs[1], (old, old))
+        self.cache.lookup(urls[1])
+        self.assertEquals(self.cache.prune(), 0)
+
+        self.cache.max_age = None
+        self.cache.max_size = os.path.getsize(objs[1])
+        self.assertEquals(self.cache.prune(), 0)
+        self.cache.max_size -= 1
+        self.assertEquals(self.cache.prune(), 1)
+        self.assertEquals(os.listdir(self.cache.objects_dir), [])
+
+    def testPrunedWhileRunning(self):
+        url = "%s/update.mar" % self.url
+        obj = self.cache.get(url)
+        # Another run sharing the cache removes it after we looked it up
+        self.cache.lookup = lambda url, sha512=None: obj
+        os.unlink(obj)
+        dest = os.path.join(self.tmpdir, "update.mar")
+        self.cache.fetch(url, dest)
+        self.assertEquals(open(dest).read(),
+                          open(os.path.join(self.www, "update.mar")).read())
+
+    def testBinaryDiff(self):
+        self.makeBuilds("fr", target_bin="\0other")
+        tests = self.run_verify()
+        self.assertEquals(tests["de"].status, "SUCCESS")
+        self.assertEquals(tests["fr"].status, "FAIL")
+        self.assertTrue("FAIL: binary files found in diff" in
+                        tests["fr"].output)
+
+    def testWrongHash(self):
+        self.makeMar({"a.txt": "new", "bin": "\0new"}, hash_value="abc")
+        tests = self.run_verify()
+        self.assertEquals(tests["de"].status, "FAIL")
+        self.assertTrue(any("wrong hash" in l for l in tests["de"].output))
+
+    def testNoUpdate(self):
+        self.config.releases[0]["patch_types"] = ["partial"]
+        tests = self.run_verify()
+        self.assertEquals(tests["de"].status, "FAIL")
+        self.assertTrue(any("no partial update found" in l
+                            for l in tests["de"].output))
+
+    def testMarsOnly(self):
+        self.makeBuilds("fr", target_bin="\0other")
+        tests = self.run_verify(mars_only=True)
+        self.assertEquals(tests["fr"].status, "SUCCESS")
+        self.assertFalse([r for r in self.requests if "builds" in r])
+
+    def testUseOldUpdater(self):
+        self.assertTrue(use_old_updater("firefox", "33.0.1"))
+        self.assertFalse(use_old_updater("firefox", "34.0b1"))
+        self.assertTrue(use_old_updater("seamonkey", "2.30"))
+        self.assertFalse(use_old_updater("seamonkey", "2.31"))
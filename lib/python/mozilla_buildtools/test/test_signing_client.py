@@ -1 +1,78 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
 import signing.client
+from signing.client import remote_signfiles, remote_signbatch
+
+
+class TestRemoteSignfiles(TestCase):
+    @mock.patch('signing.client.remote_signfile')
+    @mock.patch('signing.client.remote_signbatch')
+    def testSplitAcrossServers(self, signbatch, signfile):
+        signbatch.return_value = []
+        files = [('f%i' % i, None) for i in range(5)]
+        self.assertTrue(remote_signfiles(None, ['a', 'b'], files, 'gpg', 'token'))
+        batches = dict((c[0][1], c[0][2]) for c in signbatch.call_args_list)
+        self.assertEquals(batches, {'a': files[0::2], 'b': files[1::2]})
+        self.assertFalse(signfile.called)
+
+    @mock.patch('signing.client.remote_signfile')
+    @mock.patch('signing.client.remote_signbatch')
+    def testFailuresRetried(self, signbatch, signfile):
+        signbatch.side_effect = lambda options, url, files, fmt, token: files[:1]
+        signfile.return_value = True
+        files = [('f1', None), ('f2', None)]
+        self.assertTrue(remote_signfiles(None, ['a'], files, 'gpg', 'token'))
+        signfile.assert_called_once_with(None, ['a'], 'f1', 'gpg', 'token', None)
+
+        signfile.return_value = False
+        self.assertFalse(remote_signfiles(None, ['a'], files, 'gpg', 'token'))
+
+
+class TestRemoteSignbatch(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.options = mock.Mock()
+        self.options.cachedir = None
+        self.options.noncefile = os.path.join(self.tmpdir, 'nonce')
+        self.files = []
+        for name in 'a', 'b', 'c':
+            fn = os.path.join(self.tmpdir, name)
+            open(fn, 'wb').write(name)
+            self.files.append((fn, None))
+        self.hashes = [signing.client.sha1sum(fn) for fn, dest in self.files]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('signing.client.remote_signfile')
+    @mock.patch('signing.client.get_batch_status')
+    @mock.patch('signing.client.uploadfile')
+    @mock.patch('signing.client.start_batch')
+    def testBatch(self, start_batch, uploadfile, get_batch_status, signfile):
+        a, b, c = self.hashes
+        start_batch.return_value = ('batch1', [b])
+        get_batch_status.return_value = {
+            a: {'status': 'done', 'digest': a},
+            b: {'status': 'done', 'digest': b},
+            c: {'status': 'error'},
+        }
+        signfile.return_value = True
+
+        failed = remote_signbatch(self.options, 'url', self.files, 'gpg', 'token')
+        self.assertEquals(failed, [self.files[2]])
+        uploadfile.assert_called_once_with(
+            'url', self.files[1][0], 'gpg', 'token', nonce='')
+        self.assertEquals(sorted(c[0][2] for c in signfile.call_args_list),
+                          [self.files[0][0], self.files[1][0]])
+
+    @mock.patch('signing.client.start_batch')
+    def testServerError(self, start_batch):
+        import urllib2
+        start_batch.side_effect = urllib2.URLError('no batches here')
+        failed = remote_signbatch(self.options, 'url', self.files, 'gpg', 'token')
+        self.assertEquals(sorted(failed), sorted(self.files))
@@ -6,8 +6,10 @@ if sys.version_info < (2, 6, 0):
     raise SkipTest
 
 
+import os
 import time
 import hashlib
+import json
 import shutil
 import tempfile
 from unittest import TestCase
@@ -17,6 +19,7 @@ import mock
 import webob
 
 import signing.server as ss
+from signing.cache import SignedFileCache
 
 
 class TestTokens(TestCase):
@@ -208,3 +211,388 @@ class TestSigningServer(TestCase):
         # try futzing with the token data
         token = token.replace(slave, '127.0.0.99')
         sign(token, nonce3, 'evenmorestuff.txt', 'stuff!!\n' * 100, slave='127.0.0.99', expect_fail=True)
+
+
+class TestSignedFileCache(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = os.path.join(self.tmpdir, 'index.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeSigned(self, cache, filehash, format_, size):
+        fn = cache.get_path(filehash, format_)
+        if not os.path.exists(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        open(fn, 'wb').write('x' * size)
+        cache.add(filehash, format_, 'digest-' + filehash, size)
+        return fn
+
+    def testHitMiss(self):
+        cache = SignedFileCache(self.tmpdir, self.index)
+        self.assertEquals(cache.get('abc', 'gpg'), None)
+        self.makeSigned(cache, 'abc', 'gpg', 10)
+        self.assertEquals(cache.get('abc', 'gpg'), ('digest-abc', 10))
+        self.assertEquals(cache.get('abc', 'mar'), None)
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+
+    def testMissingFile(self):
+        cache = SignedFileCache(self.tmpdir, self.index)
+        fn = self.makeSigned(cache, 'abc', 'gpg', 10)
+        os.unlink(fn)
+        self.assertEquals(cache.get('abc', 'gpg'), None)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.total_size, 0)
+
+    def testEvictLRU(self):
+        cache = SignedFileCache(self.tmpdir, self.index, max_size=25)
+        a = self.makeSigned(cache, 'a', 'gpg', 10)
+        b = self.makeSigned(cache, 'b', 'gpg', 10)
+        # Using 'a' makes 'b' the least recently used entry
+        cache.get('a', 'gpg')
+        self.makeSigned(cache, 'c', 'gpg', 10)
+        self.assertEquals(cache.evict(), 1)
+        self.assertTrue(os.path.exists(a))
+        self.assertFalse(os.path.exists(b))
+        self.assertFalse(('b', 'gpg') in cache)
+        self.assertEquals(cache.total_size, 20)
+
+    def testUnbounded(self):
+        cache = SignedFileCache(self.tmpdir, self.index)
+        self.makeSigned(cache, 'a', 'gpg', 10)
+        self.assertEquals(cache.evict(), 0)
+
+    def testPersistence(self):
+        cache = SignedFileCache(self.tmpdir, self.index)
+        self.makeSigned(cache, 'a', 'gpg', 10)
+        b = self.makeSigned(cache, 'b', 'mar', 20)
+        self.makeSigned(cache, 'c', 'gpg', 30)
+        cache.get('a', 'gpg')
+        cache.save()
+        os.unlink(b)
+
+        cache = SignedFileCache(self.tmpdir, self.index)
+        self.assertEquals(list(cache.entries.keys()),
+                          [('c', 'gpg'), ('a', 'gpg')])
+        self.assertEquals(cache.total_size, 40)
+
+    def testCorruptIndex(self):
+        open(self.index, 'wb').write('{not json')
+        cache = SignedFileCache(self.tmpdir, self.index)
+        self.assertEquals(len(cache), 0)
+
+
+class TestSigningServerCache(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config = RawConfigParser()
+        config.readfp(StringIO(config_data % dict(tmpdir=self.tmpdir)))
+        config.set('server', 'max_cache_size', '1000')
+        self.server = ss.SigningServer(config, {})
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def testGetServedFromCache(self):
+        fn = self.server.get_path('abc', 'gpg')
+        os.makedirs(os.path.dirname(fn))
+        open(fn, 'wb').write('signed')
+        self.server.cache.add('abc', 'gpg', 'cached-digest', 6)
+
+        req = webob.Request.blank("/sign/gpg/abc")
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        with mock.patch('signing.server.sha1sum') as sha1sum:
+            resp = req.get_response(self.server)
+            self.assertFalse(sha1sum.called)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp.headers['X-SHA1-Digest'], 'cached-digest')
+        self.assertEquals(resp.body, 'signed')
+        self.assertEquals(self.server.cache.hits, 1)
+
+    def testCleanupKeepsCachedFiles(self):
+        fn = self.server.get_path('abc', 'gpg')
+        os.makedirs(os.path.dirname(fn))
+        open(fn, 'wb').write('signed')
+        self.server.cache.add('abc', 'gpg', 'cached-digest', 6)
+        uncached = self.server.get_path('def', 'gpg')
+        open(uncached, 'wb').write('signed')
+
+        self.server.cleanup()
+        self.assertTrue(os.path.exists(fn))
+        self.assertFalse(os.path.exists(uncached))
+        self.assertTrue(os.path.exists(self.server.cache.index_file))
+
+
+fake_helper = """
+import sys, json, shutil, time
+passphrase = json.loads(sys.stdin.readline())
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    results = []
+    for inputfile, outputfile, filename in json.loads(line):
+        if filename == 'crash':
+            sys.exit(1)
+        if filename == 'slow':
+            time.sleep(10)
+        if filename == 'bad':
+            results.append(1)
+            continue
+        shutil.copyfile(inputfile, outputfile)
+        open(outputfile + '.out', 'ab').write(str(passphrase))
+        results.append(0)
+    sys.stdout.write(json.dumps(results) + '\\n')
+    sys.stdout.flush()
+"""
+
+
+class TestSignscriptHelper(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, 'helper.py')
+        open(self.script, 'wb').write(fake_helper)
+        self.cmd = [sys.executable, self.script]
+        self.input = os.path.join(self.tmpdir, 'input')
+        open(self.input, 'wb').write('unsigned')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testSignBatch(self):
+        helper = ss.SignscriptHelper(self.cmd, 'gpg', 'secret')
+        try:
+            out1 = os.path.join(self.tmpdir, 'out1')
+            out2 = os.path.join(self.tmpdir, 'out2')
+            self.assertEquals(helper.sign([(self.input, out1, 'good'),
+                                           (self.input, out2, 'bad')]),
+                              [0, 1])
+            self.assertEquals(open(out1).read(), 'unsigned')
+            self.assertEquals(open(out1 + '.out').read(), 'secret')
+            # The helper is still around for the next file
+            self.assertEquals(helper.sign([(self.input, out2, 'good')]), [0])
+            self.assertTrue(helper.alive())
+        finally:
+            helper.stop()
+        self.assertFalse(helper.alive())
+
+    def testHelperExits(self):
+        helper = ss.SignscriptHelper(self.cmd, 'gpg')
+        out = os.path.join(self.tmpdir, 'out')
+        self.assertRaises(ss.HelperError, helper.sign,
+                          [(self.input, out, 'crash')])
+        self.assertFalse(helper.alive())
+
+    def testHelperTimeout(self):
+        helper = ss.SignscriptHelper(self.cmd, 'gpg')
+        out = os.path.join(self.tmpdir, 'out')
+        self.assertRaises(ss.HelperError, helper.sign,
+                          [(self.input, out, 'slow')], max_time=0.5)
+        self.assertFalse(helper.alive())
+
+    def testPoolReusesHelpers(self):
+        pool = ss.SignscriptPool(self.cmd, 'gpg')
+        helper = pool.get()
+        pool.put(helper)
+        self.assertTrue(pool.get() is helper)
+        pool.put(helper)
+        pool.close()
+        self.assertFalse(helper.alive())
+
+    def testSignerWithHelpers(self):
+        inputdir = os.path.join(self.tmpdir, 'unsigned')
+        outputdir = os.path.join(self.tmpdir, 'signed')
+        os.makedirs(inputdir)
+        app = mock.Mock()
+        app.messages = ss.queue.Queue()
+        signer = ss.Signer(app, self.cmd, inputdir, outputdir, 2, {},
+                           use_helpers=True)
+        signer.max_tries = 1
+        files = []
+        for i in range(3):
+            data = 'unsigned %i' % i
+            filehash = hashlib.sha1(data).hexdigest()
+            open(os.path.join(inputdir, filehash), 'wb').write(data)
+            files.append((filehash, 'file%i' % i, 'gpg'))
+        files.append(('0' * 40, 'bad', 'gpg'))
+        try:
+            for e in signer.signfiles(files):
+                e.wait(timeout=10)
+        finally:
+            signer.stop()
+        messages = [app.messages.get() for _ in files]
+        self.assertEquals(sorted(m[0] for m in messages),
+                          ['done', 'done', 'done', 'errors'])
+        for filehash, filename, format_ in files[:3]:
+            self.assertTrue(os.path.exists(
+                os.path.join(outputdir, 'gpg', filehash)))
+
+
+class TestSigningServerUploads(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config = RawConfigParser()
+        config.readfp(StringIO(config_data % dict(tmpdir=self.tmpdir)))
+        self.server = ss.SigningServer(config, {})
+        self.server.signer = mock.Mock()
+        self.token = self.server.get_token('127.0.0.1', 300)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def upload(self, data, filename='foo.exe', sha1=None):
+        if sha1 is None:
+            sha1 = hashlib.sha1(data).hexdigest()
+        req = webob.Request.blank("/sign/gpg", POST={
+            'filedata': (filename, data),
+            'token': self.token,
+            'filename': filename,
+            'sha1': sha1})
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        return req.get_response(self.server)
+
+    def testLargeUploadHashedOnce(self):
+        data = 'x' * 100000
+        filehash = hashlib.sha1(data).hexdigest()
+        with mock.patch('signing.server.sha1sum') as sha1sum:
+            resp = self.upload(data)
+            self.assertEquals(resp.status_code, 202)
+            fn = os.path.join(self.server.unsigned_dir, filehash)
+            self.assertEquals(open(fn).read(), data)
+            self.assertEquals(ss.get_digest(fn), filehash)
+            self.assertFalse(sha1sum.called)
+        self.server.signer.signfile.assert_called_once_with(
+            filehash, 'foo.exe', 'gpg')
+        # Nothing else should be left behind
+        self.assertEquals(sorted(os.listdir(self.server.unsigned_dir)),
+                          [filehash, filehash + '.fn', filehash + '.sha1'])
+
+    def testReuploadUsesSavedDigest(self):
+        data = 'x' * 100000
+        self.upload(data)
+        self.server.pending[hashlib.sha1(data).hexdigest(), 'gpg'] = mock.Mock()
+        with mock.patch('signing.server.sha1sum') as sha1sum:
+            resp = self.upload(data)
+            self.assertEquals(resp.status_code, 202)
+            self.assertFalse(sha1sum.called)
+        self.assertEquals(len(os.listdir(self.server.unsigned_dir)), 3)
+
+    def testBadUploadRemoved(self):
+        resp = self.upload('x' * 100000, sha1='0' * 40)
+        self.assertEquals(resp.status_code, 400)
+        self.assertEquals(os.listdir(self.server.unsigned_dir), [])
+
+    def testSmallUpload(self):
+        data = 'x' * 200
+        resp = self.upload(data)
+        self.assertEquals(resp.status_code, 202)
+        fn = os.path.join(self.server.unsigned_dir, hashlib.sha1(data).hexdigest())
+        self.assertEquals(open(fn).read(), data)
+
+    def testChangedFileRehashed(self):
+        fn = os.path.join(self.tmpdir, 'file')
+        open(fn, 'wb').write('data')
+        ss.save_digest(fn, 'olddigest')
+        self.assertEquals(ss.get_digest(fn), 'olddigest')
+        open(fn, 'ab').write('more data')
+        self.assertEquals(ss.get_digest(fn), hashlib.sha1('datamore data').hexdigest())
+
+    def testGetUsesFileWrapper(self):
+        fn = self.server.get_path('abc', 'gpg')
+        os.makedirs(os.path.dirname(fn))
+        open(fn, 'wb').write('signed')
+        file_wrapper = mock.Mock(return_value=['signed'])
+        req = webob.Request.blank("/sign/gpg/abc")
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        req.environ['wsgi.file_wrapper'] = file_wrapper
+        resp = req.get_response(self.server)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp.body, 'signed')
+        self.assertEquals(file_wrapper.call_count, 1)
+        self.assertEquals(file_wrapper.call_args[0][0].name, fn)
+
+
+class TestSigningServerBatch(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config = RawConfigParser()
+        config.readfp(StringIO(config_data % dict(tmpdir=self.tmpdir)))
+        self.server = ss.SigningServer(config, {})
+        self.server.signer = mock.Mock()
+        self.server.signer.signfiles.side_effect = lambda files: [mock.Mock() for f in files]
+        self.token = self.server.get_token('127.0.0.1', 300)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def start_batch(self, files, token=None):
+        req = webob.Request.blank("/batch/gpg", POST={
+            'token': token or self.token,
+            'manifest': json.dumps(files)})
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        return req.get_response(self.server)
+
+    def get_status(self, batch_id):
+        req = webob.Request.blank("/batch/%s?wait=1" % batch_id)
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        return req.get_response(self.server)
+
+    def testBatch(self):
+        data = 'x' * 200
+        have = hashlib.sha1(data).hexdigest()
+        open(os.path.join(self.server.unsigned_dir, have), 'wb').write(data)
+        signed = 'a' * 40
+        fn = self.server.get_path(signed, 'gpg')
+        os.makedirs(os.path.dirname(fn))
+        open(fn, 'wb').write('signed')
+        self.server.cache.add(signed, 'gpg', 'digest', 6)
+        failed = 'b' * 40
+        self.server.failed[failed, 'gpg'] = time.time()
+        missing = 'c' * 40
+
+        resp = self.start_batch([(have, 'have.exe'), (signed, 'signed.exe'),
+                                 (failed, 'failed.exe'), (missing, 'missing.exe')])
+        self.assertEquals(resp.status_code, 200)
+        result = json.loads(resp.body)
+        self.assertEquals(sorted(result['missing']), [failed, missing])
+        self.server.signer.signfiles.assert_called_once_with(
+            [(have, 'have.exe', 'gpg')])
+        self.assertEquals(self.server.get_filename(have), 'have.exe')
+
+        resp = self.get_status(result['batch'])
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(json.loads(resp.body)['files'], {
+            have: {'status': 'pending'},
+            signed: {'status': 'done', 'digest': 'digest'},
+            failed: {'status': 'error'},
+            missing: {'status': 'missing'},
+        })
+
+    def testBadToken(self):
+        resp = self.start_batch([('a' * 40, 'a.exe')], token='bad!token')
+        self.assertEquals(resp.status_code, 400)
+        self.assertEquals(self.server.batches, {})
+
+    def testBadHash(self):
+        victim = os.path.join(self.tmpdir, 'victim')
+        open(victim, 'wb').write('x')
+        resp = self.start_batch([('../victim', 'a.exe')])
+        self.assertEquals(resp.status_code, 400)
+        self.assertTrue(os.path.exists(victim))
+        self.assertEquals(self.server.batches, {})
+        resp = self.start_batch([('A' * 40, 'a.exe')])
+        self.assertEquals(resp.status_code, 400)
+
+    def testUnknownBatch(self):
+        self.assertEquals(self.get_status('nope').status_code, 404)
+
+    def testBatchExpires(self):
+        batch_id = json.loads(self.start_batch([('a' * 40, 'a.exe')]).body)['batch']
+        self.assertEquals(self.get_status(batch_id).status_code, 200)
+        self.server.batches[batch_id] = self.server.batches[batch_id][:2] + (0,)
+        self.server.cleanup()
+        self.assertEquals(self.get_status(batch_id).status_code, 404)
@@ -0,0 +1,101 @@
+from unittest import TestCase
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+
+from signing.verify import check_repack, scan_package
+from mozilla_buildtools.test.test_util_archives import make_mar
+
+
+class TestCheckRepack(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.unsigned = os.path.join(self.tmpdir, "unsigned.mar")
+        self.signed = os.path.join(self.tmpdir, "signed.mar")
+        self.files = [
+            ("update.manifest", "a\nb\n", 0644),
+            ("firefox.exe", "binary", 0755),
+            ("dir/data.txt", "data" * 10000, 0644),
+        ]
+        make_mar(self.unsigned, self.files)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeSigned(self, changes={}):
+        files = [(name, changes.get(name, data), flags)
+                 for name, data, flags in self.files]
+        make_mar(self.signed, files)
+
+    def testScanPackage(self):
+        destdir = os.path.join(self.tmpdir, "out")
+        os.mkdir(destdir)
+        contents = scan_package(self.unsigned, destdir,
+                                extract=lambda name: name.endswith(".exe"))
+        self.assertEquals(contents.files["dir/data.txt"],
+                          (0644, hashlib.sha1("data" * 10000).hexdigest()))
+        self.assertEquals(contents.dirs, {"dir": None})
+        self.assertEquals(os.listdir(destdir), ["firefox.exe"])
+        self.assertEquals(
+            open(os.path.join(destdir, "firefox.exe")).read(), "binary")
+
+    def testSame(self):
+        self.makeSigned()
+        self.assertEquals(check_repack(self.unsigned, self.signed, {},
+                                       fake_signatures=True),
+                          (True, "OK"))
+
+    def testManifestOrder(self):
+        self.makeSigned({"update.manifest": "b\na\n"})
+        self.assertEquals(check_repack(self.unsigned, self.signed, {},
+                                       fake_signatures=True),
+                          (True, "OK"))
+
+    def testDiffers(self):
+        self.makeSigned({"dir/data.txt": "different"})
+        self.assertEquals(check_repack(self.unsigned, self.signed, {},
+                                       fake_signatures=True),
+                          (False, "sha1sum on dir/data.txt differs"))
+
+    def testModeDiffers(self):
+        self.files[1] = ("firefox.exe", "binary", 0644)
+        make_mar(self.signed, self.files)
+        self.files[1] = ("firefox.exe", "binary", 0755)
+        make_mar(self.unsigned, self.files)
+        self.assertEquals(check_repack(self.unsigned, self.signed, {},
+                                       fake_signatures=True),
+                          (False, "Mode mismatch (755 != 644) in firefox.exe"))
+
+    def testMissingFile(self):
+        make_mar(self.signed, self.files[:2])
+        result, msg = check_repack(self.unsigned, self.signed, {},
+                                   fake_signatures=True)
+        self.assertFalse(result)
+        self.assertTrue(msg.startswith("List of files differs"))
+
+    def testVerifiedDigests(self):
+        # Binaries that have been verified already (e.g. in the installer
+        # for the same locale) don't need to be checked again
+        self.makeSigned({"firefox.exe": "signed binary"})
+        checksums = {}
+        digest = hashlib.sha1("signed binary").hexdigest()
+        self.assertEquals(check_repack(self.unsigned, self.signed, checksums,
+                                       verified_digests=set([digest])),
+                          (True, "OK"))
+        self.assertEquals(checksums, {"firefox.exe": digest})
+
+    def testTar(self):
+        srcdir = os.path.join(self.tmpdir, "src")
+        os.makedirs(os.path.join(srcdir, "dir"))
+        open(os.path.join(srcdir, "dir", "a"), "w").write("hello")
+        for name in "unsigned.tar", "signed.tar":
+            tar = tarfile.open(os.path.join(self.tmpdir, name), "w:gz")
+            tar.add(os.path.join(srcdir, "dir"), "dir")
+            tar.close()
+        self.assertEquals(
+            check_repack(os.path.join(self.tmpdir, "unsigned.tar"),
+                         os.path.join(self.tmpdir, "signed.tar"), {},
+                         fake_signatures=True),
+            (True, "OK"))
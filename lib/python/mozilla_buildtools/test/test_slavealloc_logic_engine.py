@@ -0,0 +1,139 @@
+import random
+import unittest
+
+from slavealloc import exceptions
+from slavealloc.data import model, versions
+from slavealloc.data.setup import setup as setup_db
+from slavealloc.logic import allocate, engine
+
+
+class TestAllocationModel(unittest.TestCase):
+    def setUp(self):
+        setup_db("sqlite://")
+        model.metadata.drop_all()
+        model.metadata.create_all()
+        self.rand = random.Random(1)
+        self.populate()
+
+    def tearDown(self):
+        model.metadata.drop_all()
+        model.metadata.bind = None
+
+    def populate(self):
+        for tbl in (model.distros, model.bitlengths, model.speeds,
+                    model.purposes, model.datacenters, model.trustlevels,
+                    model.environments, model.pools):
+            tbl.insert().execute([dict(name='%s%d' % (tbl.name, i))
+                                  for i in range(1, 3)])
+        model.slave_passwords.insert().execute(
+            poolid=1, distroid=None, password='pw1')
+        model.slave_passwords.insert().execute(
+            poolid=2, distroid=2, password='pw2')
+        model.tac_templates.insert().execute(
+            tplid=1, name='custom', template='tac')
+
+        masters = []
+        for i in range(1, 9):
+            masters.append(dict(
+                masterid=i, nickname='master%d' % i, fqdn='m%d.example' % i,
+                http_port=8000 + i, pb_port=9000 + i, dcid=1 + i % 2,
+                poolid=1 + i % 2, enabled=(i != 3)))
+        model.masters.insert().execute(masters)
+
+        r = self.rand
+        slaves = []
+        for i in range(1, 301):
+            slaves.append(dict(
+                slaveid=i, name='slave%d' % i, distroid=r.randint(1, 2),
+                bitsid=1, speedid=r.randint(1, 2), purposeid=r.randint(1, 2),
+                dcid=1, trustid=1, envid=r.randint(1, 2),
+                poolid=r.randint(1, 2), basedir='/builds',
+                locked_masterid=(r.choice([2, 4]) if i % 50 == 0 else None),
+                custom_tplid=(1 if i % 70 == 0 else None),
+                enabled=(i % 30 != 0),
+                current_masterid=r.choice([None, None, 1, 2, 3, 4, 5])))
+        model.slaves.insert().execute(slaves)
+
+    def loadModel(self):
+        m = engine.AllocationModel()
+        m.load_data(engine.fetch_all())
+        return m
+
+    def testMatchesQueries(self):
+        m = self.loadModel()
+        names = ['slave%d' % i for i in range(1, 301)] * 2
+        self.rand.shuffle(names)
+        for name in names:
+            try:
+                expected = allocate.Allocation(name)
+            except exceptions.NoAllocationError:
+                expected = None
+            try:
+                got = m.allocate(name)
+            except exceptions.NoAllocationError:
+                got = None
+            self.assertEquals(expected is None, got is None, name)
+            if not expected:
+                continue
+            self.assertEquals(expected.enabled, got.enabled, name)
+            if not expected.enabled:
+                continue
+            self.assertEquals(
+                (expected.masterid, expected.slave_password,
+                 expected.template),
+                (got.masterid, got.slave_password, got.template), name)
+            expected.commit()
+            got.commit()
+
+        # Everything that was allocated is waiting to be written
+        changes = m.start_write()
+        engine.write_current_masters(changes)
+        m.finish_write(True)
+        for row in model.slaves.select().execute():
+            self.assertEquals(
+                m.slaves[row.slaveid]['current_masterid'],
+                row.current_masterid)
+
+    def testFetchChanges(self):
+        m = self.loadModel()
+        version = m.version
+        self.assertEquals(engine.fetch_changes(version)['slaves'], [])
+
+        engine.write_current_masters({5: 2, 6: 4})
+        data = engine.fetch_changes(version)
+        self.assertFalse(data['full'])
+        self.assertEquals(sorted(s['slaveid'] for s in data['slaves']),
+                          [5, 6])
+        self.assertEquals(data['masters'], [])
+        m.load_data(data)
+        self.assertEquals(m.version, data['version'])
+        self.assertEquals(m.slaves[5]['current_masterid'], 2)
+        self.assertEquals(m.slaves[6]['current_masterid'], 4)
+
+        # Incremental updates keep the counts the same as a full load
+        full = self.loadModel()
+        self.assertEquals(m.load, full.load)
+
+        # After a reset, everything is fetched
+        versions.record_reset(model.metadata.bind)
+        data = engine.fetch_changes(m.version)
+        self.assertTrue(data['full'])
+        self.assertEquals(len(data['slaves']), 300)
+        self.assertTrue(engine.fetch_changes(None)['full'])
+
+    def testMasterChanges(self):
+        m = self.loadModel()
+        conn = model.metadata.bind.connect()
+        model.masters.update(model.masters.c.masterid == 1).execute(
+            enabled=False)
+        versions.record_changes(conn, 'masters', [1])
+        conn.close()
+        m.load_data(engine.fetch_changes(m.version))
+        self.assertFalse(m.masters[1]['enabled'])
+        self.assertFalse(
+            [mm for mm in m.masters_by_pool[2] if mm['enabled'] and
+             mm['masterid'] == 1])
+        slave = [s for s in m.slaves.itervalues()
+                 if s['poolid'] == 2 and s['enabled'] and
+                 not s['locked_masterid']][0]
+        self.assertNotEquals(m.best_master(slave)['masterid'], 1)
@@ -2,8 +2,28 @@ from unittest import TestCase
 import subprocess
 import shutil
 import tempfile
+import struct
+import bz2
 
-from util.archives import bzip2, bunzip2
+from util.archives import bzip2, bunzip2, read_mar_index, iter_mar_member
+
+
+def make_mar(marfile, files):
+    """Writes out a mar file containing `files`, a list of (name, data,
+    flags). Each member's data is compressed with bz2."""
+    data = ""
+    index = ""
+    offset = 20
+    for name, contents, flags in files:
+        contents = bz2.compress(contents)
+        index += struct.pack(">LLL", offset + len(data), len(contents),
+                             flags) + name + "\0"
+        data += contents
+    index_offset = offset + len(data)
+    size = index_offset + 4 + len(index)
+    open(marfile, 'wb').write(
+        "MAR1" + struct.pack(">LQL", index_offset, size, 0) + data +
+        struct.pack(">L", len(index)) + index)
 
 
 class TestSigningUtils(TestCase):
@@ -22,3 +42,15 @@ class TestSigningUtils(TestCase):
 
         bunzip2(fn)
         self.assertEquals("hello", open(fn, 'rb').read())
+
+    def testMarMembers(self):
+        fn = "%s/foo.mar" % self.tmpdir
+        make_mar(fn, [("a/b", "hello", 0644), ("c", "x" * 100000, 0755)])
+        members = read_mar_index(fn)
+        self.assertEquals([(m[0], m[3]) for m in members],
+                          [("a/b", 0644), ("c", 0755)])
+        for (name, offset, size, flags), expected in zip(
+                members, ["hello", "x" * 100000]):
+            self.assertEquals(
+                "".join(iter_mar_member(fn, offset, size, blocksize=10)),
+                expected)
@@ -1,7 +1,10 @@
 import unittest
 import subprocess
+import os
+import time
 
-from util.commands import run_cmd, get_output, run_cmd_periodic_poll
+from util.commands import run_cmd, get_output, run_cmd_periodic_poll, \
+    supervise
 
 
 class TestRunCmd(unittest.TestCase):
@@ -85,3 +88,36 @@ class TestRunCmdiPeriodicPoll(unittest.TestCase):
             ['bash', '-c', 'sleep 5 && false'], warning_interval=2,
             warning_callback=callback)
         self.assertEqual(self.callback_called, 2)
+
+
+class TestSupervise(unittest.TestCase):
+    def testTimes(self):
+        proc = subprocess.Popen(['bash', '-c', 'sleep 1; exit 3'])
+        watcher = supervise(proc)
+        self.assertEquals(proc.returncode, 3)
+        self.assertFalse(watcher.timed_out)
+        self.assertTrue(watcher.wall_time >= 1)
+        self.assertTrue(watcher.cpu_time is not None)
+
+    def testTimeout(self):
+        # The child ignores SIGINT and SIGTERM, and leaves a grandchild
+        # behind, so they both need to be killed
+        proc = subprocess.Popen(
+            ['bash', '-c', 'trap "" INT TERM; sleep 60 & wait'],
+            preexec_fn=os.setsid)
+        start = time.time()
+        watcher = supervise(proc, timeout=1, kill_group=True, kill_grace=0.5)
+        self.assertTrue(watcher.timed_out)
+        self.assertEquals(proc.returncode, -9)
+        self.assertTrue(time.time() - start < 10)
+        self.assertRaises(OSError, os.kill, -proc.pid, 0)
+
+    def testWarningInterval(self):
+        calls = []
+
+        def callback(start_time, elapsed, proc):
+            calls.append(elapsed)
+
+        supervise(subprocess.Popen(['sleep', '1.2']), warning_interval=0.5,
+                  warning_callback=callback)
+        self.assertEquals(len(calls), 2)
@@ -11,6 +11,7 @@ from util.hg import clone, pull, update, hg_ver, mercurial, _make_absolute, \
     get_hg_output
 from util.file import touch
 from util.commands import run_cmd, get_output
+from util import hgcmdserver
 
 from mock import patch
 
@@ -1169,3 +1170,60 @@ class TestHg(unittest.TestCase):
             self.assertRaises(subprocess.CalledProcessError,
                               clone, "http://nxdomain.nxnx", self.wc)
             self.assertEquals(num_calls, [2])
+
+
+class TestHgCmdServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repodir = os.path.join(self.tmpdir, 'repo')
+        run_cmd(['%s/init_hgrepo.sh' % os.path.dirname(__file__),
+                self.repodir])
+        self.revisions = getRevisions(self.repodir)
+        self.wc = os.path.join(self.tmpdir, 'wc')
+        os.environ['HGRCPATH'] = os.path.join(os.path.dirname(__file__), "hgrc")
+        hg.use_cmdserver(True)
+
+    def tearDown(self):
+        hg.use_cmdserver(False)
+        hgcmdserver.close_all()
+        shutil.rmtree(self.tmpdir)
+
+    def testUsesServer(self):
+        clone(self.repodir, self.wc, update_dest=False)
+        rev = update(self.wc, revision=self.revisions[1])
+        self.assertEquals(rev, self.revisions[1])
+        self.assertEquals(hg.get_revision(self.wc), self.revisions[1])
+        server = hgcmdserver.get_server(self.wc)
+        self.assertTrue(server)
+        self.assertTrue(
+            os.path.realpath(self.wc) in hgcmdserver._servers)
+        # The same server gets used again
+        self.assertTrue(hgcmdserver.get_server(self.wc) is server)
+
+    def testErrors(self):
+        clone(self.repodir, self.wc)
+        self.assertRaises(subprocess.CalledProcessError,
+                          update, self.wc, revision='nonexistent')
+
+    def testConfigChanges(self):
+        clone(self.repodir, self.wc)
+        self.assertEquals(path(self.wc), self.repodir)
+        adjust_paths(self.wc, default='http://example.com/repo')
+        self.assertEquals(path(self.wc), 'http://example.com/repo')
+
+    def testRecloned(self):
+        clone(self.repodir, self.wc)
+        self.assertEquals(get_hg_output(['branch'], cwd=self.wc).strip(),
+                          'default')
+        shutil.rmtree(self.wc)
+        clone(self.repodir, self.wc, branch='branch2')
+        self.assertEquals(get_branch(self.wc), 'branch2')
+
+    def testServerDies(self):
+        clone(self.repodir, self.wc)
+        server = hgcmdserver.get_server(self.wc)
+        server.proc.kill()
+        server.proc.wait()
+        # A new one is started
+        self.assertEquals(get_branch(self.wc), 'default')
+        self.assertFalse(hgcmdserver.get_server(self.wc) is server)
@@ -0,0 +1,77 @@
+import unittest
+import tempfile
+import shutil
+import os
+import time
+
+from util import mirrors
+from util.mirrors import MirrorStats, order_mirrors, record_failure
+
+
+class TestMirrors(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stats_file = os.path.join(self.tmpdir, 'stats.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testFailuresDecay(self):
+        stats = MirrorStats(self.stats_file)
+        now = time.time()
+        stats.record('http://m1', failed=True, now=now)
+        stats.record('http://m1', failed=True, now=now)
+        self.assertAlmostEquals(stats.failures('http://m1', now), 2)
+        self.assertAlmostEquals(
+            stats.failures('http://m1', now + mirrors.FAILURE_HALF_LIFE), 1)
+
+    def testScore(self):
+        stats = MirrorStats(self.stats_file)
+        stats.record('http://m1', latency=1)
+        stats.record('http://m2', latency=0.5)
+        self.assertTrue(stats.score('http://m2') < stats.score('http://m1'))
+        stats.record('http://m2', failed=True)
+        stats.record('http://m2', failed=True)
+        self.assertTrue(stats.score('http://m2') > stats.score('http://m1'))
+
+    def testSaveLoad(self):
+        stats = MirrorStats(self.stats_file)
+        stats.record('http://m1', latency=1)
+        stats.save()
+        self.assertEquals(MirrorStats(self.stats_file).score('http://m1'), 1)
+
+    def testOrder(self):
+        latencies = {'http://m1': 0.3, 'http://m2': 0.1, 'http://m3': 0.2}
+
+        def probe(mirror, timeout):
+            return latencies[mirror]
+        self.assertEquals(
+            order_mirrors(['http://m1', 'http://m2', 'http://m3'], probe,
+                          self.stats_file),
+            ['http://m2', 'http://m3', 'http://m1'])
+
+    def testOrderFailedProbe(self):
+        def probe(mirror, timeout):
+            if mirror == 'http://m1':
+                raise IOError("down")
+            return 1
+        self.assertEquals(
+            order_mirrors(['http://m1', 'http://m2'], probe, self.stats_file),
+            ['http://m2', 'http://m1'])
+
+    def testOrderFailureHistory(self):
+        record_failure('http://m1', self.stats_file)
+        record_failure('http://m1', self.stats_file)
+        self.assertEquals(
+            order_mirrors(['http://m1', 'http://m2'], lambda m, timeout: 0.1,
+                          self.stats_file),
+            ['http://m2', 'http://m1'])
+
+    def testLocalMirrorsNotReordered(self):
+        def probe(mirror, timeout):
+            raise AssertionError("shouldn't probe")
+        self.assertEquals(
+            order_mirrors(['/b', 'http://a'], probe, self.stats_file),
+            ['/b', 'http://a'])
+        record_failure('/b', self.stats_file)
+        self.assertFalse(os.path.exists(self.stats_file))
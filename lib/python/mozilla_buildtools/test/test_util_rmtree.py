@@ -0,0 +1,129 @@
+import unittest
+import tempfile
+import shutil
+import os
+import time
+import errno
+
+import mock
+
+from util import rmtree as rmtree_module
+from util.rmtree import rmtree, TreeRemover
+
+
+class TestRmtree(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for root, dirs, files in os.walk(self.tmpdir):
+            os.chmod(root, 0700)
+        shutil.rmtree(self.tmpdir)
+
+    def makeTree(self, root, depth=3, width=3, files=5):
+        os.makedirs(root)
+        count = 0
+        for i in range(files):
+            open(os.path.join(root, "f%i" % i), "w").write("x")
+            count += 1
+        if depth:
+            for i in range(width):
+                count += self.makeTree(os.path.join(root, "d%i" % i),
+                                       depth - 1, width, files)
+        return count
+
+    def testRemoveTree(self):
+        d = os.path.join(self.tmpdir, "tree")
+        self.makeTree(d)
+        rmtree(d)
+        self.assertFalse(os.path.exists(d))
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+    def testSingleThread(self):
+        d = os.path.join(self.tmpdir, "tree")
+        self.makeTree(d)
+        rmtree(d, threads=1)
+        self.assertFalse(os.path.exists(d))
+
+    def testReadOnly(self):
+        d = os.path.join(self.tmpdir, "tree")
+        self.makeTree(d, depth=2)
+        os.chmod(os.path.join(d, "f0"), 0400)
+        os.chmod(os.path.join(d, "d0"), 0500)
+        os.chmod(os.path.join(d, "d1"), 0)
+        rmtree(d)
+        self.assertFalse(os.path.exists(d))
+
+    def testSymlinks(self):
+        d = os.path.join(self.tmpdir, "tree")
+        other = os.path.join(self.tmpdir, "other")
+        self.makeTree(d, depth=1)
+        self.makeTree(other, depth=1)
+        os.symlink(other, os.path.join(d, "link"))
+        os.symlink(os.path.join(self.tmpdir, "missing"),
+                   os.path.join(d, "broken"))
+        rmtree(d)
+        self.assertFalse(os.path.exists(d))
+        # Links aren't followed
+        self.assertTrue(os.path.exists(os.path.join(other, "d0", "f0")))
+
+        link = os.path.join(self.tmpdir, "link")
+        os.symlink(other, link)
+        rmtree(link)
+        self.assertFalse(os.path.lexists(link))
+        self.assertTrue(os.path.exists(other))
+
+    def testFileAndMissing(self):
+        f = os.path.join(self.tmpdir, "file")
+        open(f, "w").write("x")
+        rmtree(f)
+        self.assertFalse(os.path.exists(f))
+        rmtree(f)
+
+    def testThrottle(self):
+        d = os.path.join(self.tmpdir, "tree")
+        count = self.makeTree(d, depth=2)
+        calls = []
+        TreeRemover(threads=4, throttle=lambda: calls.append(1)).remove(d)
+        self.assertFalse(os.path.exists(d))
+        self.assertEquals(len(calls), count)
+
+    def testBackground(self):
+        d = os.path.join(self.tmpdir, "tree")
+        self.makeTree(d)
+        trash = rmtree(d, background=True)
+        self.assertFalse(os.path.exists(d))
+        self.assertEquals(os.path.dirname(trash), self.tmpdir)
+        for i in range(100):
+            if not os.path.exists(trash):
+                break
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(trash))
+
+    def testTrailingSlash(self):
+        d = os.path.join(self.tmpdir, "tree")
+        self.makeTree(d, depth=1)
+        rmtree(d + "/")
+        self.assertFalse(os.path.exists(d))
+
+    def testFixPermsStaysInTree(self):
+        d = os.path.join(self.tmpdir, "tree")
+        self.makeTree(d, depth=1)
+        os.chmod(self.tmpdir, 0755)
+        os.chmod(d, 0755)
+        os.chmod(os.path.join(d, "d0"), 0500)
+        rmtree_module._fix_perms(d, d)
+        rmtree_module._fix_perms(os.path.join(d, "d0", "f0"), d)
+        self.assertEquals(os.stat(self.tmpdir).st_mode & 0777, 0755)
+        self.assertEquals(os.stat(d).st_mode & 0777, 0700)
+        self.assertEquals(os.stat(os.path.join(d, "d0")).st_mode & 0777,
+                          0700)
+
+    def testListdirRetriesOnce(self):
+        d = os.path.join(self.tmpdir, "tree")
+        self.makeTree(d, depth=1)
+        denied = OSError(errno.EACCES, "Permission denied")
+        with mock.patch.object(rmtree_module, "scandir", None):
+            with mock.patch("os.listdir", side_effect=denied) as listdir:
+                self.assertRaises(OSError, rmtree, d)
+                self.assertEquals(listdir.call_count, 2)
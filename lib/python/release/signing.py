@@ -1,8 +1,102 @@
 import os
+import hashlib
+import heapq
+from multiprocessing.pool import ThreadPool
 from util.commands import run_cmd
 
 
-def generateChecksums(checksums_dir, sums_info):
+def findChecksumsFiles(checksums_dir):
+    """Returns the paths of all *.checksums files under checksums_dir"""
+    for top, dirs, files in os.walk(checksums_dir):
+        for f in files:
+            if f.endswith('.checksums'):
+                yield os.path.join(top, f)
+
+
+def readChecksumsFile(filename, hash_types):
+    """
+    Reads a .checksums file, returning a dict of hash type to a sorted list
+    of unique (file_name, hash, size) entries for each of hash_types.
+    """
+    entries = dict((hash_type, set()) for hash_type in hash_types)
+    for line in open(filename):
+        line = line.rstrip()
+        try:
+            hash, hash_type, size, file_name = line.split(None, 3)
+        except ValueError:
+            print "Failed to parse the following line:"
+            print line
+            raise
+        if hash_type in entries:
+            entries[hash_type].add((file_name, hash, size))
+    return dict((hash_type, sorted(e)) for hash_type, e in entries.items())
+
+
+def mergeChecksums(runs):
+    """Merges sorted lists of entries, yielding each unique entry once, in
+    order"""
+    last = None
+    for entry in heapq.merge(*runs):
+        if entry != last:
+            yield entry
+            last = entry
+
+
+def verifyFile(filename, hashes, size):
+    """
+    Checks that filename is size bytes long and has the given hashes, which
+    is a dict of hash type to hex digest. Returns a list of problems found.
+    """
+    try:
+        actual_size = os.path.getsize(filename)
+    except OSError:
+        return ['%s is missing' % filename]
+    if str(actual_size) != size:
+        return ['%s is %s bytes, expected %s' % (filename, actual_size, size)]
+
+    digests = dict((h, hashlib.new(h)) for h in hashes)
+    fd = open(filename, 'rb')
+    while True:
+        block = fd.read(1024 * 1024)
+        if not block:
+            break
+        for d in digests.values():
+            d.update(block)
+    fd.close()
+
+    errors = []
+    for hash_type, expected in sorted(hashes.items()):
+        actual = digests[hash_type].hexdigest()
+        if actual != expected:
+            errors.append('%s has %s %s, expected %s' % (
+                filename, hash_type, actual, expected))
+    return errors
+
+
+def verifyChecksums(files_dir, entries, threads=4):
+    """
+    Verifies the sizes and hashes of files under files_dir concurrently.
+
+    @type  entries: dict
+    @param entries: A dictionary of file name to (size, hashes) where hashes
+                    is a dict of hash type to hex digest.
+
+    @return: a list of problems found
+    """
+    def verify(item):
+        file_name, (size, hashes) = item
+        return verifyFile(os.path.join(files_dir, file_name), hashes, size)
+
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(verify, sorted(entries.items()), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return [e for errors in results for e in errors]
+
+
+def generateChecksums(checksums_dir, sums_info, threads=4, verify_dir=None):
     """
     Generates {MD5,SHA1,etc}SUMS files using *.checksums files.
 
@@ -13,29 +107,42 @@ def generateChecksums(checksums_dir, sums_info):
     @param sums_info: A dictionary which contains hash type and output file
                       pairs. Example: {'sha1': '/tmp/SHA1SUMS',
                                        'md5': '/tmp/MD5SUMS'}
+
+    @type  threads: int
+    @param threads: How many *.checksums files to read, or files to verify,
+                    at once
+
+    @type  verify_dir: string
+    @param verify_dir: If set, the directory containing the files listed in
+                       the *.checksums files. Their sizes and hashes are
+                       checked before any SUMS files are written, and
+                       ValueError is raised if any are wrong.
     """
-    sums = {}
-    for hash_type in sums_info.keys():
-        sums[hash_type] = []
-    for top, dirs, files in os.walk(checksums_dir):
-        files = [f for f in files if f.endswith('.checksums')]
-        for f in files:
-            fd = open(os.path.join(top, f))
-            for line in fd:
-                line = line.rstrip()
-                try:
-                    hash, hash_type, size, file_name = line.split(None, 3)
-                except ValueError:
-                    print "Failed to parse the following line:"
-                    print line
-                    raise
-                entry = (hash, file_name)
-                if hash_type in sums and entry not in sums[hash_type]:
-                    sums[hash_type].append(entry)
-    for hash_type in sums_info.keys():
+    hash_types = sums_info.keys()
+    pool = ThreadPool(threads)
+    try:
+        runs = pool.map(lambda f: readChecksumsFile(f, hash_types),
+                        findChecksumsFiles(checksums_dir), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    if verify_dir:
+        entries = {}
+        for run in runs:
+            for hash_type, run_entries in run.items():
+                for file_name, hash, size in run_entries:
+                    entries.setdefault(file_name, (size, {}))[1][hash_type] = hash
+        errors = verifyChecksums(verify_dir, entries, threads)
+        if errors:
+            for e in errors:
+                print e
+            raise ValueError("%i checksums failed to verify" % len(errors))
+
+    for hash_type in hash_types:
         sums_file = open(sums_info[hash_type], 'w')
-        # sort by file name
-        for hash, file_name in sorted(sums[hash_type], key=lambda x: x[1]):
+        # sorted by file name
+        for file_name, hash, size in mergeChecksums(r[hash_type] for r in runs):
             sums_file.write('%s  %s\n' % (hash, file_name))
         sums_file.close()
 
@@ -0,0 +1,680 @@
+"""Runs update verification for an UpdateVerifyConfig in parallel.
+
+This does what release/updates/verify.sh -c does, but rather than working
+through one locale of one release at a time, each test (a release, locale
+and patch type) goes through a pipeline of stages: downloading update.xml,
+the MAR and the builds on a pool of download threads, and then unpacking the
+builds, applying the MAR and comparing the result on a pool of worker
+threads. Builds and MARs are kept in a content-addressed DownloadCache, which
+can be shared by several runs at once (e.g. chunks running on the same
+machine), and each target build is only unpacked once per locale.
+
+Builds are unpacked using unpack_build from release/common/unpack.sh, so
+that they're set up exactly as verify.sh would.
+"""
+import os
+import sys
+import re
+import glob
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+import urllib2
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE, STDOUT
+from xml.etree import ElementTree
+
+from util.retry import retry
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_COMMON_DIR = os.path.join(os.path.dirname(__file__),
+                                  "../../../../release/common")
+DEFAULT_FTP_SERVER = "http://stage.mozilla.org/pub/mozilla.org"
+
+MAC_PLATFORMS = ("Darwin_ppc-gcc", "Darwin_Universal-gcc3",
+                 "Darwin_x86_64-gcc3", "Darwin_x86-gcc3-u-ppc-i386",
+                 "Darwin_x86-gcc3-u-i386-x86_64",
+                 "Darwin_x86_64-gcc3-u-i386-x86_64")
+WIN_PLATFORMS = ("WINNT_x86-msvc",)
+LINUX_PLATFORMS = ("Linux_x86-gcc", "Linux_x86-gcc3", "Linux_x86_64-gcc3")
+
+
+def platform_info(platform, product):
+    """Returns (the name of the application directory in an unpacked build,
+    the updater's path within it, a regexp matching diff's complaints about
+    binary files) for `platform`"""
+    if platform in MAC_PLATFORMS:
+        return "*.app", "Contents/MacOS/updater.app/Contents/MacOS/updater", \
+            "^Binary files"
+    elif platform in WIN_PLATFORMS:
+        return "bin", "updater.exe", "^Files.*and.*differ$"
+    elif platform in LINUX_PLATFORMS:
+        return product.lower(), "updater", "^Binary files"
+    raise ValueError("Unknown platform %s" % platform)
+
+
+def use_old_updater(product, release):
+    """The arguments for the updater changed in Gecko 34/SeaMonkey 2.31"""
+    parts = [int(p) for p in re.findall(r"\d+", release)[:2]] + [0, 0]
+    if product == "seamonkey":
+        return parts[0] <= 2 and parts[1] < 31
+    return parts[0] < 34
+
+
+def _makedirs(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _hash_file(filename, hash_function):
+    h = hashlib.new(hash_function)
+    f = open(filename, 'rb')
+    try:
+        while True:
+            block = f.read(512 * 1024)
+            if not block:
+                break
+            h.update(block)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+class _Once(object):
+    """Calls functions only once per key. Anyone else asking for the same key
+    at the same time waits for the first call to finish, and gets the same
+    result (or exception)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def __call__(self, key, func, *args):
+        with self.lock:
+            entry = self.results.get(key)
+            first = entry is None
+            if first:
+                # done, result, exc_info
+                entry = self.results[key] = [threading.Event(), None, None]
+        if first:
+            try:
+                entry[1] = func(*args)
+            except Exception:
+                entry[2] = sys.exc_info()
+            finally:
+                entry[0].set()
+        else:
+            entry[0].wait()
+        if entry[2]:
+            raise entry[2][0], entry[2][1], entry[2][2]
+        return entry[1]
+
+
+class DownloadCache(object):
+    """
+    A store of downloaded files under `cache_dir`, named by the sha512 of
+    their contents, along with an index from URLs to them.
+
+    Several processes can use the same cache at once: files are downloaded
+    to a temporary name and renamed into place, and copies of a file are
+    hard links to it where possible, so cached files are read-only.
+
+    prune() keeps the cache from growing without bound: it removes files
+    that haven't been used in `max_age` seconds, and then the least recently
+    used ones until the cache is no bigger than `max_size` bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=None, max_age=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.objects_dir = os.path.join(self.cache_dir, "objects")
+        self.urls_dir = os.path.join(self.cache_dir, "urls")
+        _makedirs(self.objects_dir)
+        _makedirs(self.urls_dir)
+        self._once = _Once()
+
+    def _url_index(self, url):
+        return os.path.join(self.urls_dir, hashlib.sha1(url).hexdigest())
+
+    def _object(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def lookup(self, url, sha512=None):
+        """Returns the name of the cached copy of `url`, or of the file
+        whose sha512 is `sha512`, or None if we don't have one. If `sha512` is
+        set, the cached copy of `url` is only used if it matches."""
+        if sha512:
+            digest = sha512
+        else:
+            try:
+                digest = open(self._url_index(url)).read().strip()
+            except IOError:
+                return None
+        obj = self._object(digest)
+        try:
+            # Mark it as used for prune(); atime can't be relied on with
+            # noatime or relatime mounts
+            os.utime(obj, None)
+        except OSError:
+            return None
+        return obj
+
+    def _download(self, url):
+        log.debug("Downloading %s", url)
+        fd, tmpname = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp")
+        output = os.fdopen(fd, 'wb')
+        try:
+            h = hashlib.sha512()
+            resp = urllib2.urlopen(url, timeout=300)
+            try:
+                while True:
+                    block = resp.read(512 * 1024)
+                    if not block:
+                        break
+                    h.update(block)
+                    output.write(block)
+            finally:
+                resp.close()
+            output.close()
+            os.chmod(tmpname, 0444)
+            obj = self._object(h.hexdigest())
+            os.rename(tmpname, obj)
+        except:
+            output.close()
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+
+        fd, tmpname = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp")
+        os.write(fd, h.hexdigest() + "\n")
+        os.close(fd)
+        os.rename(tmpname, self._url_index(url))
+        return obj
+
+    def _download_retrying(self, url):
+        return retry(self._download, attempts=3, sleeptime=1, args=(url,))
+
+    def get(self, url, sha512=None):
+        """Returns the name of the cached copy of `url`, downloading it if
+        necessary"""
+        cached = self.lookup(url, sha512)
+        if cached:
+            log.debug("Using cached %s", url)
+            return cached
+        return self._once((url, sha512), self._download_retrying, url)
+
+    def _copy(self, obj, dest):
+        try:
+            os.link(obj, dest)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                raise
+            shutil.copyfile(obj, dest)
+
+    def fetch(self, url, dest, sha512=None):
+        """Makes `dest` a copy of `url`, which comes from the cache if it can"""
+        obj = self.get(url, sha512)
+        if os.path.exists(dest):
+            os.unlink(dest)
+        try:
+            self._copy(obj, dest)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Pruned by another run sharing the cache since we looked it up
+            log.debug("%s went away, downloading %s again", obj, url)
+            self._copy(self._download_retrying(url), dest)
+        return dest
+
+    def prune(self):
+        """Removes files from the cache until it's within max_age and
+        max_size. Returns the number of files removed."""
+        if self.max_size is None and self.max_age is None:
+            return 0
+        now = time.time()
+        objects = []
+        for name in os.listdir(self.objects_dir):
+            try:
+                st = os.stat(self._object(name))
+            except OSError:
+                continue
+            objects.append((max(st.st_atime, st.st_mtime), st.st_size, name))
+        objects.sort()
+
+        total = sum(size for _, size, _ in objects)
+        removed = 0
+        for used, size, name in objects:
+            if not (self.max_age is not None and now - used > self.max_age or
+                    self.max_size is not None and total > self.max_size):
+                break
+            try:
+                os.unlink(self._object(name))
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        if removed:
+            # Drop URLs whose files are gone
+            for name in os.listdir(self.urls_dir):
+                index = os.path.join(self.urls_dir, name)
+                try:
+                    digest = open(index).read().strip()
+                except IOError:
+                    continue
+                if not os.path.exists(self._object(digest)):
+                    try:
+                        os.unlink(index)
+                    except OSError:
+                        pass
+        log.info("Removed %i files from %s, %i bytes left", removed,
+                 self.cache_dir, total)
+        return removed
+
+
+class UpdateTest(object):
+    """One locale of one release in an UpdateVerifyConfig, being updated with
+    one type of patch"""
+
+    def __init__(self, index, release, locale, patch_type):
+        self.index = index
+        self.release = release
+        self.locale = locale
+        self.patch_type = patch_type
+        self.name = "%s-%s-%s-%s" % (index, release["build_id"], locale,
+                                     patch_type)
+        self.work_dir = None
+        self.mar = None
+        self.mar_size = None
+        self.source_package = None
+        self.status = "SUCCESS"
+        self.output = []
+
+    def __repr__(self):
+        return "<UpdateTest %s>" % self.name
+
+    def info(self, msg):
+        self.output.append(msg)
+
+    def warn(self, msg):
+        self.output.append("WARN: %s" % msg)
+        if self.status == "SUCCESS":
+            self.status = "WARN"
+
+    def fail(self, msg):
+        self.output.append("FAIL: %s" % msg)
+        self.status = "FAIL"
+
+    @property
+    def failed(self):
+        return self.status == "FAIL"
+
+
+class UpdateVerifyRunner(object):
+    """
+    Verifies all of the updates in `config`, an UpdateVerifyConfig, in
+    `work_dir`.
+
+    Downloads are done by `download_threads` threads and kept in `cache`, a
+    DownloadCache. Unpacking builds, applying MARs and comparing them is done
+    by `threads` threads. If `mars_only` is set, MARs are downloaded and
+    checked, but not applied.
+    """
+
+    def __init__(self, config, work_dir, cache, threads=None,
+                 download_threads=4, mars_only=False,
+                 common_dir=DEFAULT_COMMON_DIR, keep=False,
+                 empty_update_retries=5, empty_update_sleep=5):
+        self.config = config
+        self.work_dir = os.path.abspath(work_dir)
+        self.cache = cache
+        self.threads = threads or cpu_count()
+        self.download_threads = download_threads
+        self.mars_only = mars_only
+        self.common_dir = os.path.abspath(common_dir)
+        self.keep = keep
+        self.empty_update_retries = empty_update_retries
+        self.empty_update_sleep = empty_update_sleep
+
+        self._once = _Once()
+        self._output_lock = threading.Lock()
+        self._targets_lock = threading.Lock()
+        # target key -> where that target build has been unpacked
+        self._targets = {}
+        # target key -> number of tests that still need that target
+        self._target_users = {}
+
+    # Working out what to do
+
+    def getTests(self):
+        tests = []
+        for index, release in enumerate(self.config.releases):
+            for locale in release["locales"]:
+                for patch_type in release["patch_types"]:
+                    tests.append(UpdateTest(index, release, locale,
+                                            patch_type))
+        return tests
+
+    def _build_urls(self, test):
+        """Returns the URLs of the source and target builds for `test`, or
+        (None, None) if the test doesn't have any"""
+        release = test.release
+        if self.mars_only or not release["from"] or not self.config.to:
+            return None, None
+        source = "%s/%s" % (release["ftp_server_from"] or DEFAULT_FTP_SERVER,
+                            release["from"].replace("%locale%", test.locale))
+        target = "%s/%s" % (release["ftp_server_to"] or DEFAULT_FTP_SERVER,
+                            self.config.to.replace("%locale%", test.locale))
+        return source, target
+
+    def updateUrl(self, test):
+        c = self.config
+        return "%s/update/3/%s/%s/%s/%s/%s/%s/default/default/default/" \
+            "update.xml?force=1" % (c.aus_server, c.product,
+                                    test.release["release"],
+                                    test.release["build_id"], c.platform,
+                                    test.locale, c.channel)
+
+    # Download stage
+
+    def _fetch_update_xml(self, url):
+        """Returns the patches offered by `url`, as a dict of patch type to
+        their attributes, retrying until we're offered some"""
+        tries = 0
+        while True:
+            data = retry(lambda: urllib2.urlopen(url, timeout=60).read(),
+                         attempts=3, sleeptime=1)
+            tree = ElementTree.fromstring(data)
+            patches = {}
+            for patch in tree.findall("update/patch"):
+                patches[patch.get("type")] = dict(patch.items())
+            tries += 1
+            if patches or tries >= self.empty_update_retries:
+                return data, patches
+            log.debug("Empty response from %s, sleeping", url)
+            time.sleep(self.empty_update_sleep)
+
+    def download(self, test):
+        """Downloads and checks the MAR for `test`, and downloads its
+        builds"""
+        try:
+            test.work_dir = os.path.join(self.work_dir, test.name)
+            _makedirs(os.path.join(test.work_dir, "update"))
+
+            url = self.updateUrl(test)
+            test.info("Using %s" % url)
+            data, patches = self._once(url, self._fetch_update_xml, url)
+            test.info("Got this response:\n%s" % data)
+            patch = patches.get(test.patch_type)
+            if not patch:
+                test.fail("no %s update found for %s" %
+                          (test.patch_type, url))
+                return test
+
+            sha512 = None
+            if patch["hashFunction"].lower() == "sha512":
+                sha512 = patch["hashValue"]
+            test.mar = self.cache.fetch(
+                patch["URL"], os.path.join(test.work_dir, "update",
+                                           "%s.mar" % test.patch_type),
+                sha512)
+
+            size = os.path.getsize(test.mar)
+            if size != int(patch["size"]):
+                test.fail("%s from %s wrong size" % (test.patch_type, url))
+                test.fail("update.xml size: %s" % patch["size"])
+                test.fail("actual size: %s" % size)
+                return test
+            digest = _hash_file(test.mar, patch["hashFunction"].lower())
+            if digest != patch["hashValue"]:
+                test.fail("%s from %s wrong hash" % (test.patch_type, url))
+                test.fail("update.xml hash: %s" % patch["hashValue"])
+                test.fail("actual hash: %s" % digest)
+                return test
+            test.mar_size = size
+
+            source_url, target_url = self._build_urls(test)
+            if not source_url:
+                return test
+            for u in source_url, target_url:
+                try:
+                    self.cache.get(u)
+                except Exception, e:
+                    test.fail("Could not download %s: %s" % (u, e))
+                    return test
+            downloads = os.path.join(test.work_dir, "downloads")
+            _makedirs(downloads)
+            test.source_package = self.cache.fetch(
+                source_url, os.path.join(downloads,
+                                         os.path.basename(source_url)))
+        except Exception:
+            log.debug("Exception downloading %s", test, exc_info=True)
+            test.fail("Exception downloading: %s" % sys.exc_info()[1])
+        return test
+
+    # Work stage
+
+    def unpack_build(self, cwd, dir_name, package, locale,
+                     mar_channel_IDs=None):
+        """Unpacks `package`, which must be in cwd, into cwd/dir_name with
+        unpack_build from unpack.sh. Returns (success, output)."""
+        cmd = ['bash', '-c',
+               '. "$0" && product="$1" && '
+               'unpack_build "$2" "$3" "$4" "$5" "" "$6"',
+               os.path.join(self.common_dir, "unpack.sh"),
+               self.config.product, self.config.platform, dir_name,
+               os.path.relpath(package, cwd), locale, mar_channel_IDs or ""]
+        proc = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=STDOUT)
+        output = proc.communicate()[0]
+        return proc.returncode == 0, output
+
+    def _unpack_target(self, key, url, locale):
+        target_dir = tempfile.mkdtemp(dir=self.work_dir, prefix="target-")
+        downloads = os.path.join(target_dir, "downloads")
+        os.mkdir(downloads)
+        package = self.cache.fetch(
+            url, os.path.join(downloads, os.path.basename(url)))
+        ok, output = self.unpack_build(target_dir, "target", package, locale)
+        if not ok:
+            raise Exception("cannot unpack_build %s target %s:\n%s" % (
+                self.config.platform, package, output))
+        with self._targets_lock:
+            self._targets[key] = target_dir
+        return os.path.join(target_dir, "target")
+
+    def _release_target(self, key):
+        """Removes the unpacked target build for `key` once nothing else
+        needs it"""
+        with self._targets_lock:
+            self._target_users[key] -= 1
+            if self._target_users[key] or self.keep:
+                return
+            target_dir = self._targets.pop(key, None)
+        if target_dir:
+            shutil.rmtree(target_dir, ignore_errors=True)
+
+    def apply_update(self, test, source_dir):
+        """Applies test's MAR to the build in source_dir"""
+        platform_dirname, updater, _ = platform_info(self.config.platform,
+                                                     self.config.product)
+        update_dir = os.path.join(test.work_dir, "update")
+        shutil.copy(test.mar, os.path.join(update_dir, "update.mar"))
+        shutil.copy(os.path.join(source_dir, updater), update_dir)
+        for f in ("update.status", "update.log"):
+            if os.path.exists(os.path.join(update_dir, f)):
+                os.unlink(os.path.join(update_dir, f))
+
+        cmd = [os.path.join(update_dir, os.path.basename(updater)),
+               update_dir, "."]
+        if not use_old_updater(self.config.product,
+                               test.release["release"]):
+            cmd.append(".")
+        cmd.append("0")
+        proc = Popen(cmd, cwd=source_dir, stdout=PIPE, stderr=STDOUT)
+        test.info(proc.communicate()[0])
+
+        if os.path.exists(os.path.join(update_dir, "update.log")):
+            test.info(open(os.path.join(update_dir, "update.log")).read())
+        try:
+            status = open(os.path.join(update_dir, "update.status")).read()
+        except IOError:
+            status = ""
+        status = status.strip()
+        if status != "succeeded":
+            test.fail("update status was not succeeded: %s" % status)
+            return False
+        return True
+
+    def compare(self, test, source_dir, target_dir):
+        """Compares the updated build with the target build, like
+        check_updates in check_updates.sh"""
+        _, _, binary_file_pattern = platform_info(self.config.platform,
+                                                  self.config.product)
+        proc = Popen(['diff', '-r', source_dir, target_dir], stdout=PIPE,
+                     stderr=STDOUT)
+        diff = proc.communicate()[0]
+        test.info(diff)
+        what = "%s %s vs. %s" % (self.config.platform, test.source_package,
+                                 target_dir)
+        if re.search(binary_file_pattern, diff, re.M):
+            test.fail("binary files found in diff")
+            test.fail("check_updates returned failure for %s" % what)
+        elif diff:
+            test.warn("non-binary files found in diff")
+            test.warn("check_updates returned warning for %s" % what)
+        elif proc.returncode != 0:
+            test.fail("unknown error from diff: %s" % proc.returncode)
+
+    def check(self, test):
+        """Unpacks the builds for `test`, applies the update to the source
+        build, and compares it to the target build"""
+        source_url, target_url = self._build_urls(test)
+        key = ("target", target_url, test.locale)
+        try:
+            if test.failed or not test.source_package:
+                return test
+
+            try:
+                target = self._once(key, self._unpack_target, key,
+                                    target_url, test.locale)
+            except Exception, e:
+                test.fail(str(e))
+                return test
+
+            ok, output = self.unpack_build(
+                test.work_dir, "source", test.source_package, test.locale,
+                test.release["mar_channel_IDs"])
+            test.info(output)
+            if not ok:
+                test.fail("cannot unpack_build %s source %s" % (
+                    self.config.platform, test.source_package))
+                return test
+
+            platform_dirname, _, _ = platform_info(self.config.platform,
+                                                   self.config.product)
+            source_dirs = glob.glob(os.path.join(test.work_dir, "source",
+                                                 platform_dirname))
+            if not source_dirs:
+                test.fail("no dir in source/%s" % platform_dirname)
+                return test
+            source_dir = source_dirs[0]
+            target_dir = os.path.join(target, os.path.basename(source_dir))
+
+            if self.apply_update(test, source_dir):
+                self.compare(test, source_dir, target_dir)
+        except Exception:
+            log.debug("Exception checking %s", test, exc_info=True)
+            test.fail("Exception checking update: %s" % sys.exc_info()[1])
+        finally:
+            if source_url:
+                self._release_target(key)
+            if not self.keep and test.work_dir:
+                shutil.rmtree(test.work_dir, ignore_errors=True)
+            self.report(test)
+        return test
+
+    def report(self, test):
+        with self._output_lock:
+            log.info("%s %s %s %s: %s", test.release["release"],
+                     test.release["build_id"], test.locale, test.patch_type,
+                     test.status)
+            for line in test.output:
+                log.info(line)
+
+    def check_sizes(self, tests):
+        """Makes sure partial updates are smaller than complete ones, for
+        each locale of each release"""
+        sizes = {}
+        for t in tests:
+            if t.mar_size is not None:
+                sizes.setdefault((t.index, t.locale), {})[t.patch_type] = t
+        for (index, locale), patches in sorted(sizes.items()):
+            if "partial" not in patches or "complete" not in patches:
+                continue
+            partial = patches["partial"]
+            complete = patches["complete"]
+            if partial.mar_size > complete.mar_size:
+                partial.fail("partial updates are larger than complete "
+                             "updates")
+                log.info("FAIL: %s: partial updates are larger than "
+                         "complete updates", locale)
+            elif partial.mar_size == complete.mar_size:
+                log.info("WARN: %s: partial updates are the same size as "
+                         "complete updates, this should only happen for "
+                         "major updates", locale)
+            else:
+                log.info("SUCCESS: %s: partial updates are smaller than "
+                         "complete updates", locale)
+
+    def run(self):
+        """Runs all of the tests, returning them"""
+        self.cache.prune()
+        _makedirs(self.work_dir)
+        # unpack.sh refers to its helpers as ../common
+        common = os.path.join(self.work_dir, "common")
+        if not os.path.exists(common):
+            os.symlink(self.common_dir, common)
+
+        tests = self.getTests()
+        for t in tests:
+            source_url, target_url = self._build_urls(t)
+            if source_url:
+                key = ("target", target_url, t.locale)
+                self._target_users[key] = self._target_users.get(key, 0) + 1
+
+        download_pool = ThreadPool(self.download_threads)
+        work_pool = ThreadPool(self.threads)
+        checks = []
+
+        def downloaded(test):
+            # Called from the download pool as each download finishes
+            checks.append(work_pool.apply_async(self.check, (test,)))
+
+        try:
+            downloads = [download_pool.apply_async(self.download, (t,),
+                                                   callback=downloaded)
+                         for t in tests]
+            for d in downloads:
+                d.get()
+            for c in checks:
+                c.get()
+        finally:
+            download_pool.close()
+            work_pool.close()
+            download_pool.join()
+            work_pool.join()
+
+        self.check_sizes(tests)
+        failed = len([t for t in tests if t.failed])
+        log.info("%i of %i update tests failed", failed, len(tests))
+        return tests
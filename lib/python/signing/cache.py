@@ -0,0 +1,142 @@
+import os
+import json
+import tempfile
+from collections import OrderedDict
+
+from util.file import safe_unlink
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class SignedFileCache(object):
+    """
+    Content-addressed cache of signed files
+
+    Signed output is stored in `signed_dir` as <format>/<hash>, where <hash>
+    is the sha1 of the unsigned input. The cache remembers the sha1 digest and
+    size of each signed file so they can be served without being re-hashed.
+
+    `index_file` is where the cache index is persisted between restarts
+    `max_size` is the total number of bytes of signed output to keep. Least
+    recently used entries are evicted once this is exceeded. If it is None,
+    the cache size is unbounded.
+    """
+
+    def __init__(self, signed_dir, index_file, max_size=None):
+        self.signed_dir = signed_dir
+        self.index_file = index_file
+        self.max_size = max_size
+
+        # Mapping of (filehash, format) to (digest, size), in least recently
+        # used order
+        self.entries = OrderedDict()
+        self.total_size = 0
+
+        ##
+        # Stats
+        ##
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Do we have changes that haven't been written to index_file yet?
+        self.dirty = False
+
+        self.load()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_path(self, filehash, format_):
+        return os.path.join(self.signed_dir, format_, filehash)
+
+    def get(self, filehash, format_):
+        """Returns (digest, size) of the signed file for `filehash` in
+        `format_`, or None if we don't have it"""
+        key = (filehash, format_)
+        entry = self.entries.get(key)
+        if entry and not os.path.exists(self.get_path(filehash, format_)):
+            log.debug("%s/%s has gone missing", format_, filehash)
+            self.remove(filehash, format_)
+            entry = None
+
+        if not entry:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # Move to the most recently used end
+        del self.entries[key]
+        self.entries[key] = entry
+        self.dirty = True
+        return entry
+
+    def add(self, filehash, format_, digest, size):
+        key = (filehash, format_)
+        old = self.entries.pop(key, None)
+        if old:
+            self.total_size -= old[1]
+        self.entries[key] = (digest, size)
+        self.total_size += size
+        self.dirty = True
+
+    def remove(self, filehash, format_):
+        entry = self.entries.pop((filehash, format_), None)
+        if entry:
+            self.total_size -= entry[1]
+            self.dirty = True
+        return entry
+
+    def evict(self):
+        """Deletes least recently used signed files until we're under
+        max_size. Returns the number of entries evicted."""
+        if self.max_size is None:
+            return 0
+        evicted = 0
+        while self.entries and self.total_size > self.max_size:
+            (filehash, format_), (digest, size) = self.entries.popitem(last=False)
+            self.total_size -= size
+            self.dirty = True
+            fn = self.get_path(filehash, format_)
+            log.info("Evicting %s from cache", fn)
+            safe_unlink(fn)
+            safe_unlink(fn + ".out")
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def load(self):
+        self.entries.clear()
+        self.total_size = 0
+        try:
+            data = json.load(open(self.index_file, 'rb'))
+        except IOError:
+            log.debug("No cache index at %s", self.index_file)
+            return
+        except ValueError:
+            log.warning("Cache index %s is corrupt; ignoring", self.index_file)
+            return
+
+        for filehash, format_, digest, size in data:
+            # Files may have been removed while we weren't running
+            if os.path.exists(self.get_path(filehash, format_)):
+                self.add(filehash, format_, digest, size)
+        self.dirty = False
+        log.info("Loaded %i entries (%i bytes) from %s",
+                 len(self.entries), self.total_size, self.index_file)
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = [[filehash, format_, digest, size] for (filehash, format_), (digest, size)
+                in self.entries.iteritems()]
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self.index_file))
+        fp = os.fdopen(fd, 'wb')
+        json.dump(data, fp)
+        fp.close()
+        os.rename(tmpname, self.index_file)
+        self.dirty = False
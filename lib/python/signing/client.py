@@ -6,6 +6,8 @@ import time
 import socket
 import httplib
 import urllib
+import json
+import threading
 
 # TODO: Use util.command
 from subprocess import check_call
@@ -40,8 +42,150 @@ def get_token(baseurl, username, password, slave_ip, duration):
     return urllib2.urlopen(r).read()
 
 
-def remote_signfile(options, urls, filename, fmt, token, dest=None):
-    filehash = sha1sum(filename)
+def start_batch(baseurl, fmt, token, files):
+    """Tells the server at `baseurl` that we want to sign `files`, a list of
+    (filehash, filename) pairs, in format `fmt`.
+
+    Returns the batch id, and the list of hashes that need to be uploaded."""
+    url = "%s/batch/%s" % (baseurl, fmt)
+    data = urllib.urlencode({
+        'token': token,
+        'manifest': json.dumps(files),
+    })
+    log.debug("POST %s (%i files)", url, len(files))
+    r = urllib2.Request(url, data)
+    result = json.load(urllib2.urlopen(r))
+    return result['batch'], result['missing']
+
+
+def get_batch_status(baseurl, batch_id, wait=60):
+    """Returns a dictionary of file hash to status for the batch `batch_id`,
+    waiting up to `wait` seconds for pending files to be signed"""
+    url = "%s/batch/%s?wait=%i" % (baseurl, batch_id, wait)
+    log.debug("GET %s", url)
+    r = urllib2.Request(url)
+    return json.load(urllib2.urlopen(r))['files']
+
+
+def remote_signbatch(options, url, files, fmt, token):
+    """Signs `files`, a list of (filename, dest) pairs, in format `fmt` using
+    the server at `url`.
+
+    Only files the server doesn't have already are uploaded, and the server
+    is polled for the whole batch at once.
+
+    Returns the list of (filename, dest) pairs that couldn't be signed."""
+    # Mapping of file hash to the (filename, dest) pairs with that content
+    hashes = {}
+    for filename, dest in files:
+        hashes.setdefault(sha1sum(filename), []).append((filename, dest))
+
+    failed = []
+    todo = {}
+    for filehash, entries in hashes.iteritems():
+        if options.cachedir and os.path.exists(os.path.join(options.cachedir, fmt, filehash)):
+            # remote_signfile will copy these out of the cache for us
+            for filename, dest in entries:
+                if not remote_signfile(options, [url], filename, fmt, token, dest, filehash):
+                    failed.append((filename, dest))
+        else:
+            todo[filehash] = entries
+
+    if not todo:
+        return failed
+
+    try:
+        batch_id, missing = start_batch(
+            url, fmt, token,
+            [(filehash, os.path.basename(entries[0][0]))
+             for filehash, entries in todo.iteritems()])
+        log.info("%s: batch of %i files; %i to upload", batch_id,
+                 len(todo), len(missing))
+
+        try:
+            nonce = open(options.noncefile, 'rb').read()
+        except IOError:
+            nonce = ""
+        for filehash in missing:
+            filename = todo[filehash][0][0]
+            log.info("%s: uploading %s for signing", filehash, filename)
+            try:
+                uploadfile(url, filename, fmt, token, nonce=nonce)
+            except urllib2.HTTPError, e:
+                # python2.5 doesn't think 202 is ok...but really it is!
+                if e.code != 202:
+                    log.info("%s: error uploading file for signing: %s %s",
+                             filehash, e.code, e.msg)
+
+        max_pending_tries = 10
+        for _ in range(max_pending_tries):
+            status = get_batch_status(url, batch_id)
+            pending = [h for h, s in status.iteritems()
+                       if s['status'] == 'pending']
+            if not pending:
+                break
+            log.debug("%s: %i files pending", batch_id, len(pending))
+        else:
+            log.error("%s: giving up after %i tries", batch_id,
+                      max_pending_tries)
+    except (urllib2.URLError, socket.error, httplib.HTTPException, ValueError, KeyError):
+        log.exception("%s: error signing batch", url)
+        for entries in todo.values():
+            failed.extend(entries)
+        return failed
+
+    for filehash, entries in todo.iteritems():
+        if status.get(filehash, {}).get('status') != 'done':
+            log.info("%s: not signed in batch (%s)", filehash,
+                     status.get(filehash))
+            failed.extend(entries)
+            continue
+        # The file is signed; remote_signfile will download it for us
+        for filename, dest in entries:
+            if not remote_signfile(options, [url], filename, fmt, token, dest, filehash):
+                failed.append((filename, dest))
+    return failed
+
+
+def remote_signfiles(options, urls, files, fmt, token):
+    """Signs `files`, a list of (filename, dest) pairs, in format `fmt`.
+
+    The files are split into batches, one for each server in `urls`, which
+    are signed concurrently. Files that fail to be signed in a batch are
+    retried one at a time.
+
+    Returns True if all the files were signed."""
+    batches = [files[i::len(urls)] for i in range(len(urls))]
+    failed = []
+
+    def sign_batch(url, batch):
+        try:
+            failed.extend(remote_signbatch(options, url, batch, fmt, token))
+        except:
+            log.exception("%s: error signing batch", url)
+            failed.extend(batch)
+
+    threads = []
+    for url, batch in zip(urls, batches):
+        if not batch:
+            continue
+        t = threading.Thread(target=sign_batch, args=(url, batch))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    for filename, dest in failed:
+        log.info("%s: retrying on its own", filename)
+        if not remote_signfile(options, urls, filename, fmt, token, dest):
+            log.error("Failed to sign %s with %s", filename, fmt)
+            return False
+    return True
+
+
+def remote_signfile(options, urls, filename, fmt, token, dest=None, filehash=None):
+    if filehash is None:
+        filehash = sha1sum(filename)
     if dest is None:
         dest = filename
 
@@ -4,8 +4,12 @@ import hmac
 import shlex
 import time
 import signal
+import errno
 import re
 import tempfile
+import json
+import fcntl
+import cgi
 # TODO: use util.command
 from subprocess import Popen, PIPE, STDOUT
 
@@ -13,15 +17,21 @@ import gevent
 from gevent import queue
 from gevent.event import Event
 from gevent import pywsgi
+from gevent.socket import wait_read
 from IPy import IP
 import webob
 
 from util import b64
 from util.file import safe_unlink, sha1sum, safe_copyfile
+from util.commands import ProcessWatcher, supervise
+from signing.cache import SignedFileCache
 
 import logging
 log = logging.getLogger(__name__)
 
+# what a file's sha1 looks like in requests
+valid_hash = re.compile(r"^[0-9a-f]{40}$")
+
 
 def make_token_data(slave_ip, valid_from, valid_to, chaff_bytes=16):
     """Return a string suitable for using as token data. This string will
@@ -56,6 +66,20 @@ def unpack_token_data(token_data):
     )
 
 
+class _WaitTimeout(Exception):
+    pass
+
+
+def gevent_wait_read(fd, timeout):
+    """Waits for fd to be readable for util.commands.ProcessWatcher, letting
+    other greenlets run in the meantime"""
+    try:
+        wait_read(fd, timeout=timeout, timeout_exc=_WaitTimeout())
+        return True
+    except _WaitTimeout:
+        return False
+
+
 def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=None, max_tries=5):
     """Run the signing script `cmd`, passing the inputfile, outputfile,
     original filename and format.
@@ -77,7 +101,6 @@ def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=Non
     max_time = 120
     tries = 0
     while True:
-        start = time.time()
         # Make sure to call os.setsid() after we fork so the spawned process is
         # its own session leader. This means that it will get its own process
         # group, and signals sent to its process group will also be sent to its
@@ -90,39 +113,15 @@ def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=Non
             proc.stdin.write(passphrase)
         proc.stdin.close()
         log.debug("%s: %s", proc.pid, cmd)
-        siglist = [signal.SIGINT, signal.SIGTERM]
-        timeout = False
-        while True:
-            if time.time() - start > max_time:
-                timeout = True
-                log.debug("%s: Exceeded timeout", proc.pid)
-                # Kill off the process
-                if siglist:
-                    sig = siglist.pop(0)
-                else:
-                    sig = signal.SIGKILL
-                try:
-                    # Kill off the process group first, and then the process
-                    # itself for good measure
-                    os.kill(-proc.pid, sig)
-                    os.kill(proc.pid, sig)
-                    gevent.sleep(1)
-                    os.kill(proc.pid, 0)
-                except OSError:
-                    # The process is gone now
-                    rc = -1
-                    break
-
-            rc = proc.poll()
-            if rc is not None:
-                # if we killed the child, we want to break before we poll, since polling may not give
-                # an error return code.
-                if timeout:
-                    rc = -1
-                break
-
-            # Check again in a bit
-            gevent.sleep(0.25)
+        # If it takes too long, kill off the process group
+        watcher = supervise(proc, timeout=max_time, kill_group=True,
+                            wait_read=gevent_wait_read)
+        rc = proc.returncode
+        if watcher.timed_out:
+            # if we killed the child, its return code may not say so
+            rc = -1
+        log.debug("%s: Finished with rc %s (%s)", proc.pid, rc,
+                  watcher.format_times())
 
         if rc == 0:
             log.debug("%s: Success!", proc.pid)
@@ -138,6 +137,200 @@ def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=Non
         gevent.sleep(5)
 
 
+def save_digest(fn, digest):
+    """Remembers that `digest` is the sha1 digest of `fn`, so that it doesn't
+    need to be calculated again"""
+    st = os.stat(fn)
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fn))
+    fp = os.fdopen(fd, 'wb')
+    fp.write("%s %i %i" % (digest, st.st_size, st.st_mtime))
+    fp.close()
+    os.rename(tmpname, fn + ".sha1")
+
+
+def get_digest(fn):
+    """Returns the sha1 digest of `fn`. The digest saved by save_digest is
+    used if `fn` hasn't changed since then, otherwise it's recalculated."""
+    try:
+        digest, size, mtime = open(fn + ".sha1", 'rb').read().split()
+        st = os.stat(fn)
+        if int(size) == st.st_size and int(mtime) == int(st.st_mtime):
+            return digest
+    except (IOError, OSError, ValueError):
+        pass
+    return sha1sum(fn)
+
+
+class HashingFile(object):
+    """File-like object that calculates the sha1 digest and size of what's
+    written to it"""
+
+    def __init__(self, fp, name):
+        self.fp = fp
+        self.name = name
+        self.hsh = hashlib.new('sha1')
+        self.size = 0
+
+    def write(self, data):
+        self.hsh.update(data)
+        self.size += len(data)
+        self.fp.write(data)
+
+    def hexdigest(self):
+        return self.hsh.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+def make_upload_storage(tmpdir):
+    """Returns a cgi.FieldStorage class that writes uploaded files to
+    temporary files in `tmpdir`, hashing them as they're received"""
+    class UploadFieldStorage(cgi.FieldStorage):
+        def make_file(self, binary=None):
+            fd, tmpname = tempfile.mkstemp(dir=tmpdir)
+            return HashingFile(os.fdopen(fd, 'w+b'), tmpname)
+    return UploadFieldStorage
+
+
+def iterfile(fp, blocksize=1024 ** 2):
+    """Yields the contents of `fp` in `blocksize` chunks, closing it at the
+    end"""
+    try:
+        while True:
+            data = fp.read(blocksize)
+            if not data:
+                break
+            yield data
+    finally:
+        fp.close()
+
+
+class HelperError(Exception):
+    pass
+
+
+class SignscriptHelper(object):
+    """
+    A long-running signing script that signs files sent to it over a pipe
+
+    `cmd` is the signing command, which is run with '--helper format_'
+    appended. The helper is sent `passphrase` on startup, and then batches of
+    files to sign. See serve() in signscript.py for the protocol.
+    """
+
+    def __init__(self, cmd, format_, passphrase=None):
+        if isinstance(cmd, basestring):
+            cmd = shlex.split(cmd)
+        else:
+            cmd = cmd[:]
+        cmd.extend(('--helper', format_))
+
+        # Run the helper in its own session so that we can kill off any
+        # processes it has spawned if it takes too long
+        self.proc = Popen(cmd, stdin=PIPE, stdout=PIPE, close_fds=True,
+                          preexec_fn=lambda: os.setsid())
+        self.watcher = ProcessWatcher(self.proc, wait_read=gevent_wait_read)
+        log.debug("%s: started helper %s", self.proc.pid, cmd)
+        self.buf = ""
+
+        fd = self.proc.stdout.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self.proc.stdin.write(json.dumps(passphrase) + "\n")
+        self.proc.stdin.flush()
+
+    def alive(self):
+        return self.proc.returncode is None
+
+    def sign(self, requests, max_time=120):
+        """Signs a batch of files. `requests` is a list of (inputfile,
+        outputfile, filename) tuples.
+
+        Returns a list of return codes, one per request. Raises HelperError if
+        the helper exits or doesn't finish within `max_time` seconds per
+        file."""
+        try:
+            self.proc.stdin.write(json.dumps(requests) + "\n")
+            self.proc.stdin.flush()
+        except IOError:
+            self.stop()
+            raise HelperError("helper %s has exited" % self.proc.pid)
+
+        deadline = time.time() + max_time * len(requests)
+        while "\n" not in self.buf:
+            # Wait for our response, or for the helper to close its end of
+            # the pipe when it exits
+            try:
+                wait_read(self.proc.stdout.fileno(),
+                          timeout=max(0, deadline - time.time()),
+                          timeout_exc=HelperError("timed out"))
+                data = os.read(self.proc.stdout.fileno(), 65536)
+            except HelperError:
+                log.debug("%s: Exceeded timeout", self.proc.pid)
+                self.stop()
+                raise
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+            if not data:
+                self.stop()
+                raise HelperError("helper %s has exited" % self.proc.pid)
+            self.buf += data
+
+        line, self.buf = self.buf.split("\n", 1)
+        return json.loads(line)
+
+    def stop(self):
+        """Stops the helper and any processes it has started"""
+        if not self.alive():
+            return
+        log.debug("%s: stopping helper", self.proc.pid)
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.watcher.kill(signals=[signal.SIGTERM], group=True)
+        log.debug("%s: helper ran for %s", self.proc.pid,
+                  self.watcher.format_times())
+
+
+class SignscriptPool(object):
+    """
+    Pool of SignscriptHelpers for one format
+
+    Helpers are started as needed, and are kept running between files until
+    the pool is closed.
+    """
+    closed = False
+
+    def __init__(self, cmd, format_, passphrase=None):
+        self.cmd = cmd
+        self.format_ = format_
+        self.passphrase = passphrase
+        self.idle = []
+
+    def get(self):
+        while self.idle:
+            helper = self.idle.pop()
+            if helper.alive():
+                return helper
+        return SignscriptHelper(self.cmd, self.format_, self.passphrase)
+
+    def put(self, helper):
+        if self.closed or not helper.alive():
+            helper.stop()
+        else:
+            self.idle.append(helper)
+
+    def close(self):
+        self.closed = True
+        while self.idle:
+            self.idle.pop().stop()
+
+
 class Signer(object):
     """
     Main signing object
@@ -146,10 +339,13 @@ class Signer(object):
     `inputdir` and `outputdir` are where uploaded files and signed files will be stored
     `passphrases` is a dict of format => passphrase
     `concurrency` is how many workers to run
+    `use_helpers` means files are signed by long-running signing scripts
+    instead of by running the signing script once per file
     """
     stopped = False
+    max_tries = 5
 
-    def __init__(self, app, signcmd, inputdir, outputdir, concurrency, passphrases):
+    def __init__(self, app, signcmd, inputdir, outputdir, concurrency, passphrases, use_helpers=False):
         self.app = app
         self.signcmd = signcmd
         self.concurrency = concurrency
@@ -161,15 +357,37 @@ class Signer(object):
         self.workers = []
         self.queue = queue.Queue()
 
+        # Mapping of format to SignscriptPool
+        self.pools = {}
+        self.use_helpers = use_helpers
+
+    def close_helpers(self):
+        """Stops idle helpers. Busy helpers are stopped once they've finished
+        what they're working on."""
+        for pool in self.pools.values():
+            pool.close()
+
+    def stop(self):
+        self.stopped = True
+        self.close_helpers()
+
     def signfile(self, filehash, filename, format_):
+        return self.signfiles([(filehash, filename, format_)])[0]
+
+    def signfiles(self, files):
+        """Queues up a batch of files to be signed together. `files` is a
+        list of (filehash, filename, format) tuples.
+
+        Returns a list of Events, one per file, which are set once each file
+        has been processed."""
         assert not self.stopped
-        e = Event()
-        item = (filehash, filename, format_, e)
-        log.debug("Putting %s on the queue", item)
-        self.queue.put(item)
+        batch = [(filehash, filename, format_, Event())
+                 for filehash, filename, format_ in files]
+        log.debug("Putting %s on the queue", batch)
+        self.queue.put(batch)
         self._start_worker()
         log.debug("%i workers active", len(self.workers))
-        return e
+        return [item[3] for item in batch]
 
     def _start_worker(self):
         if len(self.workers) < self.concurrency:
@@ -187,68 +405,118 @@ class Signer(object):
 
     def _worker(self):
         # Main worker process
-        # We pop items off the queue and process them
+        # We pop batches off the queue and process them
 
         # How many jobs to process before exiting
         max_jobs = 10
         jobs = 0
         while True:
-            # Event to signal when we're done
-            e = None
-            try:
-                jobs += 1
-                # Fall on our sword if we're too old
-                if jobs >= max_jobs:
-                    break
+            jobs += 1
+            # Fall on our sword if we're too old
+            if jobs >= max_jobs:
+                break
 
-                try:
-                    item = self.queue.get(block=False)
-                    if not item:
-                        break
-                except queue.Empty:
-                    log.debug("no items, exiting")
+            try:
+                batch = self.queue.get(block=False)
+                if not batch:
                     break
+            except queue.Empty:
+                log.debug("no items, exiting")
+                break
 
-                filehash, filename, format_, e = item
-                log.info("Signing %s (%s - %s)", filename, format_, filehash)
-
-                inputfile = os.path.join(self.inputdir, filehash)
-                outputfile = os.path.join(self.outputdir, format_, filehash)
-                logfile = outputfile + ".out"
+            try:
+                self._sign_batch(batch)
+            finally:
+                # Signal that we're done
+                for item in batch:
+                    item[3].set()
+        log.debug("Worker exiting")
 
-                if not os.path.exists(os.path.join(self.outputdir, format_)):
-                    os.makedirs(os.path.join(self.outputdir, format_))
+    def _sign_batch(self, batch):
+        formats = []
+        for item in batch:
+            filehash, filename, format_, e = item
+            log.info("Signing %s (%s - %s)", filename, format_, filehash)
+            if format_ not in formats:
+                formats.append(format_)
+            if not os.path.exists(os.path.join(self.outputdir, format_)):
+                os.makedirs(os.path.join(self.outputdir, format_))
+
+        for format_ in formats:
+            items = [item for item in batch if item[2] == format_]
+            try:
+                if self.use_helpers:
+                    retvals = self._run_helper(format_, items)
+                else:
+                    retvals = [self._run_signscript(item) for item in items]
+            except:
+                log.exception("Exception signing %s", items)
+                retvals = [None] * len(items)
 
-                retval = run_signscript(self.signcmd, inputfile, outputfile,
-                                        filename, format_, self.passphrases.get(format_))
+            for item, retval in zip(items, retvals):
+                self._finish(item, retval)
 
-                if retval != 0:
-                    if os.path.exists(logfile):
-                        logoutput = open(logfile).read()
-                    else:
-                        logoutput = None
-                    log.warning("Signing failed %s (%s - %s)",
-                                filename, format_, filehash)
-                    log.warning("Signing log: %s", logoutput)
-                    safe_unlink(outputfile)
-                    self.app.messages.put(
-                        ('errors', item, 'signing script returned non-zero'))
-                    continue
+    def _run_signscript(self, item):
+        filehash, filename, format_, e = item
+        inputfile = os.path.join(self.inputdir, filehash)
+        outputfile = os.path.join(self.outputdir, format_, filehash)
+        try:
+            return run_signscript(self.signcmd, inputfile, outputfile,
+                                  filename, format_, self.passphrases.get(format_),
+                                  max_tries=self.max_tries)
+        except:
+            log.exception("Exception signing file %s", item)
+            return None
 
-                # Copy our signed result into unsigned and signed so if
-                # somebody wants to get this file signed again, they get the
-                # same results.
-                outputhash = sha1sum(outputfile)
-                log.debug("Copying result to %s", outputhash)
-                copied_input = os.path.join(self.inputdir, outputhash)
-                if not os.path.exists(copied_input):
-                    safe_copyfile(outputfile, copied_input)
-                copied_output = os.path.join(
-                    self.outputdir, format_, outputhash)
-                if not os.path.exists(copied_output):
-                    safe_copyfile(outputfile, copied_output)
-                self.app.messages.put(('done', item, outputhash))
-            except:
+    def _run_helper(self, format_, items):
+        pool = self.pools.get(format_)
+        if not pool:
+            pool = self.pools[format_] = SignscriptPool(
+                self.signcmd, format_, self.passphrases.get(format_))
+
+        requests = []
+        for filehash, filename, format_, e in items:
+            inputfile = os.path.join(self.inputdir, filehash)
+            outputfile = os.path.join(self.outputdir, format_, filehash)
+            # The helper appends to the log, so start off with an empty one
+            open(outputfile + ".out", 'wb').close()
+            requests.append((inputfile, outputfile, filename))
+
+        retvals = [1] * len(items)
+        todo = range(len(items))
+        tries = 0
+        while True:
+            helper = pool.get()
+            try:
+                results = helper.sign([requests[i] for i in todo])
+            except HelperError, e:
+                log.info("%s: helper failed: %s", helper.proc.pid, e)
+                results = [-1] * len(todo)
+            finally:
+                pool.put(helper)
+
+            for i, rc in zip(todo, results):
+                retvals[i] = rc
+            todo = [i for i in todo if retvals[i] != 0]
+            if not todo:
+                return retvals
+
+            # Try again in a bit
+            log.info("run_helper: %i files failed; retrying in a bit",
+                     len(todo))
+            tries += 1
+            if tries >= self.max_tries:
+                log.warning(
+                    "run_helper: Exceeded maximum number of retries; exiting")
+                return retvals
+            gevent.sleep(5)
+
+    def _finish(self, item, retval):
+        filehash, filename, format_, e = item
+        outputfile = os.path.join(self.outputdir, format_, filehash)
+        logfile = outputfile + ".out"
+        try:
+            if retval is None:
                 # Inconceivable! Something went wrong!
                 # Remove our output, it might be corrupted
                 safe_unlink(outputfile)
@@ -256,18 +524,54 @@ class Signer(object):
                     logoutput = open(logfile).read()
                 else:
                     logoutput = None
-                log.exception(
-                    "Exception signing file %s; output: %s ", item, logoutput)
+                log.warning("Exception signing file %s; output: %s ",
+                            item, logoutput)
                 self.app.messages.put((
                     'errors', item, 'worker hit an exception while signing'))
-            finally:
-                if e:
-                    e.set()
-        log.debug("Worker exiting")
+                return
+
+            if retval != 0:
+                if os.path.exists(logfile):
+                    logoutput = open(logfile).read()
+                else:
+                    logoutput = None
+                log.warning("Signing failed %s (%s - %s)",
+                            filename, format_, filehash)
+                log.warning("Signing log: %s", logoutput)
+                safe_unlink(outputfile)
+                self.app.messages.put(
+                    ('errors', item, 'signing script returned non-zero'))
+                return
+
+            # Copy our signed result into unsigned and signed so if
+            # somebody wants to get this file signed again, they get the
+            # same results.
+            outputhash = sha1sum(outputfile)
+            log.debug("Copying result to %s", outputhash)
+            copied_input = os.path.join(self.inputdir, outputhash)
+            if not os.path.exists(copied_input):
+                safe_copyfile(outputfile, copied_input)
+                save_digest(copied_input, outputhash)
+            copied_output = os.path.join(
+                self.outputdir, format_, outputhash)
+            if not os.path.exists(copied_output):
+                safe_copyfile(outputfile, copied_output)
+            self.app.messages.put(('done', item, outputhash))
+        except:
+            safe_unlink(outputfile)
+            if os.path.exists(logfile):
+                logoutput = open(logfile).read()
+            else:
+                logoutput = None
+            log.exception(
+                "Exception signing file %s; output: %s ", item, logoutput)
+            self.app.messages.put((
+                'errors', item, 'worker hit an exception while signing'))
 
 
 class SigningServer:
     signer = None
+    cache = None
 
     def __init__(self, config, passphrases):
         self.passphrases = passphrases
@@ -284,6 +588,13 @@ class SigningServer:
         # Mapping of file hashes to gevent Events
         self.pending = {}
 
+        # Mapping of (file hash, format) to when signing it last failed
+        self.failed = {}
+
+        # Mapping of batch ids to (format, {file hash: filename}, creation
+        # time)
+        self.batches = {}
+
         self.load_config(config)
 
         self.messages = queue.Queue()
@@ -297,6 +608,8 @@ class SigningServer:
     def stop(self):
         self._message_loop_thread.kill()
         self._cleanup_loop_thead.kill()
+        self.signer.stop()
+        self.cache.save()
 
     def load_config(self, config):
         from ConfigParser import NoOptionError
@@ -334,18 +647,46 @@ class SigningServer:
             if option.startswith('new_token_auth'):
                 self.token_auths.append(value)
         self.cleanup_interval = config.getint('server', 'cleanup_interval')
+        # How many bytes of signed files to keep around. If this isn't set,
+        # signed files are removed along with their unsigned files
+        if config.has_option('server', 'max_cache_size'):
+            max_cache_size = config.getint('server', 'max_cache_size')
+        else:
+            max_cache_size = None
 
         for d in self.signed_dir, self.unsigned_dir:
             if not os.path.exists(d):
                 log.info("Creating %s directory", d)
                 os.makedirs(d)
 
+        if config.has_option('paths', 'cache_index'):
+            cache_index = config.get('paths', 'cache_index')
+        else:
+            cache_index = os.path.join(self.signed_dir, 'index.json')
+        if not self.cache or self.cache.index_file != cache_index or \
+                self.cache.signed_dir != self.signed_dir:
+            if self.cache:
+                self.cache.save()
+            self.cache = SignedFileCache(self.signed_dir, cache_index,
+                                         max_cache_size)
+        else:
+            self.cache.max_size = max_cache_size
+
+        if config.has_option('signing', 'persistent_signscript'):
+            use_helpers = config.getboolean('signing', 'persistent_signscript')
+        else:
+            use_helpers = False
+
+        if self.signer:
+            # Stop any helpers running with the old configuration
+            self.signer.close_helpers()
         self.signer = Signer(self,
                              config.get('signing', 'signscript'),
                              config.get('paths', 'unsigned_dir'),
                              config.get('paths', 'signed_dir'),
                              config.getint('signing', 'concurrency'),
-                             self.passphrases)
+                             self.passphrases,
+                             use_helpers)
 
     def verify_token(self, token, slave_ip):
         token_data, token_sig = token.split('!', 1)
@@ -398,10 +739,21 @@ class SigningServer:
     def cleanup(self):
         log.info("Stats: %i hits; %i misses; %i uploads",
                  self.hits, self.misses, self.uploads)
+        log.info("Cache: %i entries; %i bytes; %i hits; %i misses; %i evictions",
+                 len(self.cache), self.cache.total_size, self.cache.hits,
+                 self.cache.misses, self.cache.evictions)
         log.debug("Pending: %s", self.pending)
         # Find files in unsigned that have bad hashes and delete them
         log.debug("Cleaning up...")
         now = time.time()
+        for batch_id, (format_, files, created) in self.batches.items():
+            if created < now - self.max_file_age:
+                log.debug("Forgetting batch %s", batch_id)
+                del self.batches[batch_id]
+        for key, failed in self.failed.items():
+            if failed < now - self.max_file_age:
+                del self.failed[key]
+
         for f in os.listdir(self.unsigned_dir):
             unsigned = os.path.join(self.unsigned_dir, f)
             # Clean up old files
@@ -411,19 +763,41 @@ class SigningServer:
                 continue
 
         # Find files in signed that don't have corresponding files in unsigned
-        # and delete them
+        # and delete them. If we have a bounded cache, signed files it knows
+        # about are kept until they're evicted.
         for format_ in os.listdir(self.signed_dir):
-            for f in os.listdir(os.path.join(self.signed_dir, format_)):
-                signed = os.path.join(self.signed_dir, format_, f)
+            format_dir = os.path.join(self.signed_dir, format_)
+            if not os.path.isdir(format_dir):
+                continue
+            for f in os.listdir(format_dir):
+                if self.cache.max_size is not None and \
+                        (os.path.splitext(f)[0], format_) in self.cache:
+                    continue
+                signed = os.path.join(format_dir, f)
                 unsigned = os.path.join(self.unsigned_dir, f)
                 if not os.path.exists(unsigned):
                     log.info("Deleting %s with no unsigned file", signed)
                     safe_unlink(signed)
+                    self.cache.remove(f, format_)
+
+        self.cache.evict()
+        self.cache.save()
 
     def submit_file(self, filehash, filename, format_):
         assert (filehash, format_) not in self.pending
         e = self.signer.signfile(filehash, filename, format_)
         self.pending[(filehash, format_)] = e
+        self.failed.pop((filehash, format_), None)
+
+    def submit_files(self, files):
+        """Submits a list of (filehash, filename, format) tuples to be signed
+        together"""
+        for filehash, filename, format_ in files:
+            assert (filehash, format_) not in self.pending
+        events = self.signer.signfiles(files)
+        for (filehash, filename, format_), e in zip(files, events):
+            self.pending[(filehash, format_)] = e
+            self.failed.pop((filehash, format_), None)
 
     def process_messages(self):
         while True:
@@ -434,12 +808,18 @@ class SigningServer:
                     item, txt = msg[1:]
                     filehash, filename, format_, e = item
                     del self.pending[filehash, format_]
+                    self.failed[filehash, format_] = time.time()
                 elif msg[0] == 'done':
                     item, outputhash = msg[1:]
                     filehash, filename, format_, e = item
                     del self.pending[filehash, format_]
                     # Remember the filename for the output file too
                     self.save_filename(outputhash, filename)
+                    # Signing the output again gives the same result, so
+                    # cache it under both hashes
+                    size = os.path.getsize(self.get_path(filehash, format_))
+                    self.cache.add(filehash, format_, outputhash, size)
+                    self.cache.add(outputhash, format_, outputhash, size)
                 else:
                     log.error("Unknown message type: %s", msg)
             except:
@@ -486,7 +866,11 @@ class SigningServer:
     def do_GET(self, environ, start_response):
         """
         GET /sign/<format>/<hash>
+        GET /batch/<batch id>
         """
+        if environ['PATH_INFO'].startswith('/batch/'):
+            return self.handle_batch_status(environ, start_response)
+
         try:
             _, magic, format_, filehash = environ['PATH_INFO'].split('/')
             assert magic == 'sign'
@@ -494,8 +878,7 @@ class SigningServer:
         except:
             log.debug("bad request: %s", environ['PATH_INFO'])
             start_response("400 Bad Request", [])
-            yield ""
-            return
+            return [""]
 
         filehash = os.path.basename(environ['PATH_INFO'])
         try:
@@ -511,21 +894,28 @@ class SigningServer:
                 log.debug("Looking for %s (%s)", fn, filename)
             else:
                 log.debug("Looking for %s", fn)
-            checksum = sha1sum(fn)
+            cached = self.cache.get(filehash, format_)
+            if cached:
+                checksum, size = cached
+            else:
+                checksum = sha1sum(fn)
+                size = os.path.getsize(fn)
+                self.cache.add(filehash, format_, checksum, size)
             headers = [
                 ('X-SHA1-Digest', checksum),
-                ('Content-Length', os.path.getsize(fn)),
+                ('Content-Length', str(size)),
             ]
             fp = open(fn, 'rb')
             os.utime(fn, None)
             log.debug("%s is OK", fn)
             start_response("200 OK", headers)
-            while True:
-                data = fp.read(1024 ** 2)
-                if not data:
-                    break
-                yield data
             self.hits += 1
+            # Let the server send the file itself if it knows how to,
+            # e.g. with sendfile()
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if file_wrapper:
+                return file_wrapper(fp, 1024 ** 2)
+            return iterfile(fp)
         except IOError:
             log.debug("%s is missing", fn)
             headers = []
@@ -541,7 +931,7 @@ class SigningServer:
             elif os.path.exists(fn):
                 log.debug("GET for file we already have, but not for the right format")
                 # Validate the file
-                myhash = sha1sum(fn)
+                myhash = get_digest(fn)
                 if myhash != filehash:
                     log.warning("%s is corrupt; deleting (%s != %s)",
                                 fn, filehash, myhash)
@@ -558,7 +948,7 @@ class SigningServer:
                 self.misses += 1
 
             start_response("404 Not Found", headers)
-            yield ""
+            return [""]
 
     def handle_upload(self, environ, start_response, values, rest, next_nonce):
         format_ = rest[0]
@@ -569,21 +959,20 @@ class SigningServer:
                  filename, filehash, environ['REMOTE_ADDR'])
         fn = os.path.join(self.unsigned_dir, filehash)
         headers = [('X-Nonce', next_nonce)]
+        if (filehash, format_) in self.cache:
+            log.info("File already signed")
+            start_response("202 File already exists", headers)
+            return ""
+
         if os.path.exists(fn):
             # Validate the file
-            mydigest = sha1sum(fn)
+            mydigest = get_digest(fn)
 
             if mydigest != filehash:
                 log.warning("%s is corrupt; deleting (%s != %s)",
                             fn, mydigest, filehash)
                 safe_unlink(fn)
 
-            elif os.path.exists(os.path.join(self.signed_dir, filehash)):
-                # Everything looks ok
-                log.info("File already exists")
-                start_response("202 File already exists", headers)
-                return ""
-
             elif (filehash, format_) in self.pending:
                 log.info("File is pending")
                 start_response("202 File is pending", headers)
@@ -598,24 +987,32 @@ class SigningServer:
             start_response("403 Unacceptable filename", headers)
             return ""
 
-        try:
-            fd, tmpname = tempfile.mkstemp(dir=self.unsigned_dir)
-            fp = os.fdopen(fd, 'wb')
-
-            h = hashlib.new('sha1')
-            s = 0
-            while True:
-                data = values['filedata'].file.read(1024 ** 2)
-                if not data:
-                    break
-                s += len(data)
-                h.update(data)
-                fp.write(data)
-            fp.close()
-        except:
-            log.exception("Error downloading data")
-            if os.path.exists(tmpname):
-                os.unlink(tmpname)
+        filedata = values['filedata'].file
+        if isinstance(filedata, HashingFile):
+            # The upload was written to disk and hashed as it was received
+            filedata.close()
+            tmpname = filedata.name
+            s = filedata.size
+            h = filedata
+        else:
+            try:
+                fd, tmpname = tempfile.mkstemp(dir=self.unsigned_dir)
+                fp = os.fdopen(fd, 'wb')
+
+                h = hashlib.new('sha1')
+                s = 0
+                while True:
+                    data = filedata.read(1024 ** 2)
+                    if not data:
+                        break
+                    s += len(data)
+                    h.update(data)
+                    fp.write(data)
+                fp.close()
+            except:
+                log.exception("Error downloading data")
+                if os.path.exists(tmpname):
+                    os.unlink(tmpname)
 
         if s < self.min_filesize:
             if os.path.exists(tmpname):
@@ -638,11 +1035,107 @@ class SigningServer:
         # Good to go!  Rename the temporary filename to the real filename
         self.save_filename(filehash, filename)
         os.rename(tmpname, fn)
+        save_digest(fn, filehash)
         self.submit_file(filehash, filename, format_)
         start_response("202 Accepted", headers)
         self.uploads += 1
         return ""
 
+    def get_status(self, filehash, format_):
+        """Returns a dictionary describing the state of signing `filehash`
+        in `format_`"""
+        if (filehash, format_) in self.pending:
+            return {'status': 'pending'}
+        entry = self.cache.entries.get((filehash, format_))
+        if entry:
+            return {'status': 'done', 'digest': entry[0]}
+        if (filehash, format_) in self.failed:
+            return {'status': 'error'}
+        return {'status': 'missing'}
+
+    def handle_batch(self, environ, start_response, values, rest):
+        """Starts signing a batch of files. `values['manifest']` is a JSON
+        list of [sha1, filename] pairs.
+
+        Files we already have are queued up for signing. Returns the batch id
+        and the list of hashes that need to be uploaded."""
+        format_ = rest[0]
+        assert format_ in self.formats
+        manifest = json.loads(values['manifest'])
+
+        files = {}
+        for filehash, filename in manifest:
+            if not isinstance(filehash, basestring) or \
+                    not valid_hash.match(filehash):
+                log.info("%s sent invalid hash in batch: %r",
+                         environ['REMOTE_ADDR'], filehash)
+                start_response("400 Invalid hash", [])
+                return ""
+            filename = filename.encode('utf-8')
+            if not any(exp.match(filename) for exp in self.allowed_filenames):
+                log.info("%s forbidden due to invalid filename: %s",
+                         environ['REMOTE_ADDR'], filename)
+                start_response("403 Unacceptable filename", [])
+                return ""
+            files[filehash.encode('utf-8')] = filename
+
+        log.info("Request to %s sign batch of %i files from %s", format_,
+                 len(files), environ['REMOTE_ADDR'])
+        missing = []
+        to_sign = []
+        for filehash, filename in files.iteritems():
+            if (filehash, format_) in self.pending or \
+                    (filehash, format_) in self.cache:
+                continue
+            fn = os.path.join(self.unsigned_dir, filehash)
+            if os.path.exists(fn):
+                if get_digest(fn) == filehash:
+                    self.save_filename(filehash, filename)
+                    to_sign.append((filehash, filename, format_))
+                    continue
+                log.warning("%s is corrupt; deleting", fn)
+                safe_unlink(fn)
+            missing.append(filehash)
+
+        if to_sign:
+            self.submit_files(to_sign)
+
+        batch_id = os.urandom(16).encode('hex')
+        self.batches[batch_id] = (format_, files, time.time())
+        start_response("200 OK", [('Content-Type', 'application/json')])
+        return json.dumps({'batch': batch_id, 'missing': missing})
+
+    def handle_batch_status(self, environ, start_response):
+        """
+        GET /batch/<batch id>[?wait=<seconds>]
+
+        Returns the status of each file in the batch. If `wait` is set, waits
+        up to that many seconds for pending files to finish first.
+        """
+        batch_id = environ['PATH_INFO'].split('/')[-1]
+        batch = self.batches.get(batch_id)
+        if not batch:
+            start_response("404 Not Found", [])
+            return [""]
+        format_, files, created = batch
+
+        try:
+            wait = min(int(webob.Request(environ).GET.get('wait', 0)), 60)
+        except ValueError:
+            start_response("400 Bad Request", [])
+            return [""]
+
+        deadline = time.time() + wait
+        for filehash in files:
+            pending = self.pending.get((filehash, format_))
+            if pending:
+                pending.wait(timeout=max(0, deadline - time.time()))
+
+        status = dict((filehash, self.get_status(filehash, format_))
+                      for filehash in files)
+        start_response("200 OK", [('Content-Type', 'application/json')])
+        return [json.dumps({'batch': batch_id, 'files': status})]
+
     def handle_token(self, environ, start_response, values):
         token = self.get_token(
             values['slave_ip'],
@@ -651,16 +1144,32 @@ class SigningServer:
         start_response("200 OK", [])
         return token
 
+    def parse_upload(self, environ):
+        """Returns a dictionary of the POSTed values in `environ`. Uploaded
+        files are written straight to unsigned_dir."""
+        storage = make_upload_storage(self.unsigned_dir)
+        fs = storage(fp=environ['wsgi.input'], environ=environ,
+                     keep_blank_values=True)
+        values = {}
+        for key in fs.keys():
+            item = fs[key]
+            if isinstance(item, list):
+                item = item[0]
+            if item.filename is not None:
+                values[key] = item
+            else:
+                values[key] = item.value
+        return values
+
     def do_POST(self, environ, start_response):
         req = webob.Request(environ)
-        values = req.POST
         headers = []
 
         try:
             path_bits = environ['PATH_INFO'].split('/')
             magic = path_bits[1]
             rest = path_bits[2:]
-            if not magic in ('sign', 'token'):
+            if not magic in ('sign', 'token', 'batch'):
                 log.exception("bad request: %s", environ['PATH_INFO'])
                 start_response("400 Bad Request", [])
                 return ""
@@ -681,24 +1190,44 @@ class SigningServer:
                     start_response("401 Authorization Required", [])
                     return ""
 
-                return self.handle_token(environ, start_response, values)
-            elif magic == 'sign':
-                # Validate token
+                return self.handle_token(environ, start_response, req.POST)
+            elif magic == 'batch':
+                values = req.POST
                 if 'token' not in values:
                     start_response("400 Missing token", [])
                     return ""
 
-                slave_ip = environ['REMOTE_ADDR']
-                if not self.verify_token(values['token'], slave_ip):
+                if not self.verify_token(values['token'], environ['REMOTE_ADDR']):
                     log.warn("Bad token")
                     start_response("400 Invalid token", [])
                     return ""
 
-                # nonces are unused, but still part of the protocol
-                next_nonce = 'UNUSED'
-                headers.append(('X-Nonce', 'UNUSED'))
+                return self.handle_batch(environ, start_response, values, rest)
+            elif magic == 'sign':
+                values = self.parse_upload(environ)
+                try:
+                    # Validate token
+                    if 'token' not in values:
+                        start_response("400 Missing token", [])
+                        return ""
+
+                    slave_ip = environ['REMOTE_ADDR']
+                    if not self.verify_token(values['token'], slave_ip):
+                        log.warn("Bad token")
+                        start_response("400 Invalid token", [])
+                        return ""
 
-                return self.handle_upload(environ, start_response, values, rest, next_nonce)
+                    # nonces are unused, but still part of the protocol
+                    next_nonce = 'UNUSED'
+                    headers.append(('X-Nonce', 'UNUSED'))
+
+                    return self.handle_upload(environ, start_response, values, rest, next_nonce)
+                finally:
+                    # Clean up any uploaded files we didn't keep
+                    for value in values.values():
+                        if isinstance(getattr(value, 'file', None), HashingFile):
+                            value.file.close()
+                            safe_unlink(value.file.name)
         except:
             log.exception("ISE")
             start_response("500 Internal Server Error", headers)
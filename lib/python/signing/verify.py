@@ -0,0 +1,310 @@
+"""Verifies that signed packages match their unsigned originals.
+
+Rather than unpacking both packages and then comparing them one file at a
+time, the members of each package are streamed out of the archive and hashed
+by a pool of threads, with both packages being read at once. Only the
+members that need to be checked by external tools (signed binaries and .chk
+files) are written to disk, and the signature checks for them are run
+together once everything has been read.
+"""
+import os
+import stat
+import errno
+import hashlib
+import tempfile
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+from subprocess import call
+
+from util.archives import read_mar_index, iter_mar_member, iter_tar_members, \
+    unpackexe
+from util.paths import cygpath
+from signing.utils import shouldSign
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 4
+
+
+class PackageContents(object):
+    """What's in a package.
+
+    `files` maps the name of each file to (mode, sha1 hexdigest); `dirs` maps
+    the name of each directory to its mode, which is None for directories
+    that only exist implicitly in the archive. Members that were asked to be
+    extracted are under `destdir`, and `contents` has the data of members
+    that were asked to be kept in memory."""
+
+    def __init__(self, destdir):
+        self.destdir = destdir
+        self.files = {}
+        self.dirs = {}
+        self.contents = {}
+        self._lock = threading.Lock()
+
+    def add_file(self, name, mode, digest, data=None):
+        with self._lock:
+            self.files[name] = (mode, digest)
+            if data is not None:
+                self.contents[name] = data
+
+    def add_implied_dirs(self):
+        for name in self.files.keys() + self.dirs.keys():
+            d = os.path.dirname(name)
+            while d and d not in self.dirs:
+                self.dirs[d] = None
+                d = os.path.dirname(d)
+
+
+def _makedirs(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _consume(contents, name, mode, blocks, extract, keep):
+    """Hashes `blocks`, the data of member `name`, writing it out to
+    contents.destdir if `extract` is set, and keeping it if `keep` is set"""
+    h = hashlib.sha1()
+    output = None
+    kept = [] if keep else None
+    if extract:
+        dst = os.path.join(contents.destdir, name)
+        _makedirs(os.path.dirname(dst))
+        output = open(dst, 'wb')
+    try:
+        for block in blocks:
+            h.update(block)
+            if output:
+                output.write(block)
+            if keep:
+                kept.append(block)
+    finally:
+        if output:
+            output.close()
+            os.chmod(dst, mode)
+    if keep:
+        kept = "".join(kept)
+    contents.add_file(name, mode, h.hexdigest(), kept)
+
+
+def _hash_file(contents, name, keep):
+    st = os.stat(os.path.join(contents.destdir, name))
+    f = open(os.path.join(contents.destdir, name), 'rb')
+    try:
+        blocks = iter(lambda: f.read(512 * 1024), "")
+        _consume(contents, name, stat.S_IMODE(st.st_mode), blocks, False,
+                 keep)
+    finally:
+        f.close()
+
+
+def scan_package(filename, destdir, extract=None, keep=(),
+                 threads=DEFAULT_THREADS):
+    """Reads the contents of the mar, exe or tar file `filename`, returning a
+    PackageContents.
+
+    Members for which extract(name) returns True are written to `destdir`.
+    The data of members named in `keep` is kept in memory. Members of mar
+    files are hashed concurrently by `threads` threads, and members of tar
+    files as they're read. exe files can only be unpacked with 7z, so they
+    are unpacked into `destdir` and hashed from there."""
+    contents = PackageContents(destdir)
+    extract = extract or (lambda name: False)
+    pool = ThreadPool(threads)
+    try:
+        if filename.endswith(".mar"):
+            def do_member(member):
+                name, offset, size, flags = member
+                _consume(contents, name, flags,
+                         iter_mar_member(filename, offset, size),
+                         extract(name), name in keep)
+            # Start with the biggest members, so that one of them doesn't
+            # hold everything up at the end
+            members = sorted(read_mar_index(filename), key=lambda m: m[2],
+                             reverse=True)
+            pool.map(do_member, members, chunksize=1)
+        elif filename.endswith(".exe"):
+            unpackexe(filename, destdir)
+            names = []
+            for root, dirs, files in os.walk(destdir):
+                rel = root[len(destdir) + 1:]
+                for d in dirs:
+                    contents.dirs[os.path.join(rel, d)] = stat.S_IMODE(
+                        os.stat(os.path.join(root, d)).st_mode)
+                names.extend(os.path.join(rel, f) for f in files)
+            pool.map(lambda name: _hash_file(contents, name, name in keep),
+                     names, chunksize=1)
+        elif filename.endswith(".tar"):
+            for info, fileobj in iter_tar_members(filename):
+                name = os.path.normpath(info.name)
+                if info.isdir():
+                    contents.dirs[name] = info.mode
+                elif fileobj:
+                    blocks = iter(lambda: fileobj.read(512 * 1024), "")
+                    _consume(contents, name, info.mode, blocks,
+                             extract(name), name in keep)
+        else:
+            raise ValueError("Unknown file type: %s" % filename)
+    finally:
+        pool.close()
+        pool.join()
+    contents.add_implied_dirs()
+    return contents
+
+
+def _list_differences(what, unsigned, signed):
+    new = ",".join(sorted(set(signed) - set(unsigned)))
+    removed = ",".join(sorted(set(unsigned) - set(signed)))
+    return """List of %s differs:
+Added: %s
+Missing: %s""" % (what, new, removed)
+
+
+def _run_quietly(cmd, cwd):
+    nullfd = open(os.devnull, "w")
+    try:
+        return call(cmd, cwd=cwd, stdout=nullfd)
+    finally:
+        nullfd.close()
+
+
+def check_repack(unsigned, signed, binary_checksums, fake_signatures=False,
+                 product="firefox", verified_digests=None,
+                 threads=DEFAULT_THREADS):
+    """Check that files `unsigned` and `signed` match.  Their contents are
+    read and compared.
+
+    Verifies that all non-signable files are unmodified and have the same
+    permissions.  If fake_signatures is True, then the files in `signed`
+    aren't actually signed, so they're compared to the unsigned ones to make
+    sure they're identical as well.
+
+    If fake_signatures is False, then chktrust is used to verify that signed
+    files have valid signatures.
+
+    binary_checksums contains a dict of filenames to sha1sums. These are
+    stored and used for verification inside locales across installers and
+    MARs.
+
+    verified_digests is a set of the sha1sums of binaries whose signatures
+    have been verified already; binaries with those sums aren't checked
+    again, and those that pass are added to it. Share it between the
+    installer and MAR of each locale.
+
+    Returns (result, message).
+    """
+    if not os.path.exists(unsigned):
+        return False, "%s doesn't exist" % unsigned
+    if not os.path.exists(signed):
+        return False, "%s doesn't exist" % signed
+    if verified_digests is None:
+        verified_digests = set()
+
+    def check_signature(name):
+        return not fake_signatures and shouldSign(name)
+
+    def extract_signed(name):
+        # chktest needs the dll alongside its .chk file
+        return check_signature(name) or name.endswith(".chk") or \
+            name.endswith(".dll")
+
+    unsigned_dir = os.path.abspath(tempfile.mkdtemp())
+    signed_dir = os.path.abspath(tempfile.mkdtemp())
+    try:
+        # Read both packages at once
+        pool = ThreadPool(2)
+        try:
+            u = pool.apply_async(scan_package, (unsigned, unsigned_dir),
+                                 dict(keep=["update.manifest"],
+                                      threads=threads))
+            s = pool.apply_async(scan_package, (signed, signed_dir),
+                                 dict(extract=extract_signed,
+                                      keep=["update.manifest"],
+                                      threads=threads))
+            u, s = u.get(), s.get()
+        finally:
+            pool.close()
+            pool.join()
+
+        unsigned_files = sorted(u.files)
+        if sorted(s.files) != unsigned_files:
+            return False, _list_differences("files", u.files, s.files)
+        if sorted(s.dirs) != sorted(u.dirs):
+            return False, _list_differences("directories", u.dirs, s.dirs)
+
+        # Check the directory modes
+        for d in sorted(u.dirs):
+            if s.dirs[d] != u.dirs[d]:
+                return False, "Mode mismatch (%o != %o) in %s" % (
+                    u.dirs[d], s.dirs[d], d)
+
+        tosign = []
+        chkfiles = []
+        for f in unsigned_files:
+            umode, usum = u.files[f]
+            smode, ssum = s.files[f]
+            b = os.path.basename(f)
+
+            # Check the file mode
+            if smode != umode:
+                return False, "Mode mismatch (%o != %o) in %s" % (
+                    umode, smode, f)
+
+            # Store the checksums of signed files for comparison against the
+            # corresponding file in the installer/MAR pair
+            if check_signature(f):
+                binary_checksums[b] = ssum
+                if ssum in verified_digests:
+                    log.debug("%s OK (already verified)", b)
+                else:
+                    tosign.append(f)
+            elif f == "update.manifest":
+                sf_lines = sorted(s.contents[f].splitlines(True))
+                uf_lines = sorted(u.contents[f].splitlines(True))
+                if sf_lines != uf_lines:
+                    return False, "update.manifest differs"
+                log.debug("%s OK", b)
+            elif f.endswith(".chk"):
+                chkfiles.append(f)
+            elif ssum != usum:
+                return False, "sha1sum on %s differs" % f
+            else:
+                log.debug("%s OK", b)
+
+        # Check all the signatures together
+        def chktrust(f):
+            sf = os.path.join(signed_dir, f)
+            return _run_quietly(['chktrust', '-q', os.path.basename(f)],
+                                os.path.dirname(sf))
+
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(chktrust, tosign, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for f, rc in zip(tosign, results):
+            if rc != 0:
+                return False, "Bad signature %s in %s (%s)" % (
+                    f, signed, cygpath(os.path.join(signed_dir, f)))
+            log.debug("%s OK", os.path.basename(f))
+            verified_digests.add(s.files[f][1])
+
+        for f in chkfiles:
+            sf = os.path.join(signed_dir, f)
+            cmd = ['chktest', os.path.basename(f).replace(".chk", ".dll")]
+            log.debug("Checking chk file %s" % cmd)
+            if 0 != _run_quietly(cmd, os.path.dirname(sf)):
+                return False, "Bad chk file %s" % sf
+            else:
+                log.debug("chk file OK")
+
+        return True, "OK"
+    finally:
+        shutil.rmtree(unsigned_dir)
+        shutil.rmtree(signed_dir)
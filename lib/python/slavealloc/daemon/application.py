@@ -1,5 +1,5 @@
 from twisted.application import service as tw_service, strports
-from slavealloc.data import setup
+from slavealloc.data import setup, versions
 from slavealloc.daemon import service
 from slavealloc.daemon.http import site
 
@@ -11,6 +11,7 @@ class Allocator(tw_service.MultiService):
         tw_service.MultiService.__init__(self)
 
         setup.setup(db_url, db_kwargs)
+        versions.create_tables()
 
         if run_allocator:
             self.allocator = service.AllocatorService()
@@ -1,9 +1,10 @@
 import sqlalchemy as sa
 import simplejson
+from twisted.internet import reactor, threads
 from twisted.python import log
-from twisted.web import resource
+from twisted.web import resource, server, http
 from slavealloc import exceptions
-from slavealloc.data import queries, model
+from slavealloc.data import queries, model, versions
 from slavealloc.logic import allocate, buildbottac
 
 # point your browser to /api/ to see the full set of docs
@@ -28,6 +29,21 @@ row does not exist, the API will return <tt>{}</tt> with a 404 status code.</p>
 modify the row.  The denormalized columns in the masters and slaves cannot be
 PUT.</p>
 
+<p>To modify many rows at once, PUT a list of such objects to the table's URL,
+e.g., <a href="/api/slaves">/api/slaves</a>.  Each object must include the
+row's primary key (e.g., <tt>slaveid</tt>).  All of the changes are made in a
+single transaction.</p>
+
+<p>Every change made through this interface or by the allocator increases a
+version number, which is returned as the ETag of each table's full dump;
+requests with a matching <tt>If-None-Match</tt> header get a 304 response.
+Add <tt>?since=VERSION</tt> to get only the rows of that table which have
+changed since that version, e.g., <a
+href="/api/slaves?since=0">/api/slaves?since=0</a>.  For slaves and masters,
+this includes rows whose denormalized fields have changed.  If the database has
+been reloaded (e.g., by dbimport) since that version, all rows are
+returned.</p>
+
 <p>The entire set of available tables is:
     <ul>
     %(tables)s
@@ -45,6 +61,33 @@ either {success=False} or {success=True, tac='content of buildbot.tac'}.</p>
 # base classes
 
 
+def notifyAllocator(request):
+    "let the allocator, if it's running here, know that the database changed"
+    allocator = getattr(request.site, 'allocator', None)
+    if allocator:
+        allocator.scheduleRefresh()
+
+
+def updateRows(table, id_column, updates):
+    """Apply C{updates}, a list of (id, dict of new values) tuples, to
+    C{table} in a single transaction, and return the new version"""
+    conn = model.metadata.bind.connect()
+    try:
+        trans = conn.begin()
+        try:
+            for id, sets in updates:
+                conn.execute(table.update(id_column == id), sets)
+            version = versions.record_changes(conn, table.name,
+                                              [id for id, sets in updates])
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    finally:
+        conn.close()
+    return version
+
+
 class Instance(resource.Resource):
     isLeaf = True
     okResponse = simplejson.dumps(dict(success=True))
@@ -102,9 +145,9 @@ class Instance(resource.Resource):
         log.msg("%s: updating id %s from %r" %
                 (self.table.name, self.id, sets))
 
-        wc, args = self.whereClause(require_id=True)
-        args.update(sets)
-        self.table.update(wc).execute(args)
+        assert self.id is not None
+        updateRows(self.table, self.id_column, [(int(self.id), sets)])
+        notifyAllocator(request)
 
         return self.okResponse
 
@@ -117,6 +160,14 @@ class Collection(resource.Resource):
     # class's table and just select everything
     query = None
 
+    # GET responses are written out in chunks of about this many bytes
+    chunk_size = 65536
+
+    # (column, table name) pairs for the columns of the instance class's table
+    # that refer to other tables whose values are included in GET responses;
+    # changes to those rows show up in ?since= responses
+    joins = ()
+
     def getChild(self, path_component, request):
         if not path_component:
             return
@@ -128,14 +179,119 @@ class Collection(resource.Resource):
             return self.instance_class(id=path_component)
 
     def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('Cache-control', 'no-cache')
+
         query = self.query
         if query is None:
             query = self.instance_class.table.select()
+
+        since = request.args.get('since')
+        if since:
+            try:
+                since = int(since[0])
+            except ValueError:
+                request.setResponseCode(400)
+                return simplejson.dumps(dict(success=False,
+                                             error='bad since value'))
+        else:
+            since = None
+
+        # the database is only touched from threads, so that big tables don't
+        # hold up the reactor
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def check_version(version):
+            if request.setETag('"%d"' % version) == http.CACHED:
+                request.finish()
+                return
+            return threads.deferToThread(self.writeRows, request, query,
+                                         since, finished)
+
+        def error(f):
+            log.err(f, "while writing %s" % self.instance_class.table.name)
+            if not finished:
+                request.setResponseCode(500)
+                request.finish()
+
+        d = threads.deferToThread(versions.current_version)
+        d.addCallback(check_version)
+        d.addErrback(error)
+        return server.NOT_DONE_YET
+
+    def sinceClause(self, since):
+        "a where clause selecting the rows affected by changes after C{since}"
+        table = self.instance_class.table
+        clauses = [self.instance_class.id_column.in_(
+            versions.changed_since(table.name, since))]
+        for column, tablename in self.joins:
+            clauses.append(column.in_(
+                versions.changed_since(tablename, since)))
+        return sa.or_(*clauses)
+
+    def writeRows(self, request, query, since, finished):
+        """Run C{query}, restricted to the changes after C{since} if it's not
+        None, and write the rows as a JSON list, without building it all at
+        once.  This runs in a thread, and stops early if C{finished} is
+        non-empty, meaning the client has gone away."""
+        if since is not None and since >= versions.reset_version():
+            query = query.where(self.sinceClause(since))
+
         res = query.execute()
+        try:
+            chunk = ['[']
+            size = 1
+            sep = ''
+            for row in res:
+                if finished:
+                    return
+                row = simplejson.dumps(dict(row.items()))
+                chunk.append(sep)
+                chunk.append(row)
+                size += len(row) + len(sep)
+                sep = ', '
+                if size >= self.chunk_size:
+                    reactor.callFromThread(request.write, ''.join(chunk))
+                    chunk = []
+                    size = 0
+        finally:
+            res.close()
+        chunk.append(']')
+        reactor.callFromThread(request.write, ''.join(chunk))
+        reactor.callFromThread(request.finish)
 
-        request.setHeader('content-type', 'application/json')
-        request.setHeader('Cache-control', 'no-cache')
-        return simplejson.dumps([dict(r.items()) for r in res.fetchall()])
+    def render_PUT(self, request):
+        try:
+            json = simplejson.load(request.content)
+            if not isinstance(json, list):
+                raise ValueError("expected a list")
+        except ValueError, e:
+            request.setResponseCode(400)
+            return simplejson.dumps(dict(success=False, error=str(e)))
+
+        instance_class = self.instance_class
+        id_key = instance_class.id_column.name
+        updates = []
+        for row in json:
+            if id_key not in row:
+                request.setResponseCode(400)
+                return simplejson.dumps(dict(success=False,
+                                             error='missing %s' % id_key))
+            sets = dict((k, row[k]) for k in instance_class.update_keys
+                        if k in row)
+            if sets:
+                updates.append((row[id_key], sets))
+        if not updates:
+            return instance_class.okResponse
+
+        log.msg("%s: updating %d rows" % (instance_class.table.name,
+                                          len(updates)))
+        version = updateRows(instance_class.table, instance_class.id_column,
+                             updates)
+        notifyAllocator(request)
+
+        return simplejson.dumps(dict(success=True, version=version))
 
 
 # concrete classes
@@ -154,6 +310,18 @@ class SlavesResource(Collection):
     instance_class = SlaveResource
     # set in render_GET
     query = None
+    joins = (
+        (model.slaves.c.distroid, 'distros'),
+        (model.slaves.c.bitsid, 'bitlengths'),
+        (model.slaves.c.speedid, 'speeds'),
+        (model.slaves.c.purposeid, 'purposes'),
+        (model.slaves.c.dcid, 'datacenters'),
+        (model.slaves.c.trustid, 'trustlevels'),
+        (model.slaves.c.envid, 'environments'),
+        (model.slaves.c.poolid, 'pools'),
+        (model.slaves.c.locked_masterid, 'masters'),
+        (model.slaves.c.current_masterid, 'masters'),
+    )
 
     def render_GET(self, request):
         environments = request.args.get('environment')
@@ -177,6 +345,10 @@ class MasterResource(Instance):
 class MastersResource(Collection):
     instance_class = MasterResource
     query = queries.denormalized_masters
+    joins = (
+        (model.masters.c.dcid, 'datacenters'),
+        (model.masters.c.poolid, 'pools'),
+    )
 
 # TAC templates
 
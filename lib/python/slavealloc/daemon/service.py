@@ -1,31 +1,136 @@
+import time
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, task, threads
 from twisted.application import service
-from slavealloc.logic import allocate, buildbottac
+from slavealloc.logic import buildbottac, engine
 from slavealloc import exceptions
 
 
 class AllocatorService(service.Service):
+    """
+    Allocates slaves to masters from an in-memory model of the database
+    (see L{slavealloc.logic.engine}).  All database access happens in
+    threads, one operation at a time: the slaves and masters that have changed
+    are fetched every C{refresh_interval} seconds, and new current_masterid
+    values are written back in batches every C{write_interval} seconds.
+
+    Changes are found using L{slavealloc.data.versions}, which doesn't see
+    changes made directly to the database, so everything is fetched again
+    every C{full_refresh_interval} seconds.
+
+    Allocations themselves happen in the main thread, and so are serialized.
+    """
+
+    refresh_interval = 30
+    full_refresh_interval = 3600
+    write_interval = 1
+
+    def __init__(self):
+        self.model = engine.AllocationModel()
+        self.dblock = defer.DeferredLock()
+        self.refresh_loop = None
+        self.write_loop = None
+        self.refresh_scheduled = False
+        self.last_full_refresh = 0
 
     def startService(self):
         log.msg("starting AllocatorService")
         service.Service.startService(self)
-        # doesn't do anything for now..
+        self.refresh_loop = task.LoopingCall(self.refresh)
+        self.refresh_loop.start(self.refresh_interval, now=True)
+        self.write_loop = task.LoopingCall(self.write)
+        self.write_loop.start(self.write_interval, now=False)
 
     def stopService(self):
         log.msg("stopping AllocatorService")
-        return service.Service.stopService(self)
+        for loop in self.refresh_loop, self.write_loop:
+            if loop and loop.running:
+                loop.stop()
+        # make sure everything's been written
+        d = self.write()
+        d.addCallback(lambda _: service.Service.stopService(self))
+        return d
+
+    def _inThread(self, fn, *args):
+        "run fn in a thread, once any other database operations are done"
+        return self.dblock.run(threads.deferToThread, fn, *args)
+
+    def refresh(self):
+        since = self.model.version
+        if time.time() - self.last_full_refresh > self.full_refresh_interval:
+            since = None
+        d = self._inThread(engine.fetch_changes, since)
+
+        def loaded(data):
+            self.model.load_data(data)
+            if data['full']:
+                self.last_full_refresh = time.time()
+        d.addCallback(loaded)
+
+        def failed(f):
+            log.err(f, "while refreshing allocation model")
+        d.addErrback(failed)
+        return d
+
+    def scheduleRefresh(self):
+        "refresh the model soon, e.g., because the database has been changed"
+        if self.refresh_scheduled or not self.running:
+            return
+        self.refresh_scheduled = True
+
+        def go(_):
+            self.refresh_scheduled = False
+            return self.refresh()
+        self.dblock.acquire().addCallback(
+            lambda _: self.dblock.release()).addCallback(go)
+
+    def write(self):
+        if not self.model.pending:
+            return defer.succeed(None)
+        changes = self.model.start_write()
+        d = self._inThread(engine.write_current_masters, changes)
+
+        def done(_):
+            self.model.finish_write(True)
+
+        def failed(f):
+            log.err(f, "while writing %d current masters" % len(changes))
+            self.model.finish_write(False)
+        d.addCallbacks(done, failed)
+        return d
 
     def getBuildbotTac(self, slave_name):
-        # slave allocation is *synchronous* and happens in the main thread.
-        # For now, this is a good thing - it allows us to ensure that multiple
-        # slaves are not simultaneously reassigned.  This should be revisited
-        # later.
         d = defer.succeed(None)
 
+        # wait for the initial refresh, and try again if it failed
+        def wait_for_load(_):
+            if self.model.loaded:
+                return
+            d = self.dblock.run(lambda: None)
+
+            def check(_):
+                if not self.model.loaded:
+                    return self.refresh()
+            d.addCallback(check)
+            return d
+        d.addCallback(wait_for_load)
+
+        # new slaves may not be in the model yet
+        def check_slave(_):
+            if self.model.get_slave(slave_name):
+                return
+            d = self._inThread(engine.fetch_slave, slave_name)
+
+            def got_row(row):
+                if row:
+                    self.model.update_slave(row)
+            d.addCallback(got_row)
+            return d
+        d.addCallback(check_slave)
+
         def gettac(_):
             try:
-                allocation = allocate.Allocation(slave_name)
+                allocation = self.model.allocate(slave_name)
             except exceptions.NoAllocationError:
                 log.msg("rejecting slave '%s'" % slave_name)
                 raise
@@ -163,6 +163,23 @@ masters = sa.Table('masters', metadata,
                    mysql_engine="InnoDB",
                    )
 
+# change tracking (see slavealloc.data.versions)
+
+versions = sa.Table('versions', metadata,
+                    sa.Column('name', sa.String(32), primary_key=True),
+                    sa.Column('version', sa.Integer, nullable=False),
+                    mysql_engine="InnoDB",
+                    )
+
+row_versions = sa.Table('row_versions', metadata,
+                        sa.Column(
+                        'tablename', sa.String(32), primary_key=True),
+                        sa.Column('id', sa.Integer, primary_key=True,
+                                  autoincrement=False),
+                        sa.Column('version', sa.Integer, nullable=False),
+                        mysql_engine="InnoDB",
+                        )
+
 # indices
 
 sa.Index('slave_silo',
@@ -177,3 +194,7 @@ sa.Index('slave_silo',
 
 sa.Index('slave_poolid',
          slaves.c.poolid)
+
+sa.Index('row_versions_version',
+         row_versions.c.tablename,
+         row_versions.c.version)
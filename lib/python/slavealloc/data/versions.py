@@ -0,0 +1,82 @@
+"""
+Change tracking for the HTTP API
+
+Every change made through the daemon (API PUTs and allocations) increments a
+global version number, and records that version against each row it changed.
+Clients can use the version as an ETag, or ask for only the rows changed since
+a version they've already seen.
+
+Bulk changes that don't know which rows they touched (dbinit and dbimport)
+call record_reset instead, which invalidates every earlier version.  Anything
+else that writes to the database must do one or the other, or API clients will
+keep using stale data.
+"""
+
+import sqlalchemy as sa
+from slavealloc.data import model
+
+
+def create_tables():
+    "create the change-tracking tables, if they don't exist yet"
+    for tbl in model.versions, model.row_versions:
+        tbl.create(checkfirst=True)
+
+
+def current_version(conn=None):
+    "return the current version, or 0 if nothing has been recorded yet"
+    if conn is None:
+        conn = model.metadata.bind
+    q = sa.select([model.versions.c.version],
+                  whereclause=(model.versions.c.name == 'global'))
+    return conn.execute(q).scalar() or 0
+
+
+def record_changes(conn, tablename, ids):
+    """Record that the rows of C{tablename} with ids C{ids} have changed, and
+    return the new version.  This should be called within the transaction that
+    makes the changes."""
+    res = conn.execute(model.versions.update(
+        whereclause=(model.versions.c.name == 'global'),
+        values={model.versions.c.version: model.versions.c.version + 1}))
+    if not res.rowcount:
+        conn.execute(model.versions.insert(), name='global', version=1)
+    version = current_version(conn)
+
+    rv = model.row_versions
+    for id in ids:
+        res = conn.execute(rv.update(
+            whereclause=((rv.c.tablename == tablename) & (rv.c.id == id)),
+            values=dict(version=version)))
+        if not res.rowcount:
+            conn.execute(rv.insert(), tablename=tablename, id=id,
+                         version=version)
+    return version
+
+
+def record_reset(conn):
+    """Record that any row may have changed, and return the new version.  Clients
+    asking for changes since an earlier version get everything."""
+    create_tables()
+    version = record_changes(conn, None, [])
+    res = conn.execute(model.versions.update(
+        whereclause=(model.versions.c.name == 'reset'),
+        values=dict(version=version)))
+    if not res.rowcount:
+        conn.execute(model.versions.insert(), name='reset', version=version)
+    return version
+
+
+def reset_version(conn=None):
+    "return the version of the last reset, or 0 if there hasn't been one"
+    if conn is None:
+        conn = model.metadata.bind
+    q = sa.select([model.versions.c.version],
+                  whereclause=(model.versions.c.name == 'reset'))
+    return conn.execute(q).scalar() or 0
+
+
+def changed_since(tablename, version):
+    "a query for the ids of rows in C{tablename} changed after C{version}"
+    rv = model.row_versions
+    return sa.select([rv.c.id], whereclause=(
+        (rv.c.tablename == tablename) & (rv.c.version > version)))
@@ -1,6 +1,6 @@
 import sqlalchemy
 from slavealloc import exceptions
-from slavealloc.data import queries, model
+from slavealloc.data import queries, model, versions
 
 
 class Allocation(object):
@@ -78,4 +78,15 @@ class Allocation(object):
         q = model.slaves.update(
             whereclause=(model.slaves.c.slaveid == self.slaveid),
             values=dict(current_masterid=self.masterid))
-        q.execute()
+        conn = model.metadata.bind.connect()
+        try:
+            trans = conn.begin()
+            try:
+                conn.execute(q)
+                versions.record_changes(conn, 'slaves', [self.slaveid])
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
@@ -0,0 +1,284 @@
+import sqlalchemy as sa
+from slavealloc import exceptions
+from slavealloc.data import model, versions
+from slavealloc.logic import allocate
+
+# the columns that put a slave into a silo; slaves are balanced across masters
+# with the other slaves in their silo.  This matches queries.best_master.
+silo_columns = ('poolid', 'distroid', 'bitsid', 'purposeid', 'dcid',
+                'trustid', 'envid')
+
+# functions to fetch data from the database.  These are meant to be run in a
+# thread, and return plain python objects
+
+
+def _rows(q):
+    return [dict(r.items()) for r in q.execute().fetchall()]
+
+
+def fetch_all():
+    """fetch everything AllocationModel needs from the database, along with
+    the version (see L{slavealloc.data.versions}) it's up to date with"""
+    # anything that changes after this will be fetched again next time
+    version = versions.current_version()
+    return dict(
+        full=True,
+        version=version,
+        slaves=_rows(model.slaves.select()),
+        masters=_rows(model.masters.select()),
+        tac_templates=_rows(model.tac_templates.select()),
+        slave_passwords=_rows(model.slave_passwords.select()),
+    )
+
+
+def fetch_changes(since):
+    """fetch the slaves and masters that have changed after version C{since}.
+    If C{since} is None, or the database has been reset since then, this is
+    the same as fetch_all."""
+    if since is None or versions.reset_version() > since:
+        return fetch_all()
+    version = versions.current_version()
+
+    def changed(table, id_column):
+        return _rows(table.select(
+            id_column.in_(versions.changed_since(table.name, since))))
+    return dict(
+        full=False,
+        version=version,
+        slaves=changed(model.slaves, model.slaves.c.slaveid),
+        masters=changed(model.masters, model.masters.c.masterid),
+    )
+
+
+def fetch_slave(slavename):
+    "fetch a single slave's row, or None"
+    row = model.slaves.select(
+        whereclause=(model.slaves.c.name == slavename)).execute().fetchone()
+    if row:
+        return dict(row.items())
+
+
+def write_current_masters(current_masters):
+    """write a dictionary of { slaveid : current_masterid } to the database,
+    in a single transaction, recording the change (see
+    L{slavealloc.data.versions})"""
+    if not current_masters:
+        return
+    q = model.slaves.update(
+        whereclause=(model.slaves.c.slaveid == sa.bindparam('b_slaveid')),
+        values=dict(current_masterid=sa.bindparam('b_masterid')))
+    conn = model.metadata.bind.connect()
+    try:
+        trans = conn.begin()
+        try:
+            conn.execute(q, [dict(b_slaveid=s, b_masterid=m)
+                             for s, m in current_masters.iteritems()])
+            versions.record_changes(conn, 'slaves', current_masters.keys())
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    finally:
+        conn.close()
+
+
+class ModelAllocation(allocate.Allocation):
+    """
+    An allocation made from an AllocationModel, rather than the database.
+    Committing it updates the model immediately, and queues the new
+    current_masterid to be written to the database.
+    """
+
+    def __init__(self, allocmodel, slavename):
+        self.allocmodel = allocmodel
+        self.slavename = slavename
+
+        slave = allocmodel.get_slave(slavename)
+        if not slave:
+            raise exceptions.NoAllocationError
+        self.slaveid = slave['slaveid']
+        self.enabled = slave['enabled']
+        self.slave_basedir = slave['basedir']
+
+        # bail out early if this slave is not enabled
+        if not self.enabled:
+            return
+
+        self.slave_password = allocmodel.get_password(slave)
+
+        if slave['locked_masterid']:
+            master = allocmodel.masters.get(slave['locked_masterid'])
+        else:
+            master = allocmodel.best_master(slave)
+
+        if not master:
+            raise exceptions.NoAllocationError
+        self.master_nickname = master['nickname']
+        self.master_fqdn = master['fqdn']
+        self.master_pb_port = master['pb_port']
+        self.masterid = master['masterid']
+
+        # get the desired template (or None for default)
+        self.template = allocmodel.tac_templates.get(slave['custom_tplid'])
+
+    def commit(self):
+        self.allocmodel.set_current_master(self.slaveid, self.masterid)
+
+
+class AllocationModel(object):
+    """
+    An in-memory copy of the slaves, masters, templates and passwords in the
+    database, along with the number of slaves in each silo attached to each
+    master, so that allocations can be made without querying the database.
+
+    This is not thread-safe: everything except the fetch_* and
+    write_current_masters functions should be called from the same thread.
+
+    @ivar pending: current_masterid changes that have not been written to the
+    database yet, as { slaveid : masterid }
+    """
+
+    def __init__(self):
+        self.slaves = {}
+        self.slaves_by_name = {}
+        self.masters = {}
+        self.masters_by_pool = {}
+        self.tac_templates = {}
+        self.slave_passwords = []
+        # { (silo, masterid) : number of slaves }
+        self.load = {}
+        self.pending = {}
+        # changes that are being written right now
+        self.writing = {}
+        self.loaded = False
+        # the database version we're up to date with
+        self.version = None
+
+    # loading
+
+    def load_data(self, data):
+        """Update the model from the result of fetch_all or fetch_changes.
+        Slaves are updated in place, so only those that have changed affect
+        the load counts."""
+        if not data['full']:
+            for m in data['masters']:
+                self.masters[m['masterid']] = m
+            self._index_masters()
+            for row in data['slaves']:
+                self.update_slave(row)
+            self.version = data['version']
+            return
+
+        self.masters = dict((m['masterid'], m) for m in data['masters'])
+        self._index_masters()
+        self.tac_templates = dict((t['tplid'], t['template'])
+                                  for t in data['tac_templates'])
+        self.slave_passwords = data['slave_passwords']
+
+        seen = set()
+        for row in data['slaves']:
+            self.update_slave(row)
+            seen.add(row['slaveid'])
+        for slaveid in set(self.slaves) - seen:
+            self.remove_slave(slaveid)
+        self.version = data['version']
+        self.loaded = True
+
+    def _index_masters(self):
+        self.masters_by_pool = {}
+        for m in sorted(self.masters.itervalues(),
+                        key=lambda m: m['masterid']):
+            self.masters_by_pool.setdefault(m['poolid'], []).append(m)
+
+    def update_slave(self, row):
+        "Add or update a slave from its database row"
+        slaveid = row['slaveid']
+        row = dict(row)
+        # the database hasn't caught up with our allocations yet
+        for changes in self.writing, self.pending:
+            if slaveid in changes:
+                row['current_masterid'] = changes[slaveid]
+
+        old = self.slaves.get(slaveid)
+        if old:
+            if old == row:
+                return
+            self.remove_slave(slaveid)
+        self.slaves[slaveid] = row
+        # database collations are generally case-insensitive
+        self.slaves_by_name[row['name'].lower()] = row
+        self._count(row, 1)
+
+    def remove_slave(self, slaveid):
+        slave = self.slaves.pop(slaveid)
+        if self.slaves_by_name.get(slave['name'].lower()) is slave:
+            del self.slaves_by_name[slave['name'].lower()]
+        self._count(slave, -1)
+
+    def _count(self, slave, delta):
+        masterid = slave['current_masterid']
+        if masterid is None:
+            return
+        key = (self.silo(slave), masterid)
+        self.load[key] = self.load.get(key, 0) + delta
+        if not self.load[key]:
+            del self.load[key]
+
+    # allocation
+
+    def silo(self, slave):
+        return tuple(slave[c] for c in silo_columns)
+
+    def get_slave(self, slavename):
+        return self.slaves_by_name.get(slavename.lower())
+
+    def get_password(self, slave):
+        for p in self.slave_passwords:
+            if p['poolid'] == slave['poolid'] and \
+               p['distroid'] in (None, slave['distroid']):
+                return p['password']
+
+    def best_master(self, slave):
+        """Find the enabled master in the slave's pool with the fewest other
+        slaves from the same silo, breaking ties by masterid"""
+        silo = self.silo(slave)
+        best = None
+        for master in self.masters_by_pool.get(slave['poolid'], []):
+            if not master['enabled']:
+                continue
+            count = self.load.get((silo, master['masterid']), 0)
+            if slave['current_masterid'] == master['masterid']:
+                count -= 1
+            # masters_by_pool is sorted by masterid, so the first wins ties
+            if best is None or count < best[0]:
+                best = (count, master)
+        if best:
+            return best[1]
+
+    def allocate(self, slavename):
+        return ModelAllocation(self, slavename)
+
+    def set_current_master(self, slaveid, masterid):
+        slave = self.slaves[slaveid]
+        if slave['current_masterid'] != masterid:
+            self._count(slave, -1)
+            slave['current_masterid'] = masterid
+            self._count(slave, 1)
+        self.pending[slaveid] = masterid
+
+    # writing
+
+    def start_write(self):
+        "Take the pending changes, to be passed to write_current_masters"
+        self.writing = self.pending
+        self.pending = {}
+        return self.writing
+
+    def finish_write(self, success):
+        """Call when the changes from start_write have been written, or have
+        failed to be written"""
+        if not success:
+            # try again next time, unless there's a newer change
+            for slaveid, masterid in self.writing.iteritems():
+                self.pending.setdefault(slaveid, masterid)
+        self.writing = {}
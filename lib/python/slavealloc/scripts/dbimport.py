@@ -1,7 +1,7 @@
 import simplejson
 import csv
 import sqlalchemy as sa
-from slavealloc.data import model
+from slavealloc.data import model, versions
 
 
 def setup_argparse(subparsers):
@@ -147,6 +147,9 @@ def main(args):
                  password=row['password'])
             for row in passwords])
 
+    # let API clients know that everything has changed
+    versions.record_reset(model.metadata.bind)
+
 
 def json2list(json_file):
     # note that this embodies some releng-specific smarts at the moment
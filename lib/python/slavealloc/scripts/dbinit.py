@@ -1,5 +1,5 @@
 import cPickle
-from slavealloc.data import model, setup
+from slavealloc.data import model, setup, versions
 
 
 def setup_argparse(subparsers):
@@ -33,6 +33,9 @@ def main(args):
     if args.dumpfile:
         load_data(args)
 
+    # let API clients know that everything has changed
+    versions.record_reset(model.metadata.bind)
+
 
 def load_data(args):
     # see dbdump.py for the data format here
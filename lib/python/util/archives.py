@@ -5,6 +5,8 @@ import logging
 import tempfile
 import bz2
 import shutil
+import struct
+import tarfile
 
 from util.paths import cygpath, findfiles
 
@@ -148,6 +150,70 @@ def packmar(marfile, srcdir):
     nullfd.close()
 
 
+def read_mar_index(marfile):
+    """Returns a list of (name, offset, size, flags) for each member of
+    marfile, without unpacking it"""
+    f = open(marfile, 'rb')
+    try:
+        magic, index_offset = struct.unpack(">4sL", f.read(8))
+        if magic != "MAR1":
+            raise ValueError("%s isn't a mar file" % marfile)
+        f.seek(index_offset)
+        index_size = struct.unpack(">L", f.read(4))[0]
+        index = f.read(index_size)
+    finally:
+        f.close()
+
+    members = []
+    pos = 0
+    while pos < len(index):
+        offset, size, flags = struct.unpack_from(">LLL", index, pos)
+        end = index.index("\0", pos + 12)
+        members.append((index[pos + 12:end], offset, size, flags))
+        pos = end + 1
+    return members
+
+
+def iter_mar_member(marfile, offset, size, decompress=True,
+                    blocksize=512 * 1024):
+    """Generates the data of the member of marfile at `offset`, in blocks.
+    If decompress is set, the data is uncompressed with bz2 on the way.
+
+    The mar file is opened separately for each member, so several members
+    can be read at once from different threads."""
+    f = open(marfile, 'rb')
+    try:
+        f.seek(offset)
+        if decompress:
+            decomp = bz2.BZ2Decompressor()
+        while size > 0:
+            block = f.read(min(blocksize, size))
+            if not block:
+                raise ValueError("%s is truncated" % marfile)
+            size -= len(block)
+            if decompress:
+                block = decomp.decompress(block)
+            yield block
+    finally:
+        f.close()
+
+
+def iter_tar_members(tar_file):
+    """Generates (TarInfo, file object) for each member of tar_file, reading
+    it in a single pass. The file object is None for anything that isn't a
+    regular file, and can only be read from until the next member is
+    generated."""
+    tar = tarfile.open(tar_file, 'r|*')
+    try:
+        for info in tar:
+            if info.isfile():
+                yield info, tar.extractfile(info)
+            else:
+                yield info, None
+    finally:
+        tar.close()
+
+
 def unpacktar(tarfile, destdir):
     """ Unpack given tarball into the specified dir """
     nullfd = open(os.devnull, "w")
@@ -3,6 +3,11 @@ import subprocess
 import os
 import time
 import platform
+import signal
+import select
+import errno
+import threading
+from util.rmtree import rmtree
 import logging
 log = logging.getLogger(__name__)
 
@@ -71,14 +76,202 @@ def run_remote_cmd(cmd, server, username=None, sshKey=None, ssh='ssh',
     return run_cmd(cmd_prefix + cmd, **kwargs)
 
 
+def _select_wait_read(fd, timeout):
+    """Waits up to `timeout` seconds for fd to be readable, returning True if
+    it is"""
+    try:
+        return bool(select.select([fd], [], [], timeout)[0])
+    except select.error, e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return False
+
+
+class ProcessWatcher(object):
+    """
+    Lets the exit of `proc` (a subprocess.Popen object) be waited for
+    without polling it.
+
+    A thread blocks in wait4() for the process, and then writes to a pipe, so
+    that wait() can select on the pipe with a timeout. `wait_read(fd,
+    timeout)` is what's used to wait for the pipe; it should return True if
+    fd is readable. Pass in one built on gevent.socket.wait_read to wait from
+    a greenlet. Where there's no wait4(), the thread simply waits for the
+    process and sets an Event.
+
+    Once the process has exited, `wall_time` is how long it ran for, and
+    `cpu_time` is the user and system time used by it and the children it
+    waited for, if the platform can tell us.
+    """
+
+    def __init__(self, proc, wait_read=None):
+        self.proc = proc
+        self.start_time = time.time()
+        self.end_time = None
+        self.rusage = None
+        self.timed_out = False
+        self._exited = threading.Event()
+        if hasattr(os, 'wait4'):
+            self._r, self._w = os.pipe()
+            self._wait_read = wait_read or _select_wait_read
+        else:
+            self._r = self._w = None
+            self._wait_read = None
+        t = threading.Thread(target=self._reap, name="wait-%i" % proc.pid)
+        t.daemon = True
+        t.start()
+
+    def _reap(self):
+        try:
+            if self._w is None:
+                self.proc.wait()
+                return
+            while True:
+                try:
+                    pid, status, self.rusage = os.wait4(self.proc.pid, 0)
+                    break
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+            if os.WIFSIGNALED(status):
+                self.proc.returncode = -os.WTERMSIG(status)
+            else:
+                self.proc.returncode = os.WEXITSTATUS(status)
+        except OSError:
+            # Somebody else has waited for it already
+            log.debug("%s: couldn't wait for process", self.proc.pid,
+                      exc_info=True)
+            self.proc.poll()
+        finally:
+            self.end_time = time.time()
+            self._exited.set()
+            if self._w is not None:
+                os.write(self._w, 'x')
+                os.close(self._w)
+
+    def wait(self, timeout=None):
+        """Waits up to `timeout` seconds (or for as long as it takes, if it's
+        None) for the process to exit. Returns its return code, or None if it
+        is still running."""
+        if not self._exited.is_set():
+            if self._wait_read:
+                self._wait_read(self._r, timeout)
+            else:
+                self._exited.wait(timeout)
+        if not self._exited.is_set():
+            return None
+        if self._r is not None:
+            os.close(self._r)
+            self._r = None
+            self._wait_read = None
+        return self.proc.returncode
+
+    def kill(self, signals=(signal.SIGINT, signal.SIGTERM), grace=1,
+             group=False):
+        """Sends each of `signals` to the process in turn, followed by
+        SIGKILL, until it exits. After each signal it gets `grace` seconds to
+        exit. If `group` is set, the signals are sent to the process group
+        first as well. Returns the process's return code."""
+        if os.name == 'nt':
+            if self.wait(0) is None:
+                self.proc.kill()
+            return self.wait()
+
+        for sig in list(signals) + [signal.SIGKILL]:
+            if self.wait(0) is not None:
+                break
+            try:
+                # Kill off the process group first, and then the process
+                # itself for good measure
+                if group:
+                    os.kill(-self.proc.pid, sig)
+                os.kill(self.proc.pid, sig)
+            except OSError:
+                # The process is gone now
+                break
+            if sig != signal.SIGKILL and self.wait(grace) is not None:
+                break
+        return self.wait()
+
+    @property
+    def wall_time(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def cpu_time(self):
+        if self.rusage is None:
+            return None
+        return self.rusage.ru_utime + self.rusage.ru_stime
+
+    def format_times(self):
+        if self.cpu_time is None:
+            return "%.2fs elapsed" % self.wall_time
+        return "%.2fs elapsed, %.2fs cpu" % (self.wall_time, self.cpu_time)
+
+
+def supervise(proc, timeout=None, warning_interval=None,
+              warning_callback=None, kill_group=False, kill_grace=1,
+              wait_read=None):
+    """Waits for `proc` (a subprocess.Popen object) to exit, and returns the
+    ProcessWatcher used to do so, which has its times.
+
+    If the process takes longer than `timeout` seconds, it is killed (see
+    ProcessWatcher.kill) and the watcher's timed_out attribute is set.
+    warning_callback is called with the following arguments every
+    `warning_interval` seconds that the process is running for:
+        start_time, elapsed, proc
+    """
+    watcher = ProcessWatcher(proc, wait_read)
+    start_time = watcher.start_time
+    deadline = None
+    next_warning = None
+    if timeout is not None:
+        deadline = start_time + timeout
+    if warning_interval and warning_callback:
+        next_warning = start_time + warning_interval
+
+    while True:
+        wakeups = [t for t in (deadline, next_warning) if t is not None]
+        if wakeups:
+            wait_time = max(min(wakeups) - time.time(), 0)
+        else:
+            wait_time = None
+        rc = watcher.wait(wait_time)
+        if rc is not None:
+            log.debug("%s: Process returned %s (%s)", proc.pid, rc,
+                      watcher.format_times())
+            return watcher
+
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            log.debug("%s: Exceeded timeout", proc.pid)
+            watcher.timed_out = True
+            watcher.kill(group=kill_group, grace=kill_grace)
+            return watcher
+
+        if next_warning is not None and now >= next_warning:
+            # reset next_warning to avoid spamming callback
+            next_warning = now + warning_interval
+            log.debug("Calling warning_callback function: %s(%s)" %
+                      (warning_callback, start_time))
+            try:
+                warning_callback(start_time, now - start_time, proc)
+            except Exception:
+                log.error("Callback raised an exception, ignoring...",
+                          exc_info=True)
+
+
 def run_cmd_periodic_poll(cmd, warning_interval=300, poll_interval=0.25,
                           warning_callback=None, **kwargs):
-    """Run cmd (a list of arguments) in a subprocess and check its completion
-    periodically.  Raise subprocess.CalledProcessError if the command exits
-    with non-zero.  If the command returns successfully, return 0.
+    """Run cmd (a list of arguments) in a subprocess and wait for it to
+    complete (see supervise).  Raise subprocess.CalledProcessError if the
+    command exits with non-zero.  If the command returns successfully, return
+    0.
     warning_callback function will be called with the following arguments if the
     command's execution takes longer then warning_interval:
         start_time, elapsed, proc
+    poll_interval is no longer used, since the command's exit is waited for
+    directly.
     """
     log_cmd(cmd, **kwargs)
     # We update this after logging because we don't want all of the inherited
@@ -87,43 +280,22 @@ def run_cmd_periodic_poll(cmd, warning_interval=300, poll_interval=0.25,
         kwargs['env'] = merge_env(kwargs['env'])
     log.info("command: output:")
     proc = subprocess.Popen(cmd, **kwargs)
-    start_time = time.time()
-    last_check = start_time
-
-    while True:
-        rc = proc.poll()
-
-        if rc is not None:
-            log.debug("Process returned %s", rc)
-            if rc == 0:
-                elapsed = time.time() - start_time
-                log.info("command: END (%.2fs elapsed)\n", elapsed)
-                return 0
-            else:
-                raise subprocess.CalledProcessError(rc, cmd)
 
-        now = time.time()
-        if now - last_check > warning_interval:
-            # reset last_check to avoid spamming callback
-            last_check = now
-            elapsed = now - start_time
-            if warning_callback:
-                log.debug("Calling warning_callback function: %s(%s)" %
-                          (warning_callback, start_time))
-                try:
-                    warning_callback(start_time, elapsed, proc)
-                except Exception:
-                    log.error("Callback raised an exception, ignoring...",
-                              exc_info=True)
-            else:
-                log.warning("Command execution is taking longer than"
-                            "warning_interval (%d)"
-                            ", executing warning_callback"
-                            "Started at: %s, elapsed: %.2fs" % (warning_interval,
-                                                                start_time,
-                                                                elapsed))
+    if not warning_callback:
+        def warning_callback(start_time, elapsed, proc):
+            log.warning("Command execution is taking longer than"
+                        "warning_interval (%d)"
+                        ", executing warning_callback"
+                        "Started at: %s, elapsed: %.2fs" % (warning_interval,
+                                                            start_time,
+                                                            elapsed))
 
-        time.sleep(poll_interval)
+    watcher = supervise(proc, warning_interval=warning_interval,
+                        warning_callback=warning_callback)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    log.info("command: END (%s)\n", watcher.format_times())
+    return 0
 
 
 def get_output(cmd, include_stderr=False, dont_log=False, **kwargs):
@@ -163,10 +335,11 @@ def get_output(cmd, include_stderr=False, dont_log=False, **kwargs):
         log.info("command: END (%.2f elapsed)\n", elapsed)
 
 
-def remove_path(path):
-    """This is a replacement for shutil.rmtree that works better under
-    windows. Thanks to Bear at the OSAF for the code.
-    (Borrowed from buildbot.slave.commands)"""
+def remove_path(path, background=False):
+    """Removes path, which may be a file or a directory tree.
+
+    If background is set, directories are moved out of the way and removed
+    by a detached process (see util.rmtree.rmtree)."""
     log.debug("Removing %s", path)
 
     if _is_windows():
@@ -174,38 +347,7 @@ def remove_path(path):
         _rmtree_windows(path)
         return
 
-    if not os.path.exists(path):
-        # This handles broken links
-        if os.path.islink(path):
-            os.remove(path)
-        return
-
-    if os.path.islink(path):
-        os.remove(path)
-        return
-
-    # Verify the directory is read/write/execute for the current user
-    os.chmod(path, 0700)
-
-    for name in os.listdir(path):
-        full_name = os.path.join(path, name)
-        # on Windows, if we don't have write permission we can't remove
-        # the file/directory either, so turn that on
-        if os.name == 'nt':
-            if not os.access(full_name, os.W_OK):
-                # I think this is now redundant, but I don't have an NT
-                # machine to test on, so I'm going to leave it in place
-                # -warner
-                os.chmod(full_name, 0600)
-
-        if os.path.isdir(full_name):
-            remove_path(full_name)
-        else:
-            # Don't try to chmod links
-            if not os.path.islink(full_name):
-                os.chmod(full_name, 0700)
-            os.remove(full_name)
-    os.rmdir(path)
+    rmtree(path, background=background)
 
 
 # _is_windows and _rmtree_windows taken
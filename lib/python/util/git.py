@@ -7,6 +7,7 @@ import re
 
 from util.commands import run_cmd, remove_path, run_quiet_cmd
 from util.file import safe_unlink
+from util.mirrors import order_mirrors, record_failure, probe_git
 
 import logging
 log = logging.getLogger(__name__)
@@ -304,7 +305,7 @@ def clone(repo, dest, refname=None, mirrors=None, shared=False, update_dest=True
     there.  The working copy will be empty.
 
     If `mirrors` is set, will try and clone from the mirrors before
-    cloning from `repo`.
+    cloning from `repo`. Mirrors are tried fastest first; see util.mirrors.
 
     If `shared` is True, then git shared repos will be used
 
@@ -315,7 +316,7 @@ def clone(repo, dest, refname=None, mirrors=None, shared=False, update_dest=True
 
     if mirrors:
         log.info("Attempting to clone from mirrors")
-        for mirror in mirrors:
+        for mirror in order_mirrors(mirrors, probe_git):
             log.info("Cloning from %s", mirror)
             try:
                 retval = clone(mirror, dest, refname, update_dest=update_dest)
@@ -324,6 +325,7 @@ def clone(repo, dest, refname=None, mirrors=None, shared=False, update_dest=True
                 raise
             except Exception:
                 log.exception("Problem cloning from mirror %s", mirror)
+                record_failure(mirror)
                 continue
         else:
             log.info("Pulling from mirrors failed; falling back to %s", repo)
@@ -372,16 +374,17 @@ def fetch(repo, dest, refname=None, remote_name="origin", fetch_remote=None, mir
     """Fetches changes from git repo and places it in `dest`.
 
     If `mirrors` is set, will try and fetch from the mirrors first before
-    `repo`."""
+    `repo`. Mirrors are tried fastest first; see util.mirrors."""
 
     if mirrors:
-        for mirror in mirrors:
+        for mirror in order_mirrors(mirrors, probe_git):
             try:
                 return fetch(mirror, dest, refname=refname)
             except KeyboardInterrupt:
                 raise
             except Exception:
                 log.exception("Problem fetching from mirror %s", mirror)
+                record_failure(mirror)
                 continue
         else:
             log.info("Pulling from mirrors failed; falling back to %s", repo)
@@ -3,11 +3,14 @@ import os
 import re
 import subprocess
 import sys
+import time
 from urlparse import urlsplit
 from ConfigParser import RawConfigParser
 
-from util.commands import run_cmd, get_output, remove_path
+from util.commands import run_cmd, get_output, remove_path, log_cmd
 from util.retry import retry, retrier
+from util import hgcmdserver
+from util.mirrors import order_mirrors, record_failure, probe_hg, probe_file
 
 import logging
 log = logging.getLogger(__name__)
@@ -20,6 +23,17 @@ TRANSIENT_HG_ERRORS = (
 
 RETRY_ATTEMPTS = 3
 
+# Whether to run hg commands in existing repositories through a long-lived
+# command server (see util.hgcmdserver), rather than a new hg process each
+# time. Set HG_CMDSERVER=1 in the environment, or call use_cmdserver(), to
+# turn this on.
+USE_CMDSERVER = os.environ.get('HG_CMDSERVER') == '1'
+
+
+def use_cmdserver(enabled=True):
+    global USE_CMDSERVER
+    USE_CMDSERVER = enabled
+
 
 class DefaultShareBase:
     pass
@@ -67,6 +81,46 @@ def get_repo_path(repo):
         return urlsplit(repo).path.lstrip("/")
 
 
+def _cmdserver_output(cmd, cwd=None, include_stderr=False, dont_log=False):
+    """Runs hg with the given arguments in the repository at `cwd` using a
+    command server, and returns its output like get_output does. Returns None
+    if the command server can't be used."""
+    if not USE_CMDSERVER or not cwd:
+        return None
+    # Extensions can only be enabled when the command server starts
+    if '--config' in cmd:
+        return None
+    server = hgcmdserver.get_server(cwd)
+    if not server:
+        return None
+
+    log_cmd(['hg'] + cmd, cwd=cwd)
+    log.info("command: using command server")
+    t = time.time()
+    try:
+        ret, output, error = server.runcommand(cmd)
+    except hgcmdserver.CommandServerError:
+        log.warning("command server failed; running hg instead",
+                    exc_info=True)
+        hgcmdserver.close_server(cwd)
+        return None
+    finally:
+        log.info("command: END (%.2f elapsed)\n", time.time() - t)
+
+    if include_stderr:
+        output += error
+    elif error:
+        log.info(error)
+    if ret != 0:
+        e = subprocess.CalledProcessError(ret, ['hg'] + cmd)
+        e.output = output
+        raise e
+    if not dont_log:
+        log.info("command: output:")
+        log.info(output)
+    return output
+
+
 def get_hg_output(cmd, **kwargs):
     """
     Runs hg with the given arguments and sets HGPLAIN in the environment to
@@ -75,7 +129,16 @@ def get_hg_output(cmd, **kwargs):
         env = {}
         env['HGPLAIN'] = '1'
         return get_output(['hg'] + cmd, env=env, **kwargs)
+
+    If USE_CMDSERVER is set and `cwd` is a repository, the command is run by
+    that repository's command server instead.
     """
+    if USE_CMDSERVER and not kwargs.get('env') and \
+            set(kwargs) <= set(['cwd', 'include_stderr', 'dont_log']):
+        output = _cmdserver_output(cmd, **kwargs)
+        if output is not None:
+            return output
+
     if 'env' in kwargs:
         env = kwargs['env']
         del kwargs['env']
@@ -85,6 +148,13 @@ def get_hg_output(cmd, **kwargs):
     return get_output(['hg'] + cmd, env=env, **kwargs)
 
 
+def run_hg(cmd, cwd=None):
+    """Runs hg with the given arguments, like run_cmd(['hg'] + cmd), using
+    the command server for `cwd` if USE_CMDSERVER is set"""
+    if _cmdserver_output(cmd, cwd, include_stderr=True) is None:
+        run_cmd(['hg'] + cmd, cwd=cwd)
+
+
 def get_revision(path):
     """Returns which revision directory `path` currently has checked out."""
     return get_hg_output(['parent', '--template', '{node|short}'], cwd=path)
@@ -111,9 +181,15 @@ def is_hg_cset(rev):
         return False
 
 
+_hg_ver = None
+
+
 def hg_ver():
     """Returns the current version of hg, as a tuple of
-    (major, minor, build)"""
+    (major, minor, build). This is only checked once."""
+    global _hg_ver
+    if _hg_ver:
+        return _hg_ver
     ver_string = get_hg_output(['-q', 'version'])
     match = re.search("\(version ([0-9.]+)\)", ver_string)
     if match:
@@ -124,6 +200,7 @@ def hg_ver():
     else:
         ver = (0, 0, 0)
     log.debug("Running hg version %s", ver)
+    _hg_ver = ver
     return ver
 
 
@@ -143,19 +220,19 @@ def update(dest, branch=None, revision=None):
     current branch.  Local changes will be discarded."""
     # If we have a revision, switch to that
     if revision is not None:
-        cmd = ['hg', 'update', '-C', '-r', revision]
-        run_cmd(cmd, cwd=dest)
+        cmd = ['update', '-C', '-r', revision]
+        run_hg(cmd, cwd=dest)
     else:
         # Check & switch branch
         local_branch = get_hg_output(['branch'], cwd=dest).strip()
 
-        cmd = ['hg', 'update', '-C']
+        cmd = ['update', '-C']
 
         # If this is different, checkout the other branch
         if branch and branch != local_branch:
             cmd.append(branch)
 
-        run_cmd(cmd, cwd=dest)
+        run_hg(cmd, cwd=dest)
     return get_revision(dest)
 
 
@@ -171,7 +248,7 @@ def clone(repo, dest, branch=None, revision=None, update_dest=True,
     set, otherwise to `branch`, otherwise to the head of default.
 
     If `mirrors` is set, will try and clone from the mirrors before
-    cloning from `repo`.
+    cloning from `repo`. Mirrors are tried fastest first; see util.mirrors.
 
     If `bundles` is set, will try and download the bundle first and
     unbundle it. If successful, will pull in new revisions from mirrors or
@@ -186,7 +263,7 @@ def clone(repo, dest, branch=None, revision=None, update_dest=True,
 
     if bundles:
         log.info("Attempting to initialize clone with bundles")
-        for bundle in bundles:
+        for bundle in order_mirrors(bundles, probe_file):
             if os.path.exists(dest):
                 remove_path(dest)
             init(dest)
@@ -202,13 +279,14 @@ def clone(repo, dest, branch=None, revision=None, update_dest=True,
             except Exception:
                 remove_path(dest)
                 log.exception("Problem unbundling/pulling from %s", bundle)
+                record_failure(bundle)
                 continue
         else:
             log.info("Using bundles failed; falling back to clone")
 
     if mirrors:
         log.info("Attempting to clone from mirrors")
-        for mirror in mirrors:
+        for mirror in order_mirrors(mirrors, probe_hg):
             log.info("Cloning from %s", mirror)
             try:
                 retval = clone(mirror, dest, branch, revision,
@@ -217,6 +295,7 @@ def clone(repo, dest, branch=None, revision=None, update_dest=True,
                 return retval
             except:
                 log.exception("Problem cloning from mirror %s", mirror)
+                record_failure(mirror)
                 continue
         else:
             log.info("Pulling from mirrors failed; falling back to %s", repo)
@@ -289,14 +368,15 @@ def pull(repo, dest, update_dest=True, mirrors=None, **kwargs):
     set, otherwise to `branch`, otherwise to the head of default.
 
     If `mirrors` is set, will try and pull from the mirrors first before
-    `repo`."""
+    `repo`. Mirrors are tried fastest first; see util.mirrors."""
 
     if mirrors:
-        for mirror in mirrors:
+        for mirror in order_mirrors(mirrors, probe_hg):
             try:
                 return pull(mirror, dest, update_dest=update_dest, **kwargs)
             except:
                 log.exception("Problem pulling from mirror %s", mirror)
+                record_failure(mirror)
                 continue
         else:
             log.info("Pulling from mirrors failed; falling back to %s", repo)
@@ -370,14 +450,14 @@ def out(src, remote, **kwargs):
 
 
 def push(src, remote, push_new_branches=True, force=False, **kwargs):
-    cmd = ['hg', 'push']
+    cmd = ['push']
     cmd.extend(common_args(**kwargs))
     if force:
         cmd.append('-f')
     if push_new_branches:
         cmd.append('--new-branch')
     cmd.append(remote)
-    run_cmd(cmd, cwd=src)
+    run_hg(cmd, cwd=src)
 
 
 def mercurial(repo, dest, branch=None, revision=None, update_dest=True,
@@ -409,8 +489,7 @@ def mercurial(repo, dest, branch=None, revision=None, update_dest=True,
         shareBase = os.environ.get("HG_SHARE_BASE_DIR", None)
 
     log.info("Reporting hg version in use")
-    cmd = ['hg', '-q', 'version']
-    run_cmd(cmd, cwd='.')
+    log.info("hg version %s", ".".join(str(v) for v in hg_ver()))
 
     if shareBase:
         # Check that 'hg share' works
@@ -659,15 +738,15 @@ def adjust_paths(dest, **paths):
 
 
 def commit(dest, msg, user=None):
-    cmd = ['hg', 'commit', '-m', msg]
+    cmd = ['commit', '-m', msg]
     if user:
         cmd.extend(['-u', user])
-    run_cmd(cmd, cwd=dest)
+    run_hg(cmd, cwd=dest)
     return get_revision(dest)
 
 
 def tag(dest, tags, user=None, msg=None, rev=None, force=None):
-    cmd = ['hg', 'tag']
+    cmd = ['tag']
     if user:
         cmd.extend(['-u', user])
     if msg:
@@ -677,12 +756,12 @@ def tag(dest, tags, user=None, msg=None, rev=None, force=None):
     if force:
         cmd.append('-f')
     cmd.extend(tags)
-    run_cmd(cmd, cwd=dest)
+    run_hg(cmd, cwd=dest)
     return get_revision(dest)
 
 
 def merge_via_debugsetparents(dest, old_head, new_head, msg, user=None):
     """Merge 2 heads avoiding non-fastforward commits"""
-    cmd = ['hg', 'debugsetparents', new_head, old_head]
-    run_cmd(cmd, cwd=dest)
+    cmd = ['debugsetparents', new_head, old_head]
+    run_hg(cmd, cwd=dest)
     commit(dest, msg=msg, user=user)
@@ -0,0 +1,169 @@
+"""A client for Mercurial's command server.
+
+Rather than starting a new hg process for every command, a single
+`hg serve --cmdserver pipe` process is started per repository, and commands
+are sent to it over its stdin/stdout. This saves Python startup and
+repository loading time for each command.
+
+See https://www.mercurial-scm.org/wiki/CommandServer for the protocol.
+"""
+import os
+import struct
+import subprocess
+import atexit
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class CommandServerError(Exception):
+    pass
+
+
+def _repo_stamp(repo):
+    """Returns something that changes if `repo` is replaced, or if its
+    configuration changes. The command server only reads .hg/hgrc when it
+    starts."""
+    hgdir = os.path.join(repo, '.hg')
+    st = os.stat(hgdir)
+    stamp = [st.st_dev, st.st_ino]
+    for f in ('hgrc', 'sharedpath'):
+        try:
+            st = os.stat(os.path.join(hgdir, f))
+            stamp.append((st.st_mtime, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class CommandServer(object):
+    """A command server for the repository at `repo`"""
+
+    def __init__(self, repo, hg='hg'):
+        self.repo = repo
+        self.stamp = _repo_stamp(repo)
+        env = os.environ.copy()
+        env['HGPLAIN'] = '1'
+        self.proc = subprocess.Popen(
+            [hg, '--config', 'ui.interactive=False',
+             'serve', '--cmdserver', 'pipe'],
+            cwd=repo, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            close_fds=(os.name != 'nt'))
+
+        channel, hello = self._read_channel()
+        if channel != 'o':
+            self.close()
+            raise CommandServerError("Unexpected hello from command server")
+        capabilities = []
+        for line in hello.splitlines():
+            if line.startswith('capabilities:'):
+                capabilities = line.split()[1:]
+        if 'runcommand' not in capabilities:
+            self.close()
+            raise CommandServerError("Command server can't run commands")
+        log.debug("Started command server for %s (pid %i)", repo,
+                  self.proc.pid)
+
+    def _read(self, size):
+        data = self.proc.stdout.read(size)
+        if len(data) != size:
+            raise CommandServerError("Command server for %s went away" %
+                                     self.repo)
+        return data
+
+    def _read_channel(self):
+        channel, length = struct.unpack('>cI', self._read(5))
+        if channel in 'IL':
+            # The server wants input; `length` is how much it will take
+            return channel, length
+        return channel, self._read(length)
+
+    def _write(self, data):
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except IOError:
+            raise CommandServerError("Command server for %s went away" %
+                                     self.repo)
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def is_current(self):
+        """Returns True if the repository hasn't been replaced or
+        reconfigured since we started"""
+        try:
+            return _repo_stamp(self.repo) == self.stamp
+        except OSError:
+            return False
+
+    def runcommand(self, args):
+        """Runs hg with `args`, returning (return code, stdout, stderr)"""
+        data = '\0'.join(args)
+        self._write('runcommand\n' + struct.pack('>I', len(data)) + data)
+        out = []
+        err = []
+        while True:
+            channel, data = self._read_channel()
+            if channel == 'o':
+                out.append(data)
+            elif channel == 'e':
+                err.append(data)
+            elif channel == 'r':
+                return struct.unpack('>i', data)[0], ''.join(out), ''.join(err)
+            elif channel in 'IL':
+                # We have no input to give it
+                self._write(struct.pack('>I', 0))
+            elif channel.isupper():
+                # Required channels we don't understand
+                raise CommandServerError("Unknown channel %r" % channel)
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            pass
+
+
+# repository path -> CommandServer
+_servers = {}
+# repositories we couldn't start a command server for
+_broken = set()
+
+
+def get_server(repo):
+    """Returns a running command server for the repository at `repo`, or
+    None if there isn't a repository there or a server can't be started"""
+    repo = os.path.realpath(repo)
+    if repo in _broken or not os.path.isdir(os.path.join(repo, '.hg')):
+        return None
+
+    server = _servers.get(repo)
+    if server and server.is_alive() and server.is_current():
+        return server
+    if server:
+        close_server(repo)
+
+    try:
+        server = CommandServer(repo)
+    except (CommandServerError, OSError, struct.error):
+        log.warning("Couldn't start a command server for %s", repo,
+                    exc_info=True)
+        _broken.add(repo)
+        return None
+    _servers[repo] = server
+    return server
+
+
+def close_server(repo):
+    server = _servers.pop(os.path.realpath(repo), None)
+    if server:
+        server.close()
+
+
+def close_all():
+    for repo in _servers.keys():
+        close_server(repo)
+
+atexit.register(close_all)
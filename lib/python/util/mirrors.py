@@ -0,0 +1,167 @@
+"""Choosing which mirror of a repository (or bundle) to use.
+
+All of the mirrors are probed at once with a cheap request, and each one's
+latency and recent failures are kept in a small JSON file, so that the
+fastest healthy mirror is tried first.  Failures are forgotten over time
+(halving every FAILURE_HALF_LIFE seconds), so a mirror that was down is
+tried again once it has had time to recover.
+
+Only http(s) mirrors can be probed; if any of the mirrors given aren't, they
+are left in the order they were given in.
+"""
+import os
+import time
+import json
+import tempfile
+import threading
+import urllib2
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_STATS_FILE = os.environ.get(
+    'MIRROR_STATS_FILE', os.path.expanduser('~/.mirror_stats.json'))
+PROBE_TIMEOUT = 5
+FAILURE_HALF_LIFE = 3600
+# How much weight new latency measurements get
+LATENCY_WEIGHT = 0.3
+
+
+def _probe_url(url, method='GET', timeout=PROBE_TIMEOUT):
+    """Returns how long it takes to get the first byte of `url`, raising
+    an exception if it can't be fetched"""
+    req = urllib2.Request(url)
+    req.get_method = lambda: method
+    start = time.time()
+    resp = urllib2.urlopen(req, timeout=timeout)
+    try:
+        if method != 'HEAD':
+            resp.read(1)
+    finally:
+        resp.close()
+    return time.time() - start
+
+
+def probe_hg(mirror, timeout=PROBE_TIMEOUT):
+    return _probe_url(mirror.rstrip('/') + '?cmd=capabilities',
+                      timeout=timeout)
+
+
+def probe_git(mirror, timeout=PROBE_TIMEOUT):
+    return _probe_url(mirror.rstrip('/') +
+                      '/info/refs?service=git-upload-pack', timeout=timeout)
+
+
+def probe_file(url, timeout=PROBE_TIMEOUT):
+    return _probe_url(url, method='HEAD', timeout=timeout)
+
+
+class MirrorStats(object):
+    """Latency and health records for mirrors, stored in `filename`"""
+
+    def __init__(self, filename=DEFAULT_STATS_FILE):
+        self.filename = filename
+        self.stats = {}
+        self.load()
+
+    def load(self):
+        try:
+            self.stats = json.load(open(self.filename))
+        except (IOError, ValueError):
+            self.stats = {}
+
+    def save(self):
+        try:
+            fd, tmpname = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.filename)))
+            fp = os.fdopen(fd, 'w')
+            json.dump(self.stats, fp)
+            fp.close()
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError):
+            log.debug("Couldn't save mirror stats to %s", self.filename,
+                      exc_info=True)
+
+    def failures(self, mirror, now=None):
+        """Returns the number of recent failures for `mirror`, decayed by
+        how long ago they were"""
+        s = self.stats.get(mirror)
+        if not s:
+            return 0.0
+        if now is None:
+            now = time.time()
+        age = max(now - s['time'], 0)
+        return s['failures'] * 0.5 ** (age / FAILURE_HALF_LIFE)
+
+    def record(self, mirror, latency=None, failed=False, now=None):
+        if now is None:
+            now = time.time()
+        failures = self.failures(mirror, now)
+        s = self.stats.setdefault(mirror, {'latency': None})
+        if failed:
+            failures += 1
+        elif latency is not None:
+            if s['latency'] is None:
+                s['latency'] = latency
+            else:
+                s['latency'] += LATENCY_WEIGHT * (latency - s['latency'])
+        s['failures'] = failures
+        s['time'] = now
+
+    def score(self, mirror):
+        """Lower is better"""
+        s = self.stats.get(mirror)
+        if not s or s['latency'] is None:
+            latency = PROBE_TIMEOUT
+        else:
+            latency = s['latency']
+        return latency * (1 + self.failures(mirror))
+
+
+def order_mirrors(mirrors, probe, stats_file=DEFAULT_STATS_FILE,
+                  timeout=PROBE_TIMEOUT):
+    """Probes all of `mirrors` at once using `probe`, and returns them
+    ordered from best to worst. Mirrors that failed their probe come last."""
+    mirrors = list(mirrors)
+    if len(mirrors) < 2 or \
+            not all(m.startswith(('http://', 'https://')) for m in mirrors):
+        return mirrors
+
+    results = {}
+
+    def do_probe(mirror):
+        try:
+            results[mirror] = probe(mirror, timeout=timeout)
+        except Exception, e:
+            log.info("Probing mirror %s failed: %s", mirror, e)
+            results[mirror] = None
+
+    threads = [threading.Thread(target=do_probe, args=(m,)) for m in mirrors]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    # Don't let a hung probe hold us up for too long
+    deadline = time.time() + timeout + 1
+    for t in threads:
+        t.join(max(deadline - time.time(), 0))
+
+    stats = MirrorStats(stats_file)
+    for m in mirrors:
+        latency = results.get(m)
+        stats.record(m, latency=latency, failed=latency is None)
+    stats.save()
+
+    ordered = sorted(mirrors, key=lambda m: (results.get(m) is None,
+                                             stats.score(m)))
+    log.info("Mirror order: %s", ", ".join(ordered))
+    return ordered
+
+
+def record_failure(mirror, stats_file=DEFAULT_STATS_FILE):
+    """Records that using `mirror` failed, so that it's tried later next
+    time"""
+    if not mirror.startswith(('http://', 'https://')):
+        return
+    stats = MirrorStats(stats_file)
+    stats.record(mirror, failed=True)
+    stats.save()
@@ -0,0 +1,248 @@
+"""Fast removal of large directory trees.
+
+Rather than stat'ing and chmod'ing everything on the way down, each entry is
+simply unlinked; if that fails because it's a directory, it is descended
+into, and permissions are only fixed up when a removal fails because of them.
+Where the scandir module is available, directory entries' types are used to
+avoid the failed unlinks as well.
+
+Directories are handed out to a pool of threads, so that separate subtrees
+are removed at the same time.
+"""
+import os
+import sys
+import stat
+import errno
+import threading
+import tempfile
+import Queue
+
+import logging
+log = logging.getLogger(__name__)
+
+try:
+    scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+DEFAULT_THREADS = 8
+
+
+def _fix_perms(path, root):
+    """Makes path, and its parent directory if that's inside the tree at root,
+    writable by us"""
+    try:
+        if path.startswith(os.path.join(root, '')):
+            os.chmod(os.path.dirname(path), 0700)
+        if not os.path.islink(path):
+            os.chmod(path, 0700)
+    except OSError:
+        pass
+
+
+def _unlink(path, root):
+    """Removes path, part of the tree at root, if it isn't a directory. Returns
+    True if it's gone, and False if it's a directory."""
+    try:
+        os.unlink(path)
+        return True
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return True
+        if e.errno == errno.EISDIR:
+            return False
+        if e.errno not in (errno.EPERM, errno.EACCES):
+            raise
+    # Either it's a directory (EPERM on OSX), or we're not allowed to remove it
+    try:
+        if stat.S_ISDIR(os.lstat(path).st_mode):
+            return False
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return True
+        raise
+    _fix_perms(path, root)
+    os.unlink(path)
+    return True
+
+
+def _listdir(path, root, retry=True):
+    """Returns a list of (name, is_dir) for path's entries. is_dir is None if
+    we don't know."""
+    try:
+        if scandir:
+            return [(e.name, e.is_dir(follow_symlinks=False))
+                    for e in scandir(path)]
+        return [(name, None) for name in os.listdir(path)]
+    except OSError, e:
+        if e.errno != errno.EACCES or not retry:
+            raise
+    # We need to be able to read and search directories to empty them
+    _fix_perms(path, root)
+    return _listdir(path, root, retry=False)
+
+
+def _rmdir(path, root):
+    try:
+        os.rmdir(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return
+        if e.errno not in (errno.EPERM, errno.EACCES):
+            raise
+        _fix_perms(path, root)
+        os.rmdir(path)
+
+
+class TreeRemover(object):
+    """
+    Removes directory trees using `threads` threads.
+
+    If `throttle` is set, it is called after each file is removed, and can
+    sleep to limit how quickly files are removed.
+    """
+
+    def __init__(self, threads=DEFAULT_THREADS, throttle=None):
+        self.threads = max(threads, 1)
+        self.throttle = throttle
+        self._throttle_lock = threading.Lock()
+
+    def remove(self, path):
+        """Removes path, which can also be a file or a symlink"""
+        path = os.path.normpath(path)
+        if not os.path.lexists(path):
+            return
+        if _unlink(path, path):
+            return
+
+        self.root = path
+        self.queue = Queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.error = None
+        # directory -> number of subdirectories that haven't been removed yet
+        self.pending = {}
+
+        self.queue.put(path)
+        workers = []
+        for i in range(self.threads):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        try:
+            # Wait with a timeout so we can be interrupted
+            while not self.done.wait(1):
+                pass
+        finally:
+            for t in workers:
+                self.queue.put(None)
+            for t in workers:
+                t.join()
+
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _worker(self):
+        while True:
+            d = self.queue.get()
+            if d is None:
+                return
+            if self.done.is_set():
+                continue
+            try:
+                self._empty(d)
+            except Exception:
+                self.error = sys.exc_info()
+                self.done.set()
+
+    def _empty(self, d):
+        """Removes the files in d, and queues up its subdirectories. If it has
+        none, d is removed straight away."""
+        subdirs = []
+        for name, is_dir in _listdir(d, self.root):
+            full_name = os.path.join(d, name)
+            if is_dir:
+                subdirs.append(full_name)
+                continue
+            if not _unlink(full_name, self.root):
+                subdirs.append(full_name)
+                continue
+            if self.throttle:
+                with self._throttle_lock:
+                    self.throttle()
+
+        if not subdirs:
+            self._finish(d)
+            return
+        with self.lock:
+            self.pending[d] = len(subdirs)
+        for s in subdirs:
+            self.queue.put(s)
+
+    def _finish(self, d):
+        """Removes the now empty directory d, and then any of its parents
+        that have no subdirectories left"""
+        while True:
+            _rmdir(d, self.root)
+            if d == self.root:
+                self.done.set()
+                return
+            parent = os.path.dirname(d)
+            with self.lock:
+                self.pending[parent] -= 1
+                if self.pending[parent]:
+                    return
+                del self.pending[parent]
+            d = parent
+
+
+def rmtree(path, threads=DEFAULT_THREADS, background=False, throttle=None):
+    """Removes the directory tree at path.
+
+    If background is set, path is moved out of the way and removed by a
+    detached process, and the name it was moved to is returned. Where we
+    can't fork, it is removed before returning as usual."""
+    if background:
+        return rmtree_background(path, threads)
+    log.debug("Removing %s", path)
+    TreeRemover(threads, throttle).remove(path)
+
+
+def rmtree_background(path, threads=DEFAULT_THREADS):
+    """Moves path into a new hidden directory alongside it, and removes that
+    in a detached process. Returns the name of the hidden directory."""
+    if not os.path.lexists(path):
+        return None
+    parent, name = os.path.split(os.path.abspath(path))
+    trash = tempfile.mkdtemp(dir=parent, prefix='.%s.deleteme.' % name)
+    os.rename(path, os.path.join(trash, name))
+    log.debug("Removing %s (as %s) in the background", path, trash)
+
+    if not hasattr(os, 'fork'):
+        TreeRemover(threads).remove(trash)
+        return trash
+
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return trash
+
+    # Detach from our parent's session, and fork again so we're not left as
+    # a zombie
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        # Don't hold on to our parent's output; buildbot waits for it to be
+        # closed
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.nice(10)
+        TreeRemover(threads).remove(trash)
+    finally:
+        os._exit(0)
@@ -1,11 +1,13 @@
 #!/usr/bin/python
-"""%prog [options] format inputfile outputfile inputfilename"""
+"""%prog [options] format inputfile outputfile inputfilename
+       %prog [options] --helper format"""
 import os
 import os.path
 import site
 # Modify our search path to find our modules
 site.addsitedir(os.path.join(os.path.dirname(__file__), "../../lib/python"))
 
+import json
 import logging
 import sys
 
@@ -14,6 +16,125 @@ from signing.utils import shouldSign, signfile, osslsigncode_signfile
 from signing.utils import gpg_signfile, mar_signfile, dmg_signpackage
 from signing.utils import jar_signfile, emevoucher_signfile
 
+log = logging.getLogger(__name__)
+
+
+def sign(parser, options, format_, inputfile, destfile, filename, passphrase):
+    """Sign `inputfile` in format `format_`, writing the result to
+    `destfile`. `filename` is the file's original name."""
+    tmpfile = destfile + ".tmp"
+
+    if format_ == "signcode":
+        if not options.signcode_keydir:
+            parser.error("keydir required when format is signcode")
+        copyfile(inputfile, tmpfile)
+        if shouldSign(filename):
+            signfile(tmpfile, options.signcode_keydir, options.fake,
+                     passphrase, timestamp=options.signcode_timestamp)
+        else:
+            parser.error("Invalid file for signing: %s" % filename)
+            sys.exit(1)
+    elif format_ == "osslsigncode":
+        safe_unlink(tmpfile)
+        if not options.signcode_keydir:
+            parser.error("keydir required when format is osslsigncode")
+        if shouldSign(filename):
+            osslsigncode_signfile(inputfile, tmpfile, options.signcode_keydir, options.fake,
+                     passphrase, timestamp=options.signcode_timestamp)
+        else:
+            parser.error("Invalid file for signing: %s" % filename)
+            sys.exit(1)
+    elif format_ == "gpg":
+        if not options.gpg_homedir:
+            parser.error("gpgdir required when format is gpg")
+        safe_unlink(tmpfile)
+        gpg_signfile(
+            inputfile, tmpfile, options.gpg_homedir, options.fake, passphrase)
+    elif format_ == "emevoucher":
+        safe_unlink(tmpfile)
+        emevoucher_signfile(
+            inputfile, tmpfile, options.emevoucher_key, options.fake, passphrase)
+    elif format_ == "mar":
+        if not options.mar_cmd:
+            parser.error("mar_cmd is required when format is mar")
+        safe_unlink(tmpfile)
+        mar_signfile(
+            inputfile, tmpfile, options.mar_cmd, options.fake, passphrase)
+    elif format_ == "b2gmar":
+        if not options.b2gmar_cmd:
+            parser.error("b2gmar_cmd is required when format is b2gmar")
+        safe_unlink(tmpfile)
+        mar_signfile(
+            inputfile, tmpfile, options.b2gmar_cmd, options.fake, passphrase)
+    elif format_ == "dmg":
+        if not options.dmg_keychain:
+            parser.error("dmg_keychain required when format is dmg")
+        if not options.mac_id:
+            parser.error("mac_id required when format is dmg")
+        safe_unlink(tmpfile)
+        dmg_signpackage(inputfile, tmpfile, options.dmg_keychain, options.mac_id, options.mac_cert_subject_ou, options.fake, passphrase)
+    elif format_ == "jar":
+        if not options.jar_keystore:
+            parser.error("jar_keystore required when format is jar")
+        if not options.jar_keyname:
+            parser.error("jar_keyname required when format is jar")
+        copyfile(inputfile, tmpfile)
+        jar_signfile(tmpfile, options.jar_keystore,
+                     options.jar_keyname, options.fake, passphrase)
+
+    os.rename(tmpfile, destfile)
+
+
+def serve(parser, options, format_):
+    """Sign files in format `format_` as they are requested on stdin, until
+    stdin is closed.
+
+    The first line of input is the JSON encoded passphrase. Each subsequent
+    line is a JSON list of [inputfile, destfile, filename] requests, which are
+    answered with a JSON list of return codes on stdout. Output from signing
+    each file is appended to destfile + ".out".
+    """
+    # Keep our own copies of stdin and stdout for talking to the signing
+    # server, so that signing tools we run can't interfere with them
+    requests = os.fdopen(os.dup(0), 'rb')
+    responses = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in 0, 1, 2:
+        os.dup2(devnull, fd)
+
+    passphrase = json.loads(requests.readline())
+    if passphrase is not None:
+        passphrase = passphrase.encode('utf-8')
+    while True:
+        line = requests.readline()
+        if not line:
+            break
+        results = []
+        for request in json.loads(line):
+            inputfile, destfile, filename = [r.encode('utf-8') for r in request]
+            output = os.open(destfile + ".out",
+                             os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            os.dup2(output, 1)
+            os.dup2(output, 2)
+            os.close(output)
+            try:
+                sign(parser, options, format_, inputfile, destfile, filename,
+                     passphrase)
+                rc = 0
+            except SystemExit, e:
+                rc = e.code or 1
+            except Exception:
+                log.exception("Error signing %s", filename)
+                rc = 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+            results.append(rc)
+        responses.write(json.dumps(results) + "\n")
+        responses.flush()
+
+
 if __name__ == '__main__':
     from optparse import OptionParser
     from ConfigParser import RawConfigParser
@@ -31,6 +152,7 @@ if __name__ == '__main__':
         jar_keystore=None,
         jar_keyname=None,
         emevoucher_key=None,
+        helper=False,
     )
     parser.add_option("--keydir", dest="signcode_keydir",
                       help="where MozAuthenticode.spc, MozAuthenticode.spk can be found")
@@ -52,6 +174,8 @@ if __name__ == '__main__':
                       help="which key to use from jar_keystore")
     parser.add_option("--emevoucher_key", dest="emevoucher_key",
                       help="The certificate to use for signing the eme voucher")
+    parser.add_option("--helper", dest="helper", action="store_true",
+                      help="keep running, signing files requested on stdin")
     parser.add_option(
         "-v", action="store_const", dest="loglevel", const=logging.DEBUG)
 
@@ -72,73 +196,19 @@ if __name__ == '__main__':
     logging.basicConfig(
         level=options.loglevel, format="%(asctime)s - %(message)s")
 
+    if options.helper:
+        if len(args) != 1:
+            parser.error("Incorrect number of arguments")
+        serve(parser, options, args[0])
+        sys.exit(0)
+
     if len(args) != 4:
         parser.error("Incorrect number of arguments")
 
     format_, inputfile, destfile, filename = args
 
-    tmpfile = destfile + ".tmp"
-
     passphrase = sys.stdin.read().strip()
     if passphrase == '':
         passphrase = None
 
-    if format_ == "signcode":
-        if not options.signcode_keydir:
-            parser.error("keydir required when format is signcode")
-        copyfile(inputfile, tmpfile)
-        if shouldSign(filename):
-            signfile(tmpfile, options.signcode_keydir, options.fake,
-                     passphrase, timestamp=options.signcode_timestamp)
-        else:
-            parser.error("Invalid file for signing: %s" % filename)
-            sys.exit(1)
-    elif format_ == "osslsigncode":
-        safe_unlink(tmpfile)
-        if not options.signcode_keydir:
-            parser.error("keydir required when format is osslsigncode")
-        if shouldSign(filename):
-            osslsigncode_signfile(inputfile, tmpfile, options.signcode_keydir, options.fake,
-                     passphrase, timestamp=options.signcode_timestamp)
-        else:
-            parser.error("Invalid file for signing: %s" % filename)
-            sys.exit(1)
-    elif format_ == "gpg":
-        if not options.gpg_homedir:
-            parser.error("gpgdir required when format is gpg")
-        safe_unlink(tmpfile)
-        gpg_signfile(
-            inputfile, tmpfile, options.gpg_homedir, options.fake, passphrase)
-    elif format_ == "emevoucher":
-        safe_unlink(tmpfile)
-        emevoucher_signfile(
-            inputfile, tmpfile, options.emevoucher_key, options.fake, passphrase)
-    elif format_ == "mar":
-        if not options.mar_cmd:
-            parser.error("mar_cmd is required when format is mar")
-        safe_unlink(tmpfile)
-        mar_signfile(
-            inputfile, tmpfile, options.mar_cmd, options.fake, passphrase)
-    elif format_ == "b2gmar":
-        if not options.b2gmar_cmd:
-            parser.error("b2gmar_cmd is required when format is b2gmar")
-        safe_unlink(tmpfile)
-        mar_signfile(
-            inputfile, tmpfile, options.b2gmar_cmd, options.fake, passphrase)
-    elif format_ == "dmg":
-        if not options.dmg_keychain:
-            parser.error("dmg_keychain required when format is dmg")
-        if not options.mac_id:
-            parser.error("mac_id required when format is dmg")
-        safe_unlink(tmpfile)
-        dmg_signpackage(inputfile, tmpfile, options.dmg_keychain, options.mac_id, options.mac_cert_subject_ou, options.fake, passphrase)
-    elif format_ == "jar":
-        if not options.jar_keystore:
-            parser.error("jar_keystore required when format is jar")
-        if not options.jar_keyname:
-            parser.error("jar_keyname required when format is jar")
-        copyfile(inputfile, tmpfile)
-        jar_signfile(tmpfile, options.jar_keystore,
-                     options.jar_keyname, options.fake, passphrase)
-
-    os.rename(tmpfile, destfile)
+    sign(parser, options, format_, inputfile, destfile, filename, passphrase)
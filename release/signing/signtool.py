@@ -10,7 +10,7 @@ import site
 # Modify our search path to find our modules
 site.addsitedir(os.path.join(os.path.dirname(__file__), "../../lib/python"))
 
-from signing.client import remote_signfile, buildValidatingOpener
+from signing.client import remote_signfile, remote_signfiles, buildValidatingOpener
 from util.archives import packtar, unpacktar
 from util.paths import findfiles
 
@@ -59,6 +59,7 @@ def main():
         tokenfile=None,
         noncefile=None,
         cachedir=None,
+        batch=False,
     )
 
     parser.add_option(
@@ -87,6 +88,8 @@ def main():
                       help="command to re-sign nss libraries, if required")
     parser.add_option("--cachedir", dest="cachedir",
                       help="local cache directory")
+    parser.add_option("--batch", dest="batch", action="store_true",
+                      help="sign files in batches, spread across all hosts")
     # TODO: Concurrency?
     # TODO: Different certs per server?
 
@@ -195,6 +198,7 @@ def main():
         else:
             files = findfiles(args, options.includes, options.excludes)
 
+        to_sign = []
         for f in files:
             log.debug("%s", f)
             log.debug("checking %s for signature...", f)
@@ -205,10 +209,17 @@ def main():
                 dest = os.path.join(options.output_dir, os.path.basename(f))
             else:
                 dest = None
+            to_sign.append((f, dest))
 
-            if not remote_signfile(options, urls, f, fmt, token, dest):
-                log.error("Failed to sign %s with %s", f, fmt)
+        if options.batch and len(to_sign) > 1:
+            if not remote_signfiles(options, urls, to_sign, fmt, token):
+                log.error("Failed to sign files with %s", fmt)
                 sys.exit(1)
+        else:
+            for f, dest in to_sign:
+                if not remote_signfile(options, urls, f, fmt, token, dest):
+                    log.error("Failed to sign %s with %s", f, fmt)
+                    sys.exit(1)
 
         if fmt == "dmg":
             for fd in args:
@@ -1,138 +1,19 @@
 #!/usr/bin/python
 # Verifies that a directory of signed files matches a corresponding directory
 # of unsigned files
-import tempfile
+import os
+import site
+# Modify our search path to find our modules
+site.addsitedir(os.path.join(os.path.dirname(__file__), "../../lib/python"))
 import random
-from subprocess import call
+import logging
 
-from signing import *
+from util.paths import convertPath, findfiles
+from release.info import fileInfo
+from signing.utils import sortFiles, filterFiles, checkTools, sums_are_equal
+from signing.verify import check_repack
 
-
-def check_repack(unsigned, signed, binary_checksums, fake_signatures=False,
-                 product="firefox"):
-    """Check that files `unsigned` and `signed` match.  They will both be
-    unpacked and their contents compared.
-
-    Verifies that all non-signable files are unmodified and have the same
-    permissions.  If fake_signatures is True, then the files in `signed` aren't
-    actually signed, so they're compared to the unsigned ones to make sure
-    they're identical as well.
-
-    If fake_signatures is False, then chktrust is used to verify that signed
-    files have valid signatures.
-
-    binary_checksums contains a dict of filenames to sha1sums. These are
-    stored and used for verification inside locales across installers and MARs
-    """
-    if not os.path.exists(unsigned):
-        return False, "%s doesn't exist" % unsigned
-    if not os.path.exists(signed):
-        return False, "%s doesn't exist" % signed
-    unsigned_dir = os.path.abspath(tempfile.mkdtemp())
-    signed_dir = os.path.abspath(tempfile.mkdtemp())
-    try:
-        # Unpack both files
-        unpackfile(unsigned, unsigned_dir)
-        unpackfile(signed, signed_dir)
-
-        unsigned_files = sorted(
-            [f[len(unsigned_dir) + 1:] for f in findfiles(unsigned_dir)])
-        signed_files = sorted(
-            [f[len(signed_dir) + 1:] for f in findfiles(signed_dir)])
-
-        unsigned_dirs = sorted(
-            [d[len(unsigned_dir) + 1:] for d in finddirs(unsigned_dir)])
-        signed_dirs = sorted(
-            [d[len(signed_dir) + 1:] for d in finddirs(signed_dir)])
-
-        # Make sure the list of files are the same
-        if signed_files != unsigned_files:
-            new_files = ",".join(set(signed_files) - set(unsigned_files))
-            removed_files = ",".join(set(unsigned_files) - set(signed_files))
-            return False, """List of files differs:
-Added: %(new_files)s
-Missing: %(removed_files)s""" % locals()
-
-        # And the list of directories too
-        if signed_dirs != unsigned_dirs:
-            new_dirs = ",".join(set(signed_dirs) - set(unsigned_dirs))
-            removed_dirs = ",".join(set(unsigned_dirs) - set(signed_dirs))
-            return False, """List of directories differs:
-Added: %(new_dirs)s
-Missing: %(removed_dirs)s""" % locals()
-
-        # Check the directory modes
-        for d in unsigned_dirs:
-            ud = os.path.join(unsigned_dir, d)
-            sd = os.path.join(signed_dir, d)
-            if os.stat(sd).st_mode != os.stat(ud).st_mode:
-                return False, "Mode mismatch (%o != %o) in %s" % (os.stat(ud).st_mode, os.stat(sd).st_mode, d)
-
-        info = fileInfo(signed, product)
-
-        chkfiles = []
-
-        for f in unsigned_files:
-            sf = os.path.join(signed_dir, f)
-            uf = os.path.join(unsigned_dir, f)
-            b = os.path.basename(sf)
-            if info['format'] == 'mar':
-                # Need to decompress this first
-                bunzip2(sf)
-                bunzip2(uf)
-
-            # Check the file mode
-            if os.stat(sf).st_mode != os.stat(uf).st_mode:
-                return False, "Mode mismatch (%o != %o) in %s" % (os.stat(uf).st_mode, os.stat(sf).st_mode, f)
-
-            # Check the file signatures and also store the file checksums for
-            # comparison against the corresponding file in the installer/MAR
-            # pair
-            if not fake_signatures and shouldSign(uf):
-                d = os.path.dirname(sf)
-                nullfd = open(os.devnull, "w")
-                if 0 != call(['chktrust', '-q', b], cwd=d, stdout=nullfd):
-                    return False, "Bad signature %s in %s (%s)" % (f, signed, cygpath(sf))
-                else:
-                    # store checksum for signed binary for later verification
-                    binary_checksums[b] = sha1sum(sf)
-                    log.debug("%s OK", b)
-            else:
-                # Check the hashes
-                if f == "update.manifest":
-                    sf_lines = sorted(open(sf).readlines())
-                    uf_lines = sorted(open(uf).readlines())
-                    if sf_lines != uf_lines:
-                        return False, "update.manifest differs"
-                    log.debug("%s OK", b)
-                elif f.endswith(".chk"):
-                    chkfiles.append(sf)
-                elif sha1sum(sf) != sha1sum(uf):
-                    return False, "sha1sum on %s differs" % f
-                else:
-                    log.debug("%s OK", b)
-
-        # We need to wait for all the .chk and their dlls to be unpacked /
-        # uncompressed before checking them
-        for f in chkfiles:
-            d = os.path.dirname(f)
-            b = os.path.basename(f)
-            nullfd = open(os.devnull, "w")
-            cmd = ['chktest', b.replace(".chk", ".dll")]
-            log.debug("Checking chk file %s" % cmd)
-            if 0 != call(cmd, cwd=d, stdout=nullfd):
-                return False, "Bad chk file %s" % f
-            else:
-                log.debug("chk file OK")
-
-        return True, "OK"
-    except:
-        import traceback
-        print traceback.format_exc()
-        raise
-    finally:
-        shutil.rmtree(unsigned_dir)
-        shutil.rmtree(signed_dir)
+log = logging.getLogger()
 
 
 def verify_checksums(sums):
@@ -238,8 +119,6 @@ def filter_quick(unsigned_packages, first_locale, product):
 
 if __name__ == "__main__":
     import sys
-    import os
-    import logging
     from optparse import OptionParser
 
     parser = OptionParser(
@@ -251,6 +130,7 @@ if __name__ == "__main__":
         first_locale='en-US',
         quick=False,
         loglevel=logging.INFO,
+        threads=4,
     )
     parser.add_option("", "--fake", dest="fake", action="store_true", help="Don't verify signatures, just compare file hashes")
     parser.add_option("", "--abort-on-fail", dest="abortOnFail", action="store_true", help="Stop processing after the first error")
@@ -259,6 +139,8 @@ if __name__ == "__main__":
                       help="first locale to check")
     parser.add_option("", "--quick-verify", dest="quick", action="store_true",
                       help="Verify only first locale and one random additional locale")
+    parser.add_option("-j", "--threads", dest="threads", type="int",
+                      help="how many files to read or check at once")
     parser.add_option("-q", "--quiet", dest="loglevel", action="store_const",
                       const=logging.WARNING, help="be quiet")
     parser.add_option("-v", "--verbose", dest="loglevel", action="store_const",
@@ -289,15 +171,22 @@ if __name__ == "__main__":
 
     failed = False
     all_checksums = {}
+    # The sha1sums of binaries whose signatures have been checked, per
+    # locale, so that the same binary in the installer and MAR is only
+    # checked once
+    verified_digests = {}
     for uf in unsigned_files[:]:
         sf = convertPath(uf, signed_dir)
         repack_checksums = setup_checksums(all_checksums, uf, options.product)
+        locale = fileInfo(uf, options.product)['locale']
         # repack_checksums is a reference to a sub-dict in
         # all_checksums[locale][format], so when check_repack fills it with
         # the checksums of the package internals for the current file,
         # all_checksums gets populated
-        result, msg = check_repack(uf, sf, repack_checksums, options.fake,
-                                   options.product)
+        result, msg = check_repack(
+            uf, sf, repack_checksums, options.fake, options.product,
+            verified_digests=verified_digests.setdefault(locale, set()),
+            threads=options.threads)
         print sf, result, msg
         if not result:
             failed = True
@@ -13,6 +13,7 @@ log = logging.getLogger(__name__)
 
 from release.info import readReleaseConfig
 from release.updates.verify import UpdateVerifyConfig
+from release.updates.verify_runner import UpdateVerifyRunner, DownloadCache
 from util.commands import run_cmd
 from util.hg import mercurial, update, make_hg_url
 
@@ -47,6 +48,11 @@ if __name__ == "__main__":
         configDict="verifyConfigs",
         chunks=None,
         thisChunk=None,
+        jobs=None,
+        cacheDir=os.environ.get("UPDATE_VERIFY_CACHE",
+                                path.expanduser("~/.update-verify-cache")),
+        cacheMaxSize=20,
+        cacheMaxAge=7,
     )
     parser.add_option("--config-dict", dest="configDict")
     parser.add_option("-t", "--release-tag", dest="releaseTag")
@@ -55,6 +61,18 @@ if __name__ == "__main__":
     parser.add_option("-p", "--platform", dest="platform")
     parser.add_option("--chunks", dest="chunks", type="int")
     parser.add_option("--this-chunk", dest="thisChunk", type="int")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="verify this many updates at once, in python "
+                      "rather than with verify.sh")
+    parser.add_option("--cache-dir", dest="cacheDir",
+                      help="where to keep downloads; this can be shared "
+                      "between chunks")
+    parser.add_option("--cache-max-size", dest="cacheMaxSize", type="float",
+                      help="remove the least recently used downloads until "
+                      "the cache is no bigger than this many GB")
+    parser.add_option("--cache-max-age", dest="cacheMaxAge", type="float",
+                      help="remove downloads that haven't been used in this "
+                      "many days")
 
     options, args = parser.parse_args()
     mercurial(options.buildbotConfigs, "buildbot-configs")
@@ -62,6 +80,23 @@ if __name__ == "__main__":
     releaseConfig = validate(options, args)
     verifyConfigFile = releaseConfig[options.configDict][options.platform]
 
+    if options.jobs:
+        verifyConfig = UpdateVerifyConfig()
+        verifyConfig.read(path.join(UPDATE_VERIFY_DIR, verifyConfigFile))
+        myVerifyConfig = verifyConfig.getChunk(
+            options.chunks, options.thisChunk)
+        runner = UpdateVerifyRunner(
+            myVerifyConfig, path.join(UPDATE_VERIFY_DIR, "work"),
+            DownloadCache(options.cacheDir,
+                          max_size=options.cacheMaxSize * 1024 ** 3,
+                          max_age=options.cacheMaxAge * 24 * 3600),
+            threads=options.jobs,
+            common_dir=path.join(UPDATE_VERIFY_DIR, "../common"))
+        tests = runner.run()
+        if [t for t in tests if t.failed]:
+            sys.exit(1)
+        sys.exit(0)
+
     fd, configFile = mkstemp()
     fh = os.fdopen(fd, "w")
     try:
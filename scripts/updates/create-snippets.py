@@ -1,5 +1,7 @@
+from email.utils import formatdate, mktime_tz, parsedate_tz
 import logging
-from os import makedirs, mkdir, path
+from multiprocessing.pool import ThreadPool
+from os import makedirs, mkdir, path, utime
 import site
 import sys
 
@@ -23,6 +25,8 @@ if __name__ == "__main__":
     parser.add_option("--hash-type", dest="hashType", default="sha512")
     parser.add_option(
         "--checksums-dir", dest="checksumsDir", default="checksums")
+    parser.add_option("-j", "--threads", dest="threads", type="int", default=8,
+                      help="how many checksums files to fetch at once")
     parser.add_option(
         "-v", "--verbose", dest="verbose", default=False, action="store_true")
 
@@ -45,47 +49,77 @@ if __name__ == "__main__":
     appVersion = pc['release'][version]['extension-version']
     prettyVersion = pc['release'][version]['prettyVersion']
 
-    # We end up using most checksums many times so we keep an in-memory
-    # cache of them to speed things up. We also keep an on-disk cache
-    # of the downloaded .checksums files in checksumsDir to speed things up
-    # if we have to re-run the script for some reason.
-    checksums = {}
+    # Every update path for a platform/locale uses the same .checksums file,
+    # so we fetch all of them up front, several at a time, and index them by
+    # file name. We also keep an on-disk cache of the downloaded .checksums
+    # files in checksumsDir, and only download them again if they've changed
+    # on the server, to speed things up if we have to re-run the script for
+    # some reason.
     checksumsDir = options.checksumsDir
     if not path.exists(checksumsDir):
         mkdir(checksumsDir)
 
-    def cacheChecksums(platform, locale, sums):
-        if platform not in checksums:
-            checksums[platform] = {}
-        checksums[platform][locale] = sums
-
-    # We use both an on-disk and in-memory cache of checksums to speed up
-    # the snippet creation process. In order, we try to:
-    # - Look for the checksums in the in-memory cache
-    # - Read the checksums from the on-disk cache
-    # - Download a fresh copy of the checksums file and cache both places.
-    def getChecksum(platform, locale, checksumsFile):
-        if checksums.get(platform, {}).get(locale):
-            log.debug(
-                "Using in-memory checksums for %s %s" % (platform, locale))
-        else:
-            try:
-                cacheChecksums(platform, locale,
-                               parseChecksumsFile(open(checksumsFile).read()))
-                log.debug(
-                    "Using on-disk checksums for %s %s" % (platform, locale))
-            except (IOError, ValueError):
-                contents = requests.get(
-                    checksumsUrl, config={'danger_mode': True}).content
-                log.debug("Using newly downloaded checksums for %s %s" %
-                          (platform, locale))
-                # Cache the sums in-memory and on-disk.
-                cacheChecksums(platform, locale, parseChecksumsFile(contents))
-                with open(checksumsFile, 'w') as f:
-                    f.write(contents)
-        return checksums[platform][locale]
-
-    for fromVersion, platform, locale, channels, updateTypes in pc.getUpdatePaths():
+    updatePaths = list(pc.getUpdatePaths())
+    checksumsFiles = {}
+    for fromVersion, platform, locale, channels, updateTypes in updatePaths:
+        checksumsUrl = substitutePath(
+            pc['release'][version]['checksumsurl'], platform, locale)
+        checksumsFile = path.join(options.checksumsDir, "%s-%s-%s-%s" %
+                                  (appName, platform, locale, version))
+        checksumsFiles[(platform, locale)] = (checksumsUrl, checksumsFile)
+
+    session = requests.session(config={'danger_mode': True,
+                                       'pool_maxsize': options.threads})
+
+    def fetchChecksums(checksumsUrl, checksumsFile):
+        """Returns the contents of the .checksums file at checksumsUrl,
+        using checksumsFile as a cache"""
+        headers = {}
+        if path.exists(checksumsFile):
+            headers['If-Modified-Since'] = formatdate(
+                path.getmtime(checksumsFile), usegmt=True)
+        try:
+            r = session.get(checksumsUrl, headers=headers)
+        except requests.RequestException:
+            if not headers:
+                raise
+            log.warning("Couldn't check %s, using on-disk copy" %
+                        checksumsUrl, exc_info=True)
+            return open(checksumsFile).read()
+        if r.status_code == 304:
+            log.debug("Using on-disk checksums for %s" % checksumsUrl)
+            return open(checksumsFile).read()
+
+        log.debug("Using newly downloaded checksums for %s" % checksumsUrl)
+        contents = r.content
+        with open(checksumsFile, 'w') as f:
+            f.write(contents)
+        lastModified = r.headers.get('last-modified')
+        if lastModified and parsedate_tz(lastModified):
+            mtime = mktime_tz(parsedate_tz(lastModified))
+            utime(checksumsFile, (mtime, mtime))
+        return contents
+
+    def loadChecksums(item):
+        """Fetches and parses a .checksums file, returning a table of file
+        info keyed by base file name"""
+        key, (checksumsUrl, checksumsFile) = item
+        info = {}
+        for f, fileInfo in parseChecksumsFile(
+                fetchChecksums(checksumsUrl, checksumsFile)).iteritems():
+            info.setdefault(path.basename(f), fileInfo)
+        return key, info
+
+    log.info("Fetching %d checksums files" % len(checksumsFiles))
+    pool = ThreadPool(options.threads)
+    try:
+        checksums = dict(pool.map(loadChecksums, checksumsFiles.items(),
+                                  chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+
+    for fromVersion, platform, locale, channels, updateTypes in updatePaths:
         fromRelease = pc['release'][fromVersion]
         buildid = pc['release'][version]['platforms'][platform]
         fromBuildid = fromRelease['platforms'][platform]
@@ -93,12 +127,8 @@ if __name__ == "__main__":
         detailsUrl = substitutePath(
             pc['current-update']['details'], platform, locale, appVersion)
         optionalAttrs = pc.getOptionalAttrs(fromVersion, locale)
-        checksumsUrl = substitutePath(
-            pc['release'][version]['checksumsurl'], platform, locale)
-        checksumsFile = path.join(options.checksumsDir, "%s-%s-%s-%s" %
-                                  (appName, platform, locale, version))
 
-        info = getChecksum(platform, locale, checksumsFile)
+        info = checksums[(platform, locale)]
         # We may have multiple update types to generate a snippet for...
         for type_ in updateTypes:
             # And also multiple channels...
@@ -108,13 +138,10 @@ if __name__ == "__main__":
                 url = pc.getUrl(fromVersion, platform, locale, type_, channel)
                 filename = path.basename(
                     pc.getPath(fromVersion, platform, locale, type_))
-                for f in info:
-                    if filename == path.basename(f):
-                        hash_ = info[f]['hashes'][hashType]
-                        size = info[f]['size']
-                        break
-                else:
+                if filename not in info:
                     raise Exception("Couldn't find hash/size, bailing")
+                hash_ = info[filename]['hashes'][hashType]
+                size = info[filename]['size']
                 # We also may have multiple snippets for the same platform.
                 for snippet in getSnippetPaths(pc['appName'], fromAppVersion, platform, fromBuildid, locale, channel, type_):
                     if channel in pc['current-update']['channel']:
@@ -18,6 +18,10 @@ import pytz
 import shutil
 import re
 import tempfile
+import json
+import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 from optparse import OptionParser
 from errno import EEXIST
@@ -54,14 +58,126 @@ TRY_URL_PATH = config.get('urls', 'try')
 PARTIAL_MAR_RE = re.compile(config.get('patterns', 'partial_mar'))
 
 
-# Cache of original_file to new location on disk
-_linkCache = {}
+class Publisher(object):
+    """ Publishes uploaded files to all of their destinations at once.
+
+    The ReleaseTo* functions only plan where files go, by calling
+    CopyFileToDir. publish() then copies each file once per filesystem, in
+    parallel across files, and hard links (or failing that, reflinks) that
+    copy into the rest of its destinations. Every destination is replaced
+    atomically. Links that point at the published files, like "latest", are
+    queued with addLink() and made once everything has been copied. """
+
+    def __init__(self):
+        # new_file -> original_file
+        self.destinations = {}
+        # list of (function, args) that make links, in the order they're added
+        self.links = []
+        # list of (original_file, new_file, method), as they're published
+        self.published = []
+        self._lock = threading.Lock()
+
+    def add(self, original_file, new_file):
+        self.destinations[new_file] = original_file
+
+    def addLink(self, fn, *args):
+        self.links.append((fn, args))
+
+    def publish(self, threads=4):
+        by_source = {}
+        for new_file, original_file in sorted(self.destinations.items()):
+            by_source.setdefault(original_file, []).append(new_file)
+
+        pool = ThreadPool(threads)
+        try:
+            # map() re-raises the first error we hit
+            pool.map(self._publishFile, by_source.items(), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        for fn, args in self.links:
+            fn(*args)
+
+    def _publishFile(self, item):
+        original_file, new_files = item
+        # device -> a published copy of original_file on it
+        copies = {}
+        for new_file in new_files:
+            dev = os.stat(os.path.dirname(new_file)).st_dev
+            tmp_path = os.path.join(os.path.dirname(new_file), ".%s.%i.tmp" %
+                                    (os.path.basename(new_file), os.getpid()))
+            try:
+                method = None
+                if dev in copies:
+                    method = linkFile(copies[dev], tmp_path)
+                if not method:
+                    copyFile(original_file, tmp_path)
+                    method = 'copy'
+                os.rename(tmp_path, new_file)
+            except:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            copies.setdefault(dev, new_file)
+            with self._lock:
+                self.published.append((original_file, new_file, method))
+
+    def writeManifest(self, filename):
+        """ Writes a JSON list of what was published, and how """
+        manifest = []
+        for original_file, new_file, method in sorted(self.published):
+            manifest.append({'source': original_file,
+                             'destination': new_file,
+                             'method': method,
+                             'size': os.path.getsize(new_file)})
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)))
+        tmp_fp = os.fdopen(tmp_fd, 'w')
+        json.dump(manifest, tmp_fp, indent=2)
+        tmp_fp.close()
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, filename)
+
+
+def linkFile(src, dest):
+    """ Hard links, or reflinks, src to dest. Returns which one was done, or
+    None if neither worked. """
+    try:
+        os.link(src, dest)
+        return 'link'
+    except OSError:
+        pass
+    devnull = open(os.devnull, 'w')
+    try:
+        if subprocess.call(['cp', '--reflink=always', src, dest],
+                           stdout=devnull, stderr=devnull) == 0:
+            os.chmod(dest, 0644)
+            return 'reflink'
+    except OSError:
+        # No cp?
+        pass
+    finally:
+        devnull.close()
+    if os.path.exists(dest):
+        os.unlink(dest)
+    return None
+
+
+def copyFile(src, dest):
+    dest_fp = open(dest, 'wb')
+    shutil.copyfileobj(open(src, 'rb'), dest_fp, 1024 * 1024)
+    dest_fp.close()
+    os.chmod(dest, 0644)
+
+
+publisher = Publisher()
 
 
 def CopyFileToDir(original_file, source_dir, dest_dir, preserve_dirs=False):
-    """ Atomically copy original_file from source_dir into dest_dir,
-    overwriting old files and preserving directory hierarchy if preserve_dirs
-    is True """
+    """ Arrange for original_file from source_dir to be atomically copied into
+    dest_dir by publisher, overwriting old files and preserving directory
+    hierarchy if preserve_dirs is True """
     if not original_file.startswith(source_dir):
         print "%s is not in %s!" % (original_file, source_dir)
         return
@@ -81,34 +197,7 @@ def CopyFileToDir(original_file, source_dir, dest_dir, preserve_dirs=False):
                 print "%s already exists, continuing anyways" % full_dest_dir
             else:
                 raise
-    if os.path.exists(new_file):
-        try:
-            os.unlink(new_file)
-        except OSError, e:
-            # If the file gets deleted by another instance of post_upload
-            # because there was a name collision this improves the situation
-            # as to not abort the process but continue with the next file
-            print "Warning: The file %s has already been unlinked by " + \
-                  "another instance of post_upload.py" % new_file
-            return
-
-    # Try hard linking the file
-    if original_file in _linkCache:
-        for src in _linkCache[original_file]:
-            try:
-                os.link(src, new_file)
-                os.chmod(new_file, 0644)
-                return
-            except OSError:
-                pass
-
-    tmp_fd, tmp_path = tempfile.mkstemp(dir=dest_dir)
-    tmp_fp = os.fdopen(tmp_fd, 'wb')
-    shutil.copyfileobj(open(original_file, 'rb'), tmp_fp)
-    tmp_fp.close()
-    os.chmod(tmp_path, 0644)
-    os.rename(tmp_path, new_file)
-    _linkCache.setdefault(original_file, []).append(new_file)
+    publisher.add(original_file, new_file)
 
 
 def BuildIDToDict(buildid):
@@ -166,13 +255,17 @@ def ReleaseToDated(options, upload_dir, files):
     os.utime(longDatedPath, None)
 
     if not options.noshort:
-        try:
-            cwd = os.getcwd()
-            os.chdir(NIGHTLY_PATH)
-            if not os.path.exists(shortDir):
-                os.symlink(longDir, shortDir)
-        finally:
-            os.chdir(cwd)
+        publisher.addLink(symlink_short_dated_dir, longDir, shortDir)
+
+
+def symlink_short_dated_dir(longDir, shortDir):
+    try:
+        cwd = os.getcwd()
+        os.chdir(NIGHTLY_PATH)
+        if not os.path.exists(shortDir):
+            os.symlink(longDir, shortDir)
+    finally:
+        os.chdir(cwd)
 
 
 def ReleaseToLatest(options, upload_dir, files):
@@ -239,9 +332,13 @@ def ReleaseToBuildDir(builds_dir, builds_url, options, upload_dir, files, dated)
     os.utime(tinderboxBuildsPath, None)
     # create latest softlink?
     if dated and options.release_to_latest_tinderbox_builds:
-        # best effort softlink
-        print >> sys.stderr, "ln -sfnv %s %s" % (_to, _from)
-        os.system('ln -sfnv "%s" "%s"' % (_to, _from))
+        publisher.addLink(symlink_latest, _to, _from)
+
+
+def symlink_latest(_to, _from):
+    # best effort softlink
+    print >> sys.stderr, "ln -sfnv %s %s" % (_to, _from)
+    os.system('ln -sfnv "%s" "%s"' % (_to, _from))
 
 
 def ReleaseToTinderboxBuilds(options, upload_dir, files, dated=True):
@@ -450,6 +547,12 @@ if __name__ == '__main__':
                       help="Copy files to try-builds/$who-$revision")
     parser.add_option("--signed", action="store_true", dest="signed",
                       help="Don't use unsigned directory for uploaded files")
+    parser.add_option("--threads", type="int", default=4,
+                      action="store", dest="threads",
+                      help="How many files to publish at once (default 4)")
+    parser.add_option("--manifest",
+                      action="store", dest="manifest",
+                      help="Write a JSON list of the files published to MANIFEST")
     (options, args) = parser.parse_args()
 
     if len(args) < 2:
@@ -543,3 +646,6 @@ if __name__ == '__main__':
 
     for func in releaseTo:
         func(options, upload_dir, files)
+    publisher.publish(options.threads)
+    if options.manifest:
+        publisher.writeManifest(options.manifest)